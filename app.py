@@ -1,19 +1,114 @@
 import re
+import csv
+import io
+import json
 import traceback
-from flask import Flask, jsonify, redirect, render_template, request, url_for, session, flash
-from models import TipoTransazione, Utente, Lavoro, Conto, Transazione
+import os
+from flask import Flask, Response, g, jsonify, redirect, render_template, request, stream_with_context, url_for, session, flash
+from models import TipoTransazione, Utente, Conto, Transazione
 from database import Base, engine, SessionLocal
+from migrazioni import applica_migrazioni
+from riferimenti import catalogo_lavori
+from storico import PAGINA_TRANSAZIONI, movimenti_estratto, pagina_transazioni
+from hash_pin import ServizioPinOccupato, avvia_pool, calcola_hash
+from limiti_accesso import TroppiTentativi, controlla_tentativo, tentativo_riuscito
+from idempotenza import ChiaveNonUtilizzabile, chiave_corrente, idempotente, nuova_chiave
+from cache_conti import cache as cache_conti, versione_conto, voce_conto
+from eventi import TroppiIscritti, bacheca, flusso_eventi, ultimo_movimento_id
+from coda_movimenti import MovimentoInSospeso, MovimentoRifiutato, Richiesta, applica_blocco, esegui_movimento
+from budget_query import budget_query
+from metriche import concludi_richiesta, inizia_richiesta, registro as registro_metriche
 from functools import wraps
 from sqlalchemy.orm import joinedload
 from sqlalchemy.exc import IntegrityError
 from decimal import Decimal
 from datetime import datetime, timedelta
 from flasgger import Swagger
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
 
 app = Flask(__name__)
-swagger = Swagger(app)
+swagger = Swagger(app, template={
+    "securityDefinitions": {
+        "Bearer": {
+            "type": "apiKey",
+            "name": "Authorization",
+            "in": "header",
+            "description": "Token restituito da /api/login, nel formato: Bearer <token>"
+        }
+    }
+})
 app.secret_key = b'_5#y2L"F4Q8z\n\xec]/'
+
+#token delle API: firmati con HMAC, contengono utente e conti autorizzati e si verificano senza accedere al DB
+DURATA_TOKEN_API = int(os.environ.get("BANCA_TOKEN_DURATA", "900")) #secondi
+firma_token_api = URLSafeTimedSerializer(app.secret_key, salt="token-api")
 Base.metadata.create_all(bind=engine)
+applica_migrazioni(engine)
+avvia_pool()
+catalogo_lavori() #carica subito i dati di riferimento
+
+
+@app.errorhandler(ServizioPinOccupato)
+def servizio_pin_occupato(e):
+    #pool di bcrypt saturo: rispondo subito invece di accodare altro lavoro
+    if request.path.startswith("/api/"):
+        risposta = jsonify({"error": str(e)})
+    else:
+        flash(str(e), "error")
+        risposta = app.make_response(render_template("home.html"))
+    risposta.status_code = 503
+    risposta.headers["Retry-After"] = "1"
+    return risposta
+
+
+@app.errorhandler(TroppiTentativi)
+def troppi_tentativi(e):
+    #tentativi sul PIN esauriti: nessuna verifica bcrypt, si torna alla pagina del modulo
+    if request.path.startswith("/api/"):
+        risposta = jsonify({"error": str(e)})
+        risposta.status_code = 429
+    else:
+        flash(str(e), "error")
+        risposta = redirect(request.path)
+    risposta.headers["Retry-After"] = str(e.attesa)
+    return risposta
+
+
+@app.errorhandler(MovimentoInSospeso)
+def movimento_in_sospeso(e):
+    #lo scrittore ha già preso il movimento ma non ha risposto in tempo: non è fallito, non va ripetuto
+    if request.path.startswith("/api/"):
+        return jsonify({"stato": "in_sospeso", "message": str(e)}), 202
+    flash(str(e), "error")
+    return redirect(url_for("pagina_privata"))
+
+
+@app.errorhandler(ChiaveNonUtilizzabile)
+def chiave_non_utilizzabile(e):
+    #Idempotency-Key non valida, in corso o riusata con altri dati: la richiesta non viene eseguita
+    if request.path.startswith("/api/"):
+        return jsonify({"error": str(e)}), e.stato
+    flash(str(e), "error")
+    return redirect(request.path)
+
+
+#---- Metriche per rotta (metriche.py): la richiesta viene misurata dal routing fino alla risposta ----
+@app.before_request
+def inizia_metriche():
+    if request.endpoint not in ("metriche", "static"):
+        inizia_richiesta()
+
+
+@app.after_request
+def concludi_metriche(risposta):
+    concludi_richiesta(request.endpoint or "non_trovata", request.method, risposta.status_code)
+    return risposta
+
+
+@app.teardown_request
+def concludi_metriche_errore(errore):
+    #solo se after_request non è stato eseguito (eccezione non gestita)
+    concludi_richiesta(request.endpoint or "non_trovata", request.method, 500)
 
 
 @app.route('/')
@@ -21,6 +116,7 @@ def home():
     return render_template('home.html')
 
 @app.route('/login', methods=['GET', 'POST'])
+@budget_query(3)
 def login():
     if request.method == 'GET':
         return render_template('login.html') 
@@ -32,10 +128,13 @@ def login():
         flash("Inserisci sia il codice titolare che il PIN.", "error")
         return redirect(url_for("login"))
 
+    controlla_tentativo(codice_titolare_inserito, request.remote_addr)
     db = SessionLocal()
     try:
         utente = db.query(Utente).filter(Utente.codice_titolare == codice_titolare_inserito).first()
         if utente and utente.verifica_pin(pin_inserito):
+            tentativo_riuscito(codice_titolare_inserito, request.remote_addr)
+            db.commit() #salva l'eventuale hash ricalcolato con il nuovo costo
             session["utente_id"] = utente.id
             flash(f"Benvenuto {utente.nome}!", "success")
             return redirect(url_for("pagina_privata"))
@@ -48,12 +147,13 @@ def login():
 
 
 @app.route('/registrazione', methods=['GET','POST'])
+@budget_query(8)
 def registrazione():
-    db = SessionLocal()
     if request.method == 'GET':
-        lavori_db=db.query(Lavoro).all()
-        return render_template('registrazione.html', lavori=lavori_db)
-    
+        #catalogo lavori dalla cache dei dati di riferimento: la pagina non interroga il database
+        return render_template('registrazione.html', lavori=catalogo_lavori())
+
+    db = SessionLocal()
     nome_inserito = request.form.get('nome') 
     cognome_inserito = request.form.get('cognome') 
     codice_fiscale_inserito = request.form.get('codice_fiscale')
@@ -72,12 +172,17 @@ def registrazione():
         return redirect(url_for('registrazione'))
     
     #controllo se esiste già un utente con quel codice fiscale
-    utente_esistente = db.query(Utente).filter_by(codice_fiscale=codice_fiscale_inserito).first() 
+    utente_esistente = db.execute(Utente.query_codice_fiscale(codice_fiscale_inserito)).first()
     if utente_esistente:
         flash("Esiste già un utente con questo codice fiscale. Effettua il login per aprire un nuovo conto.", "error")
         return redirect(url_for('login'))
     
     try:
+        #bcrypt prima di toccare le sequenze: l'UPDATE di codice titolare e IBAN prende il lock di scrittura,
+        #che deve restare aperto solo per gli insert e il commit, non per l'attesa dell'hash
+        Utente.controlla_formato_pin(pin1_inserito)
+        pin_hash = calcola_hash(pin1_inserito)
+
         nuovo_utente = Utente(
             nome_inserito,
             cognome_inserito,
@@ -85,7 +190,7 @@ def registrazione():
             lavoro_inserito,
             db
         )
-        nuovo_utente.crea_pin(pin1_inserito)
+        nuovo_utente.pin_hash = pin_hash
         db.add(nuovo_utente)
         db.flush()
         #creazione conto associato al nuovo utente
@@ -118,6 +223,10 @@ def registrazione():
         flash("Errore interno durante la generazione dei codici. Riprovare.", "error")
         return redirect(url_for('registrazione'))
 
+    except ServizioPinOccupato:
+        db.rollback()
+        raise
+
     except Exception as e:
         db.rollback()
         flash("Errore durante la registrazione. Riprovare.", "error")
@@ -138,7 +247,55 @@ def login_required(f):
     return wrapper
 
 
+def api_token_required(f):
+    #come login_required ma per le API: verifica solo la firma del token (nessuna query e nessun bcrypt)
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        intestazione = request.headers.get("Authorization", "")
+        if not intestazione.startswith("Bearer "):
+            return jsonify({"error": "Token mancante"}), 401
+        try:
+            dati = firma_token_api.loads(intestazione[len("Bearer "):], max_age=DURATA_TOKEN_API)
+        except (SignatureExpired, BadSignature):
+            return jsonify({"error": "Token non valido o scaduto"}), 401
+
+        if "conto_id" in kwargs and kwargs["conto_id"] not in dati["conti"]:
+            return jsonify({"error": "Conto non autorizzato"}), 403
+
+        g.utente_id = dati["utente"]
+        g.conti_autorizzati = dati["conti"]
+        return f(*args, **kwargs)
+    return wrapper
+
+
+def etag_conto(conto_id, *varianti):
+    #(ETag, versione) del conto: Conto.versione cambia a ogni movimento, quindi basta una lettura per chiave primaria.
+    #La versione viene sempre dal DB e non dalla cache del processo, così un movimento fatto da un altro worker o
+    #da stipendi.py cambia subito l'ETag. None se il conto non esiste o non è dell'utente del token.
+    conto = versione_conto(conto_id)
+    if conto is None:
+        return None
+    utente_id, versione = conto
+    if utente_id != g.utente_id:
+        return None
+    return "-".join(str(parte) for parte in (conto_id, versione, *varianti)), versione
+
+
+def con_etag(risposta, etag):
+    risposta.set_etag(etag)
+    risposta.headers["Cache-Control"] = "private, no-cache" #il client può conservarla ma deve riconvalidarla
+    return risposta
+
+
+def non_modificato(etag):
+    #If-None-Match corrisponde: 304 senza corpo e senza leggere lo storico
+    if request.if_none_match.contains_weak(etag):
+        return con_etag(Response(status=304), etag)
+    return None
+
+
 @app.route('/pagina_privata', methods=['GET','POST'])
+@budget_query(3)
 @login_required
 def pagina_privata():
     db = SessionLocal()
@@ -148,7 +305,8 @@ def pagina_privata():
             flash("Sessione scaduta. Effettua nuovamente il login.", "error")
             return redirect(url_for('login'))
 
-        utente = db.query(Utente).options(joinedload(Utente.conti)).filter_by(id=utente_id).first()
+        #anche il lavoro, letto dal template: senza joinedload sarebbe una query in più a ogni pagina
+        utente = db.query(Utente).options(joinedload(Utente.conti), joinedload(Utente.lavoro)).filter_by(id=utente_id).first()
         if not utente:
             flash("Utente non trovato.", "error")
             return redirect(url_for('login'))
@@ -167,23 +325,27 @@ def pagina_privata():
             conto_selezionato = conti[0] 
             session["conto_selezionato"] = conto_selezionato.id
 
-        # Carica le transazioni solo dal conto selezionato 
-        transazioni = (
-            db.query(Transazione)
-            .filter(
-                (Transazione.conto_mittente_id == conto_selezionato.id) |
-                (Transazione.conto_destinatario_id == conto_selezionato.id)
-            )
-            .order_by(Transazione.data.desc())
-            .all()
-        )
+        # Carica una pagina di transazioni solo dal conto selezionato 
+        cursore = request.args.get("cursore")
+        try:
+            if cursore:
+                transazioni, prossimo_cursore = pagina_transazioni(db, conto_selezionato.id, cursore)
+            else:
+                #prima pagina (la più richiesta): dalla cache dei conti, se non è più vecchia del conto appena letto
+                voce = voce_conto(conto_selezionato.id, conto_selezionato.versione)
+                transazioni, prossimo_cursore = voce.transazioni, voce.prossimo_cursore
+        except ValueError:
+            flash("Pagina dei movimenti non valida.", "error")
+            return redirect(url_for('pagina_privata', conto_id=conto_selezionato.id))
 
         return render_template(
             "pagina_privata.html",
             utente=utente,
             conti=conti,
             conto_selezionato=conto_selezionato,
-            transazioni=transazioni
+            transazioni=transazioni,
+            cursore=cursore,
+            prossimo_cursore=prossimo_cursore
         )
 
     except Exception as e:
@@ -195,12 +357,34 @@ def pagina_privata():
         db.close()
 
 
+@app.route('/pagina_privata/eventi/<int:conto_id>', methods=['GET'])
+@login_required
+def eventi_pagina_privata(conto_id):
+    #stesso flusso delle API per la dashboard (EventSource usa il cookie di sessione, non il token).
+    #EventSource non permette di impostare Last-Event-ID alla prima apertura: la pagina passa in "dopo" l'ultimo
+    #movimento che mostra, così riceve anche quelli arrivati dopo il caricamento
+    conto = versione_conto(conto_id)
+    if conto is None or conto[0] != session.get("utente_id"):
+        return "", 404
+    ultimo_id = request.headers.get("Last-Event-ID", type=int) or request.args.get("dopo", type=int)
+    return risposta_eventi(conto_id, ultimo_id)
+
+
+def movimento_ripreso(messaggio):
+    #ripresa per idempotente: il movimento della chiave è già committato, quindi la risposta è quella del successo
+    def ripresa(movimento_id):
+        flash(messaggio, "success")
+        return redirect(url_for("pagina_privata"))
+    return ripresa
+
+
 @app.route("/effettua_bonifico", methods=["GET", "POST"])
+@budget_query(8) #4 + prenotazione ed esito della chiave, verificata e registrata nel commit del movimento
 @login_required
+@idempotente(ripresa=movimento_ripreso("Bonifico effettuato con successo!"))
 def effettua_bonifico():
-    db = SessionLocal()
     if request.method == "GET":
-        return render_template("effettua_bonifico.html")
+        return render_template("effettua_bonifico.html", chiave_idempotenza=nuova_chiave())
     
     try:
         utente_id = session.get("utente_id")
@@ -209,37 +393,34 @@ def effettua_bonifico():
         iban_destinatario = request.form["iban"].strip() #rimuove gli eventuali spazi
         descrizione_inserita = request.form.get("descrizione", "")
 
-        conto_mittente = db.query(Conto).filter_by(
-            id=conto_id,
-            utente_id=utente_id
-        ).first()
-
-        if not conto_mittente:
-            flash("Nessun conto disponibile.", "error")
-            return redirect(url_for("pagina_privata"))
-
-        # Trova destinatario
-        conto_destinatario = db.query(Conto).filter_by(iban=iban_destinatario).first()
-        if not conto_destinatario:
-            flash("IBAN destinatario non valido.", "error")
-            return redirect(url_for("effettua_bonifico"))
-
-        # Crea transazione
-        trans=conto_mittente.bonifico(
-            conto_destinatario,
+        # Il bonifico passa dalla coda dello scrittore unico (controlli su conto, IBAN e saldo inclusi)
+        esegui_movimento(
+            TipoTransazione.BONIFICO,
+            utente_id,
+            conto_id,
             importo_inserito,
-            descrizione_inserita
+            descrizione_inserita,
+            iban_destinatario=iban_destinatario,
+            chiave=chiave_corrente()
         )
-        db.add(trans)
-        db.commit()
         flash("Bonifico effettuato con successo!", "success")
         return redirect(url_for("pagina_privata"))
+    except MovimentoInSospeso:
+        raise
+    except MovimentoRifiutato as e:
+        if e.motivo == "conto":
+            flash("Nessun conto disponibile.", "error")
+            return redirect(url_for("pagina_privata"))
+        if e.motivo == "iban":
+            flash("IBAN destinatario non valido.", "error")
+            return redirect(url_for("effettua_bonifico"))
+        print("ERRORE BONIFICO:", e)
+        flash("Errore durante il bonifico.", "error")
+        return redirect(url_for("effettua_bonifico"))
     except Exception as e:
         print("ERRORE BONIFICO:", e)
         flash("Errore durante il bonifico.", "error")
         return redirect(url_for("effettua_bonifico"))
-    finally:
-        db.close()
 
 
 
@@ -255,16 +436,13 @@ def apri_nuovo_conto():
         if request.method == "POST":
             pin = request.form.get("pin")
             # Verifica PIN
+            controlla_tentativo(utente.codice_titolare, request.remote_addr)
             if not utente.verifica_pin(pin):
                 flash("PIN errato.", "error")
                 return redirect(url_for("apri_nuovo_conto"))
+            tentativo_riuscito(utente.codice_titolare, request.remote_addr)
             # Limite temporale — max 1 conto ogni 24 ore
-            ultimo_conto = (
-                db.query(Conto)
-                .filter_by(utente_id=utente.id)
-                .order_by(Conto.data_creazione.desc())
-                .first()
-            )
+            ultimo_conto = db.execute(Conto.query_ultimo_aperto(utente.id)).scalars().first()
             if ultimo_conto:
                 limite = ultimo_conto.data_creazione + timedelta(hours=24)
                 if datetime.now(ultimo_conto.data_creazione.tzinfo) < limite:
@@ -303,9 +481,11 @@ def modifica_profilo():
             return redirect(url_for("modifica_profilo"))
 
         # verifica pin attuale
+        controlla_tentativo(utente.codice_titolare, request.remote_addr)
         if not utente.verifica_pin(vecchio_pin_inserito):
             flash("Il PIN attuale non è corretto.", "error")
             return redirect(url_for("modifica_profilo"))
+        tentativo_riuscito(utente.codice_titolare, request.remote_addr)
         
         # verifica nuovi pin se ci sono ripetizioni dei numeri    
         if re.search(r"(\d)\1\1", nuovo_pin_inserito) or re.search(r"(\d)\1\1", conferma_pin_inserito):
@@ -335,6 +515,9 @@ def modifica_profilo():
             db.rollback()
             flash(str(e), "danger")
             return redirect(url_for("modifica_profilo"))
+        except ServizioPinOccupato:
+            db.rollback()
+            raise
         except Exception:
             db.rollback()
             flash("Errore durante l'aggiornamento del PIN.", "danger")
@@ -343,42 +526,45 @@ def modifica_profilo():
     return render_template("modifica_profilo.html")
 
 @app.route("/effettua_pagamento", methods=["GET", "POST"])
+@budget_query(8) #4 + prenotazione ed esito della chiave, verificata e registrata nel commit del movimento
 @login_required
+@idempotente(ripresa=movimento_ripreso("Pagamento effettuato con successo!"))
 def effettua_pagamento():
-    db = SessionLocal()
     if request.method == "GET":
-        return render_template("effettua_pagamento.html")
+        return render_template("effettua_pagamento.html", chiave_idempotenza=nuova_chiave())
     
     try:
         utente_id = session.get("utente_id")
         conto_id = session.get("conto_selezionato")
         importo_inserito = Decimal(request.form["importo"])
         descrizione_inserito = request.form.get("descrizione", "")
-        
-        conto_mittente = db.query(Conto).filter_by(id=conto_id, utente_id=utente_id).first()
 
-        if not conto_mittente:
-            flash("Conto non trovato o non accessibile.", "error")
-            return redirect(url_for("pagina_privata"))
-
-        # Creazione transazione pagamento
-        trans = conto_mittente.pagamento(
+        # Creazione transazione pagamento tramite la coda dello scrittore unico
+        esegui_movimento(
+            TipoTransazione.PAGAMENTO,
+            utente_id,
+            conto_id,
             importo_inserito,
-            descrizione_inserito
+            descrizione_inserito,
+            chiave=chiave_corrente()
         )
-        db.add(trans)
-        db.commit()
         flash("Pagamento effettuato con successo!", "success")
         return redirect(url_for("pagina_privata"))
 
+    except MovimentoInSospeso:
+        raise
+
+    except MovimentoRifiutato as e:
+        if e.motivo == "conto":
+            flash("Conto non trovato o non accessibile.", "error")
+            return redirect(url_for("pagina_privata"))
+        flash(f"Errore durante il pagamento: {str(e)}", "danger")
+        return redirect(url_for("effettua_pagamento"))
+
     except Exception as e:
-        db.rollback()
         traceback.print_exc()
         flash(f"Errore durante il pagamento: {str(e)}", "danger")
         return redirect(url_for("effettua_pagamento"))
-
-    finally:
-        db.close()
   
 
 @app.route('/richiesta_prestito', methods=['GET', 'POST'])
@@ -398,6 +584,7 @@ def logout():
 #---- Documentazione Swagger/Flasgger ----
 
 @app.route('/api/login', methods=['POST'])
+@budget_query(4)
 def api_login():
     """
     Login utente
@@ -431,6 +618,13 @@ def api_login():
             message:
               type: string
               example: Login OK
+            token:
+              type: string
+              description: Da inviare nell'intestazione Authorization come "Bearer <token>"
+            scadenza:
+              type: integer
+              description: Validità del token in secondi
+              example: 900
       401:
         description: Credenziali non valide
         schema:
@@ -439,8 +633,11 @@ def api_login():
             error:
               type: string
               example: Credenziali non valide
+      429:
+        description: Troppi tentativi per il codice titolare o per l'indirizzo del client (vedi Retry-After)
     """
     data = request.get_json(silent=True) or {}
+    controlla_tentativo(data.get("codice_titolare"), request.remote_addr)
     db = SessionLocal()
 
     try:
@@ -449,7 +646,15 @@ def api_login():
         ).first()
 
         if utente and utente.verifica_pin(data.get("pin")):
-            return jsonify({"message": "Login OK"}), 200
+            tentativo_riuscito(data.get("codice_titolare"), request.remote_addr)
+            db.commit() #salva l'eventuale hash ricalcolato con il nuovo costo
+            conti = [conto_id for (conto_id,) in db.query(Conto.id).filter_by(utente_id=utente.id)]
+            token = firma_token_api.dumps({"utente": utente.id, "conti": conti})
+            return jsonify({
+                "message": "Login OK",
+                "token": token,
+                "scadenza": DURATA_TOKEN_API
+            }), 200
 
         return jsonify({"error": "Credenziali non valide"}), 401
 
@@ -458,6 +663,7 @@ def api_login():
 
 
 @app.route('/api/registrazione', methods=['POST'])
+@budget_query(5)
 def api_registrazione():
     """
     Registrazione di un nuovo utente
@@ -532,10 +738,12 @@ def api_registrazione():
             return jsonify({"error": "I PIN non coincidono"}), 400
 
         # --- Verifica utente esistente ---
-        if db.query(Utente).filter_by(codice_fiscale=codice_fiscale).first():
+        if db.execute(Utente.query_codice_fiscale(codice_fiscale)).first():
             return jsonify({"error": "Utente già registrato"}), 400
 
-        # --- Creazione utente ---
+        # --- Creazione utente (hash del PIN prima delle sequenze, come in registrazione) ---
+        Utente.controlla_formato_pin(pin1)
+        pin_hash = calcola_hash(pin1)
         nuovo_utente = Utente(
             nome,
             cognome,
@@ -543,7 +751,7 @@ def api_registrazione():
             lavoro,
             db
         )
-        nuovo_utente.crea_pin(pin1)
+        nuovo_utente.pin_hash = pin_hash
         db.add(nuovo_utente)
         db.flush()  # assegna ID e codice_titolare
 
@@ -572,6 +780,10 @@ def api_registrazione():
 
         return jsonify(response), 201
 
+    except ServizioPinOccupato:
+        db.rollback()
+        raise
+
     except Exception as e:
         db.rollback()
         return jsonify({"error": str(e)}), 400
@@ -583,27 +795,30 @@ def api_registrazione():
 
 
 @app.route('/api/conti/<int:conto_id>/saldo', methods=['GET'])
+@budget_query(3)
+@api_token_required
 def api_saldo(conto_id):
     """
     Recupera il saldo corrente del conto
     ---
     tags:
       - Conti
+    security:
+      - Bearer: []
     parameters:
       - in: path
         name: conto_id
         type: integer
         required: true
         example: 3
-      - in: query
-        name: utente_id
-        type: integer
-        required: true
-        description: ID utente (simulazione autenticazione API)
-        example: 2
+      - in: header
+        name: If-None-Match
+        type: string
+        required: false
+        description: ETag ricevuto in precedenza; se il conto non è cambiato la risposta è 304
     responses:
       200:
-        description: Saldo corrente del conto
+        description: Saldo corrente del conto (con intestazione ETag)
         schema:
           type: object
           properties:
@@ -613,44 +828,47 @@ def api_saldo(conto_id):
             saldo_corrente:
               type: number
               example: 150
+      304:
+        description: Saldo invariato rispetto all'ETag indicato
       404:
         description: Conto non trovato
-      400:
-        description: Utente non specificato
+      401:
+        description: Token mancante, non valido o scaduto
+      403:
+        description: Conto non autorizzato per questo token
     """
-    db = SessionLocal()
-    try:
-        utente_id = request.args.get("utente_id", type=int)
-        if not utente_id:
-            return jsonify({"error": "Utente non specificato"}), 400
-
-        conto = db.query(Conto).filter_by(
-            id=conto_id,
-            utente_id=utente_id
-        ).first()
-
-        if not conto:
-            return jsonify({"error": "Conto non trovato"}), 404
+    conto = etag_conto(conto_id)
+    if conto is None:
+        return jsonify({"error": "Conto non trovato"}), 404
+    etag, versione = conto
+    invariato = non_modificato(etag)
+    if invariato:
+        return invariato
 
-        return jsonify({
-            "iban": conto.iban,
-            "saldo_corrente": float(conto.saldo_corrente)
-        }), 200
+    voce = voce_conto(conto_id, versione)
+    if voce is None or voce.utente_id != g.utente_id:
+        return jsonify({"error": "Conto non trovato"}), 404
 
-    finally:
-        db.close()
+    return con_etag(jsonify({
+        "iban": voce.iban,
+        "saldo_corrente": float(voce.saldo)
+    }), etag), 200
 
 
 
 
 
 @app.route('/api/conti/<int:conto_id>/transazioni', methods=['GET'])
+@budget_query(3)
+@api_token_required
 def api_transazioni(conto_id):
     """
     Recupera le transazioni di un conto
     ---
     tags:
       - Conti
+    security:
+      - Bearer: []
     parameters:
       - in: path
         name: conto_id
@@ -659,94 +877,237 @@ def api_transazioni(conto_id):
         description: ID del conto
         example: 3
       - in: query
-        name: utente_id
+        name: limite
         type: integer
-        required: true
-        description: ID utente (simulazione autenticazione API)
-        example: 2
+        required: false
+        description: Numero massimo di transazioni per pagina (max 100)
+        example: 20
+      - in: query
+        name: cursore
+        type: string
+        required: false
+        description: Valore next_cursor della pagina precedente
+        example: "20251212163747-17"
+      - in: header
+        name: If-None-Match
+        type: string
+        required: false
+        description: ETag ricevuto in precedenza; se il conto non è cambiato la risposta è 304
     responses:
       200:
-        description: Lista delle transazioni
+        description: Una pagina di transazioni, dalla più recente
         schema:
-          type: array
-          items:
-            type: object
-            properties:
-              id:
-                type: integer
-                example: 1
-              importo:
-                type: number
-                example: 100.50
-              tipo:
-                type: string
-                example: Bonifico
-              descrizione:
-                type: string
-                example: Pagamento fattura
-              data:
-                type: string
-                example: "2025-12-15T13:30:00"
-              conto_mittente_id:
-                type: integer
-                example: 1
-              conto_destinatario_id:
-                type: integer
-                example: 2
+          type: object
+          properties:
+            transazioni:
+              type: array
+              items:
+                type: object
+                properties:
+                  id:
+                    type: integer
+                    example: 1
+                  importo:
+                    type: number
+                    example: 100.50
+                  tipo:
+                    type: string
+                    example: Bonifico
+                  descrizione:
+                    type: string
+                    example: Pagamento fattura
+                  data:
+                    type: string
+                    example: "2025-12-15T13:30:00"
+                  uscita:
+                    type: boolean
+                    description: true se il conto è il mittente del movimento
+                    example: true
+                  conto_mittente_id:
+                    type: integer
+                    example: 1
+                  conto_destinatario_id:
+                    type: integer
+                    example: 2
+            next_cursor:
+              type: string
+              description: Cursore della pagina successiva, null se non ci sono altre transazioni
+              example: "20251212163747-17"
+      304:
+        description: Nessun nuovo movimento rispetto all'ETag indicato
       400:
-        description: Utente non specificato
+        description: Cursore non valido
+      401:
+        description: Token mancante, non valido o scaduto
+      403:
+        description: Conto non autorizzato per questo token
       404:
         description: Conto non trovato
     """
+    cursore = request.args.get("cursore")
+    limite = request.args.get("limite", PAGINA_TRANSAZIONI, type=int)
+    conto = etag_conto(conto_id, limite, cursore or "")
+    if conto is None:
+        return jsonify({"error": "Conto non trovato"}), 404
+    etag, versione = conto
+    invariato = non_modificato(etag)
+    if invariato:
+        return invariato
+
     db = SessionLocal()
     try:
-        utente_id = request.args.get("utente_id", type=int)
-        if not utente_id:
-            return jsonify({"error": "Utente non specificato"}), 400
-
-        conto = db.query(Conto).filter_by(
-            id=conto_id,
-            utente_id=utente_id
-        ).first()
-
-        if not conto:
-            return jsonify({"error": "Conto non trovato"}), 404
-
-        transazioni = (
-            db.query(Transazione)
-            .filter(
-                (Transazione.conto_mittente_id == conto.id) |
-                (Transazione.conto_destinatario_id == conto.id)
-            )
-            .order_by(Transazione.data.desc())
-            .all()
-        )
+        if cursore or limite != PAGINA_TRANSAZIONI:
+            transazioni, prossimo_cursore = pagina_transazioni(db, conto_id, cursore, limite)
+        else:
+            #prima pagina dalla cache dei conti, ricaricata se più vecchia della versione dell'ETag
+            voce = voce_conto(conto_id, versione)
+            transazioni, prossimo_cursore = voce.transazioni, voce.prossimo_cursore
+    except ValueError:
+        return jsonify({"error": "Cursore non valido"}), 400
+    finally:
+        db.close()
 
-        return jsonify([
+    return con_etag(jsonify({
+        "transazioni": [
             {
                 "id": t.id,
                 "importo": float(t.importo),
                 "tipo": t.tipo.value,
                 "descrizione": t.descrizione,
                 "data": t.data.isoformat(),
+                "uscita": uscita,
                 "conto_mittente_id": t.conto_mittente_id,
                 "conto_destinatario_id": t.conto_destinatario_id
             }
-            for t in transazioni
-        ]), 200
+            for t, uscita in transazioni
+        ],
+        "next_cursor": prossimo_cursore
+    }), etag), 200
 
+
+
+@app.route('/api/conti/<int:conto_id>/estratto', methods=['GET'])
+@api_token_required
+def api_estratto(conto_id):
+    """
+    Estratto conto completo in streaming (NDJSON o CSV)
+    ---
+    tags:
+      - Conti
+    security:
+      - Bearer: []
+    produces:
+      - application/x-ndjson
+      - text/csv
+    parameters:
+      - in: path
+        name: conto_id
+        type: integer
+        required: true
+        description: ID del conto
+        example: 3
+      - in: query
+        name: formato
+        type: string
+        enum: [ndjson, csv]
+        required: false
+        description: Formato dell'estratto (predefinito ndjson)
+        example: csv
+      - in: query
+        name: dal
+        type: string
+        required: false
+        description: Data iniziale inclusa (AAAA-MM-GG)
+        example: "2025-01-01"
+      - in: query
+        name: al
+        type: string
+        required: false
+        description: Data finale inclusa (AAAA-MM-GG)
+        example: "2025-12-31"
+    responses:
+      200:
+        description: Movimenti in ordine cronologico, una riga per movimento
+      400:
+        description: Formato o date non validi
+      401:
+        description: Token mancante, non valido o scaduto
+      403:
+        description: Conto non autorizzato per questo token
+      404:
+        description: Conto non trovato
+    """
+    formato = request.args.get("formato", "ndjson")
+    if formato not in ("ndjson", "csv"):
+        return jsonify({"error": "Formato non valido"}), 400
+
+    try:
+        dal = request.args.get("dal")
+        al = request.args.get("al")
+        dal = datetime.strptime(dal, "%Y-%m-%d") if dal else None
+        al = datetime.strptime(al, "%Y-%m-%d") + timedelta(days=1) if al else None
+    except ValueError:
+        return jsonify({"error": "Date non valide, usare AAAA-MM-GG"}), 400
+
+    db = SessionLocal()
+    try:
+        conto = db.query(Conto).filter_by(id=conto_id, utente_id=g.utente_id).first()
+        if not conto:
+            return jsonify({"error": "Conto non trovato"}), 404
+        iban = conto.iban
     finally:
         db.close()
 
+    def genera_righe():
+        #movimenti_estratto legge a blocchi con sessioni brevi: nessuna transazione resta aperta tra un blocco e l'altro
+        if formato == "csv":
+            buffer = io.StringIO()
+            scrittore = csv.writer(buffer)
+            scrittore.writerow(["id", "data", "entrata_uscita", "importo", "tipo", "descrizione",
+                                "conto_mittente_id", "conto_destinatario_id"])
+        for t, uscita in movimenti_estratto(conto_id, dal, al):
+            if formato == "csv":
+                scrittore.writerow([t.id, t.data.isoformat(), "Uscita" if uscita else "Entrata",
+                                    f"{t.importo:.2f}", t.tipo.value, t.descrizione or "",
+                                    t.conto_mittente_id, t.conto_destinatario_id])
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            else:
+                yield json.dumps({
+                    "id": t.id,
+                    "importo": float(t.importo),
+                    "tipo": t.tipo.value,
+                    "descrizione": t.descrizione,
+                    "data": t.data.isoformat(),
+                    "uscita": uscita,
+                    "conto_mittente_id": t.conto_mittente_id,
+                    "conto_destinatario_id": t.conto_destinatario_id
+                }) + "\n"
+        if formato == "csv" and buffer.tell():
+            yield buffer.getvalue()
+
+    if formato == "csv":
+        risposta = Response(stream_with_context(genera_righe()), mimetype="text/csv")
+        risposta.headers["Content-Disposition"] = f"attachment; filename=estratto_{iban}.csv"
+    else:
+        risposta = Response(stream_with_context(genera_righe()), mimetype="application/x-ndjson")
+    return risposta
+
 
 
 @app.route('/api/conti/<int:conto_id>/bonifico', methods=['POST'])
+@budget_query(7) #5 + prenotazione ed esito della chiave di idempotenza
+@api_token_required
+@idempotente
 def api_bonifico(conto_id):
     """
     Effettua un bonifico da un conto a un altro
     ---
     tags:
       - Transazioni
+    security:
+      - Bearer: []
     consumes:
       - application/json
     parameters:
@@ -756,19 +1117,21 @@ def api_bonifico(conto_id):
         required: true
         description: ID del conto mittente
         example: 1
+      - in: header
+        name: Idempotency-Key
+        type: string
+        required: false
+        description: Chiave scelta dal client (max 64 caratteri). Ripetendo la richiesta con la stessa chiave si riceve lo stesso esito, senza un secondo bonifico
+        example: 3f2b9c1e-bonifico-affitto-2025-12
       - in: body
         name: bonifico
         required: true
         schema:
           type: object
           required:
-            - utente_id
             - iban_destinatario
             - importo
           properties:
-            utente_id:
-              type: integer
-              example: 1
             iban_destinatario:
               type: string
               example: IT123456165276
@@ -810,26 +1173,33 @@ def api_bonifico(conto_id):
               example: 2
       400:
         description: Errore input o saldo insufficiente
+      401:
+        description: Token mancante, non valido o scaduto
+      403:
+        description: Conto non autorizzato per questo token
       404:
         description: Conto mittente o destinatario non trovato
+      409:
+        description: Richiesta con la stessa Idempotency-Key ancora in corso
+      422:
+        description: Idempotency-Key già usata con dati diversi
     """
     data = request.get_json()
     db = SessionLocal()
 
     try:
         # --- Validazione input ---
-        utente_id = data.get("utente_id")
         iban_destinatario = data.get("iban_destinatario", "").strip()
         importo = data.get("importo")
         descrizione = data.get("descrizione", "")
 
-        if not all([utente_id, iban_destinatario, importo]):
+        if not all([iban_destinatario, importo]):
             return jsonify({"error": "Dati mancanti"}), 400
 
         # --- Conto mittente ---
         conto_mittente = db.query(Conto).filter_by(
             id=conto_id,
-            utente_id=utente_id
+            utente_id=g.utente_id
         ).first()
         if not conto_mittente:
             return jsonify({"error": "Conto mittente non trovato"}), 404
@@ -881,4 +1251,278 @@ def api_bonifico(conto_id):
 
 
 
+BONIFICI_MAX = 1000 #bonifici per singola richiesta a /bonifici
+
+
+@app.route('/api/conti/<int:conto_id>/bonifici', methods=['POST'])
+@budget_query(4) #qualsiasi numero di bonifici: BEGIN, lettura dei conti, un INSERT, un UPDATE per conto in executemany
+@api_token_required
+def api_bonifici(conto_id):
+    """
+    Effettua più bonifici dallo stesso conto in un'unica transazione
+    ---
+    tags:
+      - Transazioni
+    security:
+      - Bearer: []
+    consumes:
+      - application/json
+    parameters:
+      - in: path
+        name: conto_id
+        type: integer
+        required: true
+        description: ID del conto mittente
+        example: 1
+      - in: body
+        name: bonifici
+        required: true
+        schema:
+          type: object
+          required:
+            - bonifici
+          properties:
+            modalita:
+              type: string
+              enum: [tutto_o_niente, migliore_sforzo]
+              description: tutto_o_niente annulla tutto se un bonifico viene rifiutato; migliore_sforzo esegue quelli possibili
+              example: tutto_o_niente
+            bonifici:
+              type: array
+              description: Al massimo 1000 bonifici, eseguiti nell'ordine indicato
+              items:
+                type: object
+                required:
+                  - iban_destinatario
+                  - importo
+                properties:
+                  iban_destinatario:
+                    type: string
+                    example: IT123456165276
+                  importo:
+                    type: number
+                    example: 50.00
+                  descrizione:
+                    type: string
+                    example: Stipendio dicembre
+    responses:
+      200:
+        description: Esito di ogni bonifico (con migliore_sforzo alcuni possono essere rifiutati)
+        schema:
+          type: object
+          properties:
+            eseguiti:
+              type: integer
+              example: 2
+            rifiutati:
+              type: integer
+              example: 0
+            risultati:
+              type: array
+              items:
+                type: object
+                properties:
+                  indice:
+                    type: integer
+                    example: 0
+                  esito:
+                    type: string
+                    enum: [eseguito, rifiutato]
+                  transazione_id:
+                    type: integer
+                    example: 10
+                  errore:
+                    type: string
+                    example: IBAN destinatario non valido.
+      400:
+        description: Richiesta non valida, oppure gruppo tutto_o_niente annullato (con il dettaglio per bonifico)
+      401:
+        description: Token mancante, non valido o scaduto
+      403:
+        description: Conto non autorizzato per questo token
+    """
+    data = request.get_json(silent=True) or {}
+    modalita = data.get("modalita", "tutto_o_niente")
+    bonifici = data.get("bonifici")
+
+    if modalita not in ("tutto_o_niente", "migliore_sforzo"):
+        return jsonify({"error": "Modalità non valida"}), 400
+    if not isinstance(bonifici, list) or not bonifici:
+        return jsonify({"error": "Nessun bonifico indicato"}), 400
+    if len(bonifici) > BONIFICI_MAX:
+        return jsonify({"error": f"Al massimo {BONIFICI_MAX} bonifici per richiesta"}), 400
+
+    # --- Validazione input per singolo bonifico ---
+    richieste = []
+    esiti = [None] * len(bonifici)
+    for i, b in enumerate(bonifici):
+        try:
+            iban_destinatario = str(b.get("iban_destinatario", "")).strip()
+            if not iban_destinatario or b.get("importo") is None:
+                raise ValueError("Dati mancanti")
+            importo = Decimal(str(b["importo"]))
+            if not importo.is_finite():
+                raise ValueError("Importo non valido")
+            richieste.append((i, Richiesta(
+                TipoTransazione.BONIFICO,
+                g.utente_id,
+                conto_id,
+                importo,
+                b.get("descrizione", ""),
+                iban_destinatario
+            )))
+        except (AttributeError, ArithmeticError, ValueError):
+            esiti[i] = {"indice": i, "esito": "rifiutato", "errore": "Dati mancanti o importo non valido"}
+
+    if modalita == "tutto_o_niente" and len(richieste) < len(bonifici):
+        return jsonify({"error": "Bonifici non validi, nessuno è stato eseguito",
+                        "risultati": [e for e in esiti if e]}), 400
+
+    # --- Un'unica transazione: IBAN risolti con una query, saldo controllato una volta, insert in blocco ---
+    db = SessionLocal.session_factory()
+    try:
+        applicati = applica_blocco(db, [r for _, r in richieste], tutto_o_niente=(modalita == "tutto_o_niente"))
+    except Exception as e:
+        db.rollback()
+        print("ERRORE BONIFICI:", e)
+        return jsonify({"error": "Errore durante i bonifici"}), 400
+    finally:
+        db.close()
+
+    for (i, _), (_, esito) in zip(richieste, applicati):
+        if isinstance(esito, Exception):
+            esiti[i] = {"indice": i, "esito": "rifiutato", "errore": str(esito)}
+        else:
+            esiti[i] = {"indice": i, "esito": "eseguito", "transazione_id": esito["id"]}
+
+    eseguiti = sum(1 for e in esiti if e["esito"] == "eseguito")
+    risposta = {"eseguiti": eseguiti, "rifiutati": len(esiti) - eseguiti, "risultati": esiti}
+    if modalita == "tutto_o_niente" and eseguiti < len(esiti):
+        risposta["error"] = "Bonifici non eseguiti: almeno uno è stato rifiutato"
+        return jsonify(risposta), 400
+    return jsonify(risposta), 200
+
+
 
+def risposta_eventi(conto_id, ultimo_id):
+    if ultimo_id is None:
+        #nuovo client: solo i movimenti da adesso in poi. Il punto di partenza si legge prima di iscriversi,
+        #altrimenti un movimento committato tra l'iscrizione e la lettura finirebbe sotto ultimo_id e verrebbe scartato
+        ultimo_id = ultimo_movimento_id()
+    #mi iscrivo prima di aprire il flusso, così un processo già pieno risponde 503
+    try:
+        iscrizione = bacheca.iscrivi(conto_id)
+    except TroppiIscritti as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "30"}
+    risposta = Response(
+        stream_with_context(flusso_eventi(iscrizione, ultimo_id)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"} #niente buffer nei proxy
+    )
+    #se il client chiude prima del primo evento il generatore non parte: la disiscrizione va fatta qui
+    risposta.call_on_close(lambda: bacheca.disiscrivi(iscrizione))
+    return risposta
+
+
+@app.route('/api/conti/<int:conto_id>/eventi', methods=['GET'])
+@api_token_required
+def api_eventi(conto_id):
+    """
+    Flusso Server-Sent Events dei nuovi movimenti del conto
+    ---
+    tags:
+      - Transazioni
+    security:
+      - Bearer: []
+    produces:
+      - text/event-stream
+    parameters:
+      - in: path
+        name: conto_id
+        type: integer
+        required: true
+        example: 3
+      - in: header
+        name: Last-Event-ID
+        type: integer
+        required: false
+        description: id dell'ultimo evento ricevuto; alla riconnessione vengono inviati prima i movimenti persi
+    responses:
+      200:
+        description: Un evento "movimento" per ogni transazione committata (stessi campi di /transazioni), con id = id della transazione
+      400:
+        description: Last-Event-ID non valido
+      401:
+        description: Token mancante, non valido o scaduto
+      403:
+        description: Conto non autorizzato per questo token
+      404:
+        description: Conto non trovato
+      503:
+        description: Troppi flussi aperti, riprovare più tardi
+    """
+    ultimo_id = request.headers.get("Last-Event-ID", type=int)
+    if ultimo_id is None and request.headers.get("Last-Event-ID"):
+        return jsonify({"error": "Last-Event-ID non valido"}), 400
+
+    conto = versione_conto(conto_id)
+    if conto is None or conto[0] != g.utente_id:
+        return jsonify({"error": "Conto non trovato"}), 404
+    return risposta_eventi(conto_id, ultimo_id)
+
+
+@app.route('/api/diagnostica/cache', methods=['GET'])
+def api_diagnostica_cache():
+    """
+    Contatori della cache dei conti (saldo e ultimi movimenti)
+    ---
+    tags:
+      - Diagnostica
+    responses:
+      200:
+        description: Colpi, mancati, espulsioni e occupazione della cache
+        schema:
+          type: object
+          properties:
+            voci:
+              type: integer
+              example: 120
+            byte:
+              type: integer
+              example: 950000
+            limite_byte:
+              type: integer
+              example: 8388608
+            colpi:
+              type: integer
+              example: 4200
+            mancati:
+              type: integer
+              example: 310
+            espulsioni:
+              type: integer
+              example: 0
+            invalidazioni:
+              type: integer
+              example: 95
+            percentuale_colpi:
+              type: number
+              example: 93.1
+    """
+    return jsonify(cache_conti.statistiche()), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metriche():
+    """
+    Metriche per rotta in formato Prometheus
+    ---
+    tags:
+      - Diagnostica
+    produces:
+      - text/plain
+    responses:
+      200:
+        description: Istogramma delle latenze, istruzioni, tempo e righe SQL, tempo di bcrypt e dei template
+    """
+    return Response(registro_metriche.testo_prometheus(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,448 @@
+#app_async.py è la variante ASGI delle API JSON di app.py (login, registrazione, saldo, transazioni, bonifico, eventi):
+#stesse risposte, stessi token e stessa documentazione Swagger, ma su un motore SQLAlchemy asincrono
+#(aiosqlite in locale) e con bcrypt nel pool di hash_pin senza bloccare il loop.
+#Richiede starlette, aiosqlite e un server ASGI, ad esempio:
+#  uvicorn app_async:app --port 5001
+#Le pagine HTML restano su app.py: i token ottenuti da una delle due app valgono anche sull'altra.
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+from decimal import Decimal
+from itsdangerous import BadSignature, SignatureExpired
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from starlette.schemas import SchemaGenerator
+
+#importare app.py crea le tabelle, applica le migrazioni e avvia il pool di bcrypt (prima del loop, per il fork)
+from app import DURATA_TOKEN_API, app as app_flask, firma_token_api
+from database import crea_engine_async
+from eventi import TroppiIscritti, bacheca, flusso_eventi_async
+from hash_pin import ServizioPinOccupato, calcola_hash_async, controlla_pin_async, da_aggiornare
+from idempotenza import LUNGHEZZA_MAX, ChiaveNonUtilizzabile, impronta, registro, serializza_esito
+from limiti_accesso import TroppiTentativi, controlla_tentativo, tentativo_riuscito
+from models import Conto, TipoTransazione, Transazione, Utente
+from storico import PAGINA_TRANSAZIONI, pagina_transazioni
+
+OSSERVAZIONE_MOVIMENTI = float(os.environ.get("BANCA_SSE_OSSERVAZIONE", "1")) #secondi tra due letture dei nuovi movimenti
+
+engine_async = crea_engine_async()
+SessionAsync = async_sessionmaker(engine_async, expire_on_commit=False)
+
+schema = SchemaGenerator({
+    "swagger": "2.0",
+    "info": {"title": "API Banca (ASGI)", "version": "0.0.1"},
+    "securityDefinitions": {
+        "Bearer": {
+            "type": "apiKey",
+            "name": "Authorization",
+            "in": "header",
+            "description": "Token restituito da /api/login, nel formato: Bearer <token>"
+        }
+    },
+})
+
+
+def stessa_documentazione(nome_vista):
+    #riuso la docstring Swagger della vista Flask, così le due app documentano lo stesso contratto
+    def decoratore(funzione):
+        funzione.__doc__ = app_flask.view_functions[nome_vista].__doc__
+        return funzione
+    return decoratore
+
+
+def autorizza(request, conto_id):
+    """Restituisce (utente_id, None) se il token è valido per il conto, altrimenti (None, risposta d'errore)."""
+    intestazione = request.headers.get("Authorization", "")
+    if not intestazione.startswith("Bearer "):
+        return None, JSONResponse({"error": "Token mancante"}, status_code=401)
+    try:
+        dati = firma_token_api.loads(intestazione[len("Bearer "):], max_age=DURATA_TOKEN_API)
+    except (SignatureExpired, BadSignature):
+        return None, JSONResponse({"error": "Token non valido o scaduto"}, status_code=401)
+    if conto_id not in dati["conti"]:
+        return None, JSONResponse({"error": "Conto non autorizzato"}, status_code=403)
+    return dati["utente"], None
+
+
+async def leggi_json(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+@stessa_documentazione("api_login")
+async def api_login(request):
+    data = await leggi_json(request)
+    pin = data.get("pin")
+    #stessi secchielli di app.py (in memoria non bloccano il loop; con BANCA_LIMITI_DB è un breve accesso a SQLite)
+    indirizzo = request.client.host if request.client else None
+    controlla_tentativo(data.get("codice_titolare"), indirizzo)
+    async with SessionAsync() as db:
+        utente = (await db.execute(
+            select(Utente).where(Utente.codice_titolare == data.get("codice_titolare"))
+        )).scalar_one_or_none()
+
+        if not utente or not pin or not await controlla_pin_async(pin, utente.pin_hash):
+            return JSONResponse({"error": "Credenziali non valide"}, status_code=401)
+        tentativo_riuscito(data.get("codice_titolare"), indirizzo)
+
+        if da_aggiornare(utente.pin_hash):
+            utente.pin_hash = await calcola_hash_async(pin)
+            await db.commit()
+        conti = list((await db.execute(select(Conto.id).where(Conto.utente_id == utente.id))).scalars())
+
+    token = firma_token_api.dumps({"utente": utente.id, "conti": conti})
+    return JSONResponse({"message": "Login OK", "token": token, "scadenza": DURATA_TOKEN_API})
+
+
+@stessa_documentazione("api_registrazione")
+async def api_registrazione(request):
+    data = await leggi_json(request)
+    nome = data.get("nome")
+    cognome = data.get("cognome")
+    codice_fiscale = data.get("codice_fiscale")
+    lavoro = data.get("lavoro")
+    pin1 = data.get("pin1")
+    pin2 = data.get("pin2")
+
+    # --- Controllo campi ---
+    if not all([nome, cognome, codice_fiscale, lavoro, pin1, pin2]):
+        return JSONResponse({"error": "Tutti i campi sono obbligatori"}, status_code=400)
+
+    if pin1 != pin2:
+        return JSONResponse({"error": "I PIN non coincidono"}, status_code=400)
+
+    async with SessionAsync() as db:
+        try:
+            # --- Verifica utente esistente ---
+            if (await db.execute(Utente.query_codice_fiscale(codice_fiscale))).first():
+                return JSONResponse({"error": "Utente già registrato"}, status_code=400)
+
+            #bcrypt prima di toccare le sequenze: il lavoro pesante non tiene aperta la transazione
+            Utente.controlla_formato_pin(pin1)
+            pin_hash = await calcola_hash_async(pin1)
+
+            def crea(sessione):
+                #i costruttori dei modelli usano la sessione sincrona (sequenze); run_sync la fornisce sul motore async
+                nuovo_utente = Utente(nome, cognome, codice_fiscale, lavoro, sessione)
+                nuovo_utente.pin_hash = pin_hash
+                sessione.add(nuovo_utente)
+                sessione.flush()
+
+                nuovo_conto = Conto(nuovo_utente.id, sessione)
+                sessione.add(nuovo_conto)
+                sessione.flush()
+
+                sessione.add(Transazione(
+                    importo=Decimal("100.00"),
+                    descrizione="Bonus benvenuto nuovo conto",
+                    tipo=TipoTransazione.BONUS,
+                    conto_destinatario_id=nuovo_conto.id
+                ))
+                sessione.flush()
+                return nuovo_utente.codice_titolare
+
+            codice_titolare = await db.run_sync(crea)
+
+            # --- Simulazione: non persistiamo realmente (come app.py) ---
+            await db.rollback()
+            return JSONResponse(
+                {"message": "Registrazione completata", "codice_titolare": codice_titolare},
+                status_code=201
+            )
+
+        except ServizioPinOccupato:
+            await db.rollback()
+            raise
+
+        except Exception as e:
+            await db.rollback()
+            return JSONResponse({"error": str(e)}, status_code=400)
+
+
+@stessa_documentazione("api_saldo")
+async def api_saldo(request):
+    conto_id = request.path_params["conto_id"]
+    utente_id, errore = autorizza(request, conto_id)
+    if errore:
+        return errore
+
+    async with SessionAsync() as db:
+        conto = (await db.execute(
+            select(Conto.utente_id, Conto.iban, Conto.saldo, Conto.versione).where(Conto.id == conto_id)
+        )).first()
+    if conto is None or conto.utente_id != utente_id:
+        return JSONResponse({"error": "Conto non trovato"}, status_code=404)
+
+    #stesso ETag di app.py
+    etag = f'"{conto_id}-{conto.versione}"'
+    intestazioni = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in request.headers.get("If-None-Match", ""):
+        return Response(status_code=304, headers=intestazioni)
+    return JSONResponse(
+        {"iban": conto.iban, "saldo_corrente": float(conto.saldo or 0)},
+        headers=intestazioni
+    )
+
+
+@stessa_documentazione("api_transazioni")
+async def api_transazioni(request):
+    conto_id = request.path_params["conto_id"]
+    utente_id, errore = autorizza(request, conto_id)
+    if errore:
+        return errore
+
+    cursore = request.query_params.get("cursore")
+    try:
+        limite = int(request.query_params.get("limite", PAGINA_TRANSAZIONI))
+    except ValueError:
+        limite = PAGINA_TRANSAZIONI
+
+    async with SessionAsync() as db:
+        conto = (await db.execute(
+            select(Conto.utente_id, Conto.versione).where(Conto.id == conto_id)
+        )).first()
+        if conto is None or conto.utente_id != utente_id:
+            return JSONResponse({"error": "Conto non trovato"}, status_code=404)
+
+        etag = f'"{conto_id}-{conto.versione}-{limite}-{cursore or ""}"'
+        intestazioni = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if etag in request.headers.get("If-None-Match", ""):
+            return Response(status_code=304, headers=intestazioni)
+
+        try:
+            transazioni, prossimo_cursore = await db.run_sync(pagina_transazioni, conto_id, cursore, limite)
+        except ValueError:
+            return JSONResponse({"error": "Cursore non valido"}, status_code=400)
+
+        return JSONResponse({
+            "transazioni": [
+                {
+                    "id": t.id,
+                    "importo": float(t.importo),
+                    "tipo": t.tipo.value,
+                    "descrizione": t.descrizione,
+                    "data": t.data.isoformat(),
+                    "uscita": uscita,
+                    "conto_mittente_id": t.conto_mittente_id,
+                    "conto_destinatario_id": t.conto_destinatario_id
+                }
+                for t, uscita in transazioni
+            ],
+            "next_cursor": prossimo_cursore
+        }, headers=intestazioni)
+
+
+@stessa_documentazione("api_bonifico")
+async def api_bonifico(request):
+    conto_id = request.path_params["conto_id"]
+    utente_id, errore = autorizza(request, conto_id)
+    if errore:
+        return errore
+
+    chiave = request.headers.get("Idempotency-Key")
+    if not chiave:
+        return await esegui_bonifico(conto_id, utente_id, await leggi_json(request))
+    if len(chiave) > LUNGHEZZA_MAX:
+        raise ChiaveNonUtilizzabile(f"Chiave di idempotenza oltre {LUNGHEZZA_MAX} caratteri.", 400)
+
+    #stessa impronta della vista Flask: una chiave vale per entrambe le app (la tabella delle chiavi è la stessa)
+    try:
+        dati = await request.json()
+    except ValueError:
+        dati = None
+    impronta_richiesta = impronta("api_bonifico", {"conto_id": conto_id}, [], dati)
+    #il registro usa il motore sincrono: le sue letture e scritture vanno nel pool di thread
+    proprietario, concluso, _ = await run_in_threadpool(registro.prenota, utente_id, chiave, impronta_richiesta)
+    if concluso is not None:
+        stato, esito = concluso
+        esito = json.loads(esito)
+        return Response(esito["corpo"], status_code=stato, media_type=esito["tipo"],
+                        headers={"Idempotent-Replayed": "true"})
+
+    try:
+        risposta = await esegui_bonifico(conto_id, utente_id, dati if isinstance(dati, dict) else {})
+    except Exception:
+        await run_in_threadpool(registro.annulla, utente_id, chiave, proprietario)
+        raise
+    if risposta.status_code >= 500:
+        await run_in_threadpool(registro.annulla, utente_id, chiave, proprietario)
+    else:
+        esito = serializza_esito(risposta.body.decode(), risposta.media_type)
+        await run_in_threadpool(registro.completa, utente_id, chiave, proprietario, impronta_richiesta,
+                                risposta.status_code, esito)
+    return risposta
+
+
+async def esegui_bonifico(conto_id, utente_id, data):
+    # --- Validazione input ---
+    iban_destinatario = str(data.get("iban_destinatario", "")).strip()
+    importo = data.get("importo")
+    descrizione = data.get("descrizione", "")
+
+    if not all([iban_destinatario, importo]):
+        return JSONResponse({"error": "Dati mancanti"}, status_code=400)
+
+    async with SessionAsync() as db:
+        try:
+            # --- Conto mittente ---
+            conto_mittente = (await db.execute(
+                select(Conto).where(Conto.id == conto_id, Conto.utente_id == utente_id)
+            )).scalar_one_or_none()
+            if not conto_mittente:
+                return JSONResponse({"error": "Conto mittente non trovato"}, status_code=404)
+
+            # --- Conto destinatario ---
+            conto_destinatario = (await db.execute(
+                select(Conto).where(Conto.iban == iban_destinatario)
+            )).scalar_one_or_none()
+            if not conto_destinatario:
+                return JSONResponse({"error": "IBAN destinatario non valido"}, status_code=404)
+
+            # --- Creazione bonifico (metodi del modello, nella sessione sincrona di run_sync) ---
+            def crea(sessione):
+                trans = conto_mittente.bonifico(conto_destinatario, Decimal(str(importo)), descrizione)
+                sessione.add(trans)
+                sessione.flush()
+                return {
+                    "message": "Bonifico effettuato con successo",
+                    "transazione_id": trans.id,
+                    "transazione_importo": float(trans.importo),
+                    "transazione_tipo": trans.tipo.value,
+                    "transazione_descrizione": trans.descrizione,
+                    "transazione_data": trans.data.isoformat(),
+                    "transazione_conto_mittente_id": trans.conto_mittente_id,
+                    "transazione_conto_destinatario_id": trans.conto_destinatario_id
+                }
+
+            risposta = await db.run_sync(crea)
+
+            # --- Simulazione: non persistiamo realmente (come app.py) ---
+            await db.rollback()
+            return JSONResponse(risposta)
+
+        except ValueError as e:
+            await db.rollback()
+            return JSONResponse({"error": str(e)}, status_code=400)
+
+        except Exception:
+            await db.rollback()
+            return JSONResponse({"error": "Errore durante il bonifico"}, status_code=400)
+
+
+@stessa_documentazione("api_eventi")
+async def api_eventi(request):
+    conto_id = request.path_params["conto_id"]
+    utente_id, errore = autorizza(request, conto_id)
+    if errore:
+        return errore
+
+    intestazione = request.headers.get("Last-Event-ID")
+    try:
+        ultimo_id = int(intestazione) if intestazione else None
+    except ValueError:
+        return JSONResponse({"error": "Last-Event-ID non valido"}, status_code=400)
+
+    async with SessionAsync() as db:
+        proprietario = (await db.execute(select(Conto.utente_id).where(Conto.id == conto_id))).scalar_one_or_none()
+        if proprietario == utente_id and ultimo_id is None:
+            #nuovo client: punto di partenza letto prima di iscriversi (vedi risposta_eventi in app.py)
+            ultimo_id = (await db.execute(select(func.max(Transazione.id)))).scalar() or 0
+    if proprietario is None or proprietario != utente_id:
+        return JSONResponse({"error": "Conto non trovato"}, status_code=404)
+
+    try:
+        iscrizione = bacheca.iscrivi(conto_id, asyncio.get_running_loop())
+    except TroppiIscritti as e:
+        return JSONResponse({"error": str(e)}, status_code=503, headers={"Retry-After": "30"})
+    #alla disconnessione del client Starlette chiude il generatore, che disiscrive nel proprio finally
+    return StreamingResponse(
+        flusso_eventi_async(iscrizione, ultimo_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def osserva_movimenti():
+    #i movimenti vengono scritti da altri processi (app.py, stipendi.py), quindi qui non arrivano dagli eventi di
+    #sessione: li rileggo per id crescente e li pubblico sulla bacheca di questo processo.
+    #Su SQLite gli id vengono assegnati e committati in ordine (un solo scrittore); su un server DB due transazioni
+    #possono committare in ordine inverso e un movimento con id più basso committato dopo la lettura andrebbe perso
+    colonne = (Transazione.id, Transazione.data, Transazione.importo, Transazione.tipo, Transazione.descrizione,
+               Transazione.conto_mittente_id, Transazione.conto_destinatario_id)
+    ultimo = None
+    while True:
+        try:
+            async with engine_async.connect() as conn:
+                if ultimo is not None and bacheca.iscritti():
+                    while True:
+                        righe = (await conn.execute(
+                            select(*colonne).where(Transazione.id > ultimo).order_by(Transazione.id).limit(1000)
+                        )).all()
+                        for riga in righe:
+                            bacheca.pubblica_movimento(*riga)
+                            ultimo = riga.id
+                        if len(righe) < 1000:
+                            break
+                else:
+                    #nessuno in ascolto: avanzo senza leggere i movimenti. Gli iscritti si ricontrollano dopo la
+                    #lettura, così chi si iscrive nel frattempo non perde i movimenti tra il suo id e questo
+                    massimo = (await conn.execute(select(func.max(Transazione.id)))).scalar() or 0
+                    if ultimo is None or not bacheca.iscritti():
+                        ultimo = massimo
+        except Exception as e:
+            print("❌ ERRORE osservazione movimenti:", e)
+        await asyncio.sleep(OSSERVAZIONE_MOVIMENTI)
+
+
+async def apispec(request):
+    #stesso percorso e formato JSON della specifica di flasgger
+    return JSONResponse(schema.get_schema(routes=request.app.routes))
+
+
+async def servizio_pin_occupato(request, e):
+    #pool di bcrypt saturo: come in app.py rispondo subito 503
+    return JSONResponse({"error": str(e)}, status_code=503, headers={"Retry-After": "1"})
+
+
+async def troppi_tentativi(request, e):
+    return JSONResponse({"error": str(e)}, status_code=429, headers={"Retry-After": str(e.attesa)})
+
+
+async def chiave_non_utilizzabile(request, e):
+    #Idempotency-Key non valida, in corso o riusata con altri dati: come in app.py la richiesta non viene eseguita
+    return JSONResponse({"error": str(e)}, status_code=e.stato)
+
+
+@asynccontextmanager
+async def ciclo_di_vita(app):
+    osservatore = asyncio.create_task(osserva_movimenti())
+    yield
+    osservatore.cancel()
+    await engine_async.dispose()
+
+
+app = Starlette(
+    routes=[
+        Route("/api/login", api_login, methods=["POST"]),
+        Route("/api/registrazione", api_registrazione, methods=["POST"]),
+        Route("/api/conti/{conto_id:int}/saldo", api_saldo, methods=["GET"]),
+        Route("/api/conti/{conto_id:int}/transazioni", api_transazioni, methods=["GET"]),
+        Route("/api/conti/{conto_id:int}/bonifico", api_bonifico, methods=["POST"]),
+        Route("/api/conti/{conto_id:int}/eventi", api_eventi, methods=["GET"]),
+        Route("/apispec_1.json", apispec, include_in_schema=False),
+    ],
+    exception_handlers={
+        ServizioPinOccupato: servizio_pin_occupato,
+        TroppiTentativi: troppi_tentativi,
+        ChiaveNonUtilizzabile: chiave_non_utilizzabile,
+    },
+    lifespan=ciclo_di_vita,
+)
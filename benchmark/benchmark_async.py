@@ -0,0 +1,136 @@
+#Prova di carico delle API: viste Flask di app.py (server WSGI a thread) contro app_async.py (ASGI su uvicorn).
+#Entrambe le app girano in un processo separato sullo stesso database SQLite temporaneo; il carico arriva da
+#molti client concorrenti (httpx asincrono) su saldo e transazioni. Riporta richieste/s, p50 e p99.
+#Richiede starlette, aiosqlite, uvicorn e httpx. Uso, dalla cartella del progetto:
+#  python -m benchmark.benchmark_async [--concorrenza 200] [--secondi 10] [--movimenti 500]
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+#i processi server ricevono l'URL del database temporaneo dal processo principale
+if "BANCA_BENCH_SERVER" not in os.environ:
+    _cartella = tempfile.TemporaryDirectory()
+    os.environ["BANCA_DATABASE_URL"] = f"sqlite:///{os.path.join(_cartella.name, 'bench.db')}"
+    os.environ.setdefault("BANCA_DB_PROFILO", "sqlite")
+
+PIN = "135790"
+
+
+def servi(tipo, porta):
+    #eseguito nel processo figlio: avvia una delle due app sulla porta indicata
+    if tipo == "flask":
+        from werkzeug.serving import make_server
+        from app import app
+        make_server("127.0.0.1", porta, app, threaded=True).serve_forever()
+    else:
+        import uvicorn
+        uvicorn.run("app_async:app", host="127.0.0.1", port=porta, log_level="warning")
+
+
+def prepara(movimenti):
+    os.environ["BANCA_PIN_WORKER"] = "0" #qui basta bcrypt nel processo
+    from decimal import Decimal
+    from database import Base, SessionLocal, engine
+    from migrazioni import applica_migrazioni
+    from models import Conto, Utente
+
+    Base.metadata.create_all(bind=engine)
+    applica_migrazioni(engine)
+    db = SessionLocal()
+    utente = Utente("Bench", "Mark", "BNCMRK00A01H501X", None, db)
+    utente.crea_pin(PIN)
+    db.add(utente)
+    db.flush()
+    conto = Conto(utente.id, db)
+    db.add(conto)
+    db.flush()
+    for i in range(movimenti):
+        db.add(conto.deposito(Decimal("1.00"), f"bench {i}"))
+    db.commit()
+    dati = utente.codice_titolare, conto.id
+    db.close()
+    return dati
+
+
+async def attendi_avvio(client, url):
+    for _ in range(100):
+        try:
+            await client.get(url)
+            return
+        except Exception:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"server non raggiungibile: {url}")
+
+
+async def carico(base, codice_titolare, conto_id, concorrenza, secondi):
+    import httpx
+
+    limiti = httpx.Limits(max_connections=concorrenza, max_keepalive_connections=concorrenza)
+    async with httpx.AsyncClient(base_url=base, limits=limiti, timeout=30) as client:
+        await attendi_avvio(client, "/api/login")
+        token = (await client.post("/api/login", json={"codice_titolare": codice_titolare, "pin": PIN})).json()["token"]
+        intestazioni = {"Authorization": f"Bearer {token}"}
+        percorsi = [f"/api/conti/{conto_id}/saldo", f"/api/conti/{conto_id}/transazioni?limite=50"]
+
+        latenze = []
+        errori = 0
+        fine = time.perf_counter() + secondi
+
+        async def client_singolo(i):
+            nonlocal errori
+            n = i
+            while time.perf_counter() < fine:
+                inizio = time.perf_counter()
+                try:
+                    risposta = await client.get(percorsi[n % len(percorsi)], headers=intestazioni)
+                    if risposta.status_code != 200:
+                        errori += 1
+                except httpx.HTTPError:
+                    errori += 1
+                latenze.append(time.perf_counter() - inizio)
+                n += 1
+
+        inizio = time.perf_counter()
+        await asyncio.gather(*(client_singolo(i) for i in range(concorrenza)))
+        durata = time.perf_counter() - inizio
+
+    latenze.sort()
+    percentile = lambda p: latenze[min(len(latenze) - 1, int(len(latenze) * p))] * 1000
+    return len(latenze) / durata, percentile(0.50), percentile(0.99), errori
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Richieste/s e p99 delle API: Flask (WSGI) contro ASGI")
+    parser.add_argument("--concorrenza", type=int, default=200, help="client contemporanei")
+    parser.add_argument("--secondi", type=float, default=10)
+    parser.add_argument("--movimenti", type=int, default=500, help="transazioni sul conto di prova")
+    parser.add_argument("--servi", choices=("flask", "asgi"), help=argparse.SUPPRESS)
+    parser.add_argument("--porta", type=int, default=5101, help=argparse.SUPPRESS)
+    argomenti = parser.parse_args()
+
+    if argomenti.servi:
+        servi(argomenti.servi, argomenti.porta)
+        sys.exit(0)
+
+    codice_titolare, conto_id = prepara(argomenti.movimenti)
+    print(f"\n{argomenti.concorrenza} client per {argomenti.secondi:.0f}s su saldo e transazioni, "
+          f"profilo {os.environ['BANCA_DB_PROFILO']}")
+    for tipo, porta in (("flask", argomenti.porta), ("asgi", argomenti.porta + 1)):
+        server = subprocess.Popen(
+            [sys.executable, "-m", "benchmark.benchmark_async", "--servi", tipo, "--porta", str(porta)],
+            env={**os.environ, "BANCA_PIN_WORKER": "1", "BANCA_BENCH_SERVER": "1"},
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            al_secondo, p50, p99, errori = asyncio.run(carico(
+                f"http://127.0.0.1:{porta}", codice_titolare, conto_id, argomenti.concorrenza, argomenti.secondi
+            ))
+        finally:
+            server.terminate()
+            server.wait()
+        print(f"{tipo:>6}: {al_secondo:8.0f} richieste/s   p50 {p50:7.1f} ms   p99 {p99:7.1f} ms   ({errori} errori)")
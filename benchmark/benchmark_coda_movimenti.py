@@ -0,0 +1,91 @@
+#Benchmark dei bonifici al secondo: un commit per bonifico (come facevano le route) contro la coda
+#con scrittore unico e commit di gruppo di coda_movimenti.py. Usa un database SQLite temporaneo.
+#Uso, dalla cartella del progetto:
+#  python -m benchmark.benchmark_coda_movimenti [--thread 32] [--bonifici 100] [--conti 200]
+#Il profilo del motore si sceglie come per l'app (BANCA_DB_PROFILO, predefinito qui "sqlite").
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+_cartella = tempfile.TemporaryDirectory()
+os.environ["BANCA_DATABASE_URL"] = f"sqlite:///{os.path.join(_cartella.name, 'bench.db')}"
+os.environ.setdefault("BANCA_DB_PROFILO", "sqlite")
+
+from decimal import Decimal  # noqa: E402
+from database import Base, SessionLocal, engine  # noqa: E402
+from migrazioni import applica_migrazioni  # noqa: E402
+from models import Conto, TipoTransazione, Utente  # noqa: E402
+import coda_movimenti  # noqa: E402
+
+
+def prepara(numero_conti):
+    Base.metadata.create_all(bind=engine)
+    applica_migrazioni(engine)
+    db = SessionLocal()
+    utente = Utente("Bench", "Mark", "BNCMRK00A01H501X", None, db)
+    utente.pin_hash = "-"
+    db.add(utente)
+    db.flush()
+    conti = [Conto(utente.id, db) for _ in range(numero_conti)]
+    db.add_all(conti)
+    db.flush()
+    for conto in conti:
+        db.add(conto.deposito(Decimal("1000000.00")))
+    db.commit()
+    dati = utente.id, [(c.id, c.iban) for c in conti]
+    db.close()
+    return dati
+
+
+def bonifico_singolo(utente_id, conto_id, iban):
+    #stesso schema della vecchia effettua_bonifico: due letture, insert e commit per ogni bonifico
+    db = SessionLocal.session_factory()
+    try:
+        mittente = db.query(Conto).filter_by(id=conto_id, utente_id=utente_id).first()
+        destinatario = db.query(Conto).filter_by(iban=iban).first()
+        db.add(mittente.bonifico(destinatario, Decimal("1.00"), "bench"))
+        db.commit()
+    finally:
+        db.close()
+
+
+def bonifico_in_coda(utente_id, conto_id, iban):
+    coda_movimenti.esegui_movimento(TipoTransazione.BONIFICO, utente_id, conto_id, Decimal("1.00"), "bench", iban)
+
+
+def misura(funzione, utente_id, conti, numero_thread, bonifici):
+    errori = []
+
+    def lavora(i):
+        for j in range(bonifici):
+            mittente = conti[(i * bonifici + j) % len(conti)]
+            destinatario = conti[(i * bonifici + j + 1) % len(conti)]
+            try:
+                funzione(utente_id, mittente[0], destinatario[1])
+            except Exception as e:
+                errori.append(e)
+
+    thread = [threading.Thread(target=lavora, args=(i,)) for i in range(numero_thread)]
+    inizio = time.perf_counter()
+    for t in thread:
+        t.start()
+    for t in thread:
+        t.join()
+    durata = time.perf_counter() - inizio
+    return (numero_thread * bonifici - len(errori)) / durata, len(errori)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bonifici al secondo: commit singolo contro commit di gruppo")
+    parser.add_argument("--thread", type=int, default=32)
+    parser.add_argument("--bonifici", type=int, default=100, help="bonifici per thread")
+    parser.add_argument("--conti", type=int, default=200)
+    argomenti = parser.parse_args()
+
+    utente_id, conti = prepara(argomenti.conti)
+    print(f"\n{argomenti.thread} thread x {argomenti.bonifici} bonifici, profilo {os.environ['BANCA_DB_PROFILO']}")
+    for nome, funzione in (("commit singolo", bonifico_singolo), ("coda + gruppo", bonifico_in_coda)):
+        al_secondo, errori = misura(funzione, utente_id, conti, argomenti.thread, argomenti.bonifici)
+        print(f"{nome:>15}: {al_secondo:8.0f} bonifici/s  ({errori} errori)")
@@ -0,0 +1,58 @@
+#Benchmark dell'assegnazione dei codici (codice titolare / IBAN) al crescere dell'occupazione dello spazio a 6 cifre.
+#Confronta la sequenza con permutazione (Sequenza.prossimo_codice) con il vecchio metodo "numero a caso + SELECT".
+#Uso, dalla cartella del progetto:  python -m benchmark.benchmark_codici
+import random
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from database import Base
+from migrazioni import applica_migrazioni
+from models import Sequenza
+import codici
+
+CODICI_PER_MISURA = 2000
+OCCUPAZIONI = (0.0, 0.5, 0.9)
+
+
+def misura_sequenza(engine, occupazione):
+    Sessione = sessionmaker(bind=engine)
+    with Sessione() as db:
+        db.query(Sequenza).filter_by(nome="codice_titolare").update({Sequenza.valore: int(codici.DOMINIO * occupazione)})
+        db.commit()
+
+    query = []
+    ascolta = lambda *args: query.append(1)
+    event.listen(engine, "before_cursor_execute", ascolta)
+    inizio = time.perf_counter()
+    with Sessione() as db:
+        for _ in range(CODICI_PER_MISURA):
+            Sequenza.prossimo_codice(db, "codice_titolare")
+            db.commit()
+    durata = time.perf_counter() - inizio
+    event.remove(engine, "before_cursor_execute", ascolta)
+    return durata / CODICI_PER_MISURA * 1e6, len(query) / CODICI_PER_MISURA
+
+
+def tentativi_metodo_casuale(occupazione):
+    #il vecchio metodo fa una SELECT per ogni numero estratto finché non ne trova uno libero
+    occupati = set(random.sample(range(1, codici.DOMINIO), int((codici.DOMINIO - 1) * occupazione)))
+    tentativi = 0
+    for _ in range(CODICI_PER_MISURA):
+        while True:
+            tentativi += 1
+            numero = random.randint(1, codici.DOMINIO - 1)
+            if numero not in occupati:
+                occupati.add(numero)
+                break
+    return tentativi / CODICI_PER_MISURA
+
+
+if __name__ == "__main__":
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    applica_migrazioni(engine)
+
+    print(f"{'occupazione':>12} {'µs/codice':>10} {'query/codice':>13} {'SELECT/codice (vecchio)':>24}")
+    for occupazione in OCCUPAZIONI:
+        micro, query = misura_sequenza(engine, occupazione)
+        print(f"{occupazione:>12.0%} {micro:>10.1f} {query:>13.2f} {tentativi_metodo_casuale(occupazione):>24.2f}")
@@ -0,0 +1,353 @@
+#Benchmark delle rotte più usate: login, pagina_privata, effettua_bonifico, api_saldo, api_transazioni, api_bonifico.
+#Genera un dataset sintetico (genera_dati.py) in un database temporaneo e misura ogni rotta per qualche secondo:
+# - modo "client": test client di Flask, una richiesta alla volta (latenza e SQL senza rumore di rete);
+# - modo "http": server WSGI a thread nello stesso processo e più client HTTP in parallelo.
+#Per ogni rotta riporta p50/p95/p99, richieste/s e istruzioni SQL per richiesta (tutte quelle eseguite nel processo
+#durante la misura, compresi thread scrittore e caricamenti della cache, divise per il numero di richieste).
+#I risultati si salvano in un file JSON di riferimento; con --confronta il benchmark esce con codice 1 se una
+#rotta peggiora oltre la soglia. Uso, dalla cartella del progetto:
+#  python -m benchmark.benchmark_endpoint [--modo client|http] [--secondi 3] [--thread 8]
+#         [--utenti 2000] [--transazioni 200000] [--database copia.db]
+#         [--salva-baseline baseline.json] [--confronta baseline.json] [--soglia 0.2]
+#Il login è dominato da bcrypt: per misurare il resto della rotta si può abbassare BANCA_BCRYPT_COSTO.
+#I riferimenti vanno salvati e confrontati sulla stessa macchina, con gli stessi parametri.
+import argparse
+import http.client
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+ROTTE = ("login", "pagina_privata", "effettua_bonifico", "api_saldo", "api_transazioni", "api_bonifico")
+RISCALDAMENTO = 5 #richieste non misurate per client prima di ogni rotta (cache, pool di connessioni)
+SALDO_MINIMO = 50 #euro: i conti usati fanno molti bonifici da 0.01
+
+
+class ClientTest:
+    """Client del modo "client": il test client di Flask, con i cookie di sessione."""
+
+    def __init__(self, app):
+        self._client = app.test_client()
+
+    def richiesta(self, metodo, percorso, form=None, json=None, intestazioni=None):
+        risposta = self._client.open(percorso, method=metodo, data=form, json=json, headers=intestazioni)
+        return risposta.status_code, risposta.headers.get("Location", ""), risposta.get_data()
+
+
+class ClientHttp:
+    """Client del modo "http": una connessione HTTP con i cookie ricevuti dal server."""
+
+    def __init__(self, porta):
+        self._connessione = http.client.HTTPConnection("127.0.0.1", porta, timeout=60)
+        self._cookie = {}
+
+    def richiesta(self, metodo, percorso, form=None, json=None, intestazioni=None):
+        intestazioni = dict(intestazioni or {})
+        corpo = None
+        if form is not None:
+            corpo = urlencode(form)
+            intestazioni["Content-Type"] = "application/x-www-form-urlencoded"
+        elif json is not None:
+            corpo = _json.dumps(json)
+            intestazioni["Content-Type"] = "application/json"
+        if self._cookie:
+            intestazioni["Cookie"] = "; ".join(f"{nome}={valore}" for nome, valore in self._cookie.items())
+        try:
+            self._connessione.request(metodo, percorso, body=corpo, headers=intestazioni)
+            risposta = self._connessione.getresponse()
+            corpo = risposta.read()
+        except (OSError, http.client.HTTPException):
+            self._connessione.close()
+            return 0, "", b""
+        for cookie in risposta.headers.get_all("Set-Cookie") or ():
+            nome, _, valore = cookie.split(";", 1)[0].partition("=")
+            self._cookie[nome.strip()] = valore
+        if risposta.getheader("Connection", "").lower() == "close" or risposta.version == 10:
+            self._connessione.close() #il server WSGI di sviluppo chiude dopo ogni risposta
+        return risposta.status, risposta.getheader("Location", ""), corpo
+
+
+_json = json #il parametro json di richiesta() nasconde il modulo
+
+
+class Utilizzatore:
+    """Un client con la sua sessione web e il suo token API, legato a un utente sintetico."""
+
+    def __init__(self, client, codice_titolare, conto_id, pin, iban_destinatario):
+        self.client = client
+        self.codice_titolare = codice_titolare
+        self.conto_id = conto_id
+        self.pin = pin
+        self.iban_destinatario = iban_destinatario
+        self.token = None
+
+    def accedi(self):
+        #sessione web sul conto scelto e token per le API
+        if not self.login():
+            raise RuntimeError(f"login non riuscito per {self.codice_titolare}")
+        self.client.richiesta("GET", f"/pagina_privata?conto_id={self.conto_id}")
+        stato, _, corpo = self.client.richiesta("POST", "/api/login", json={
+            "codice_titolare": self.codice_titolare, "pin": self.pin
+        })
+        if stato != 200:
+            raise RuntimeError(f"/api/login non riuscito per {self.codice_titolare}: {stato}")
+        self.token = _json.loads(corpo)["token"]
+
+    def _bearer(self):
+        return {"Authorization": f"Bearer {self.token}"}
+
+    #---- Una funzione per rotta: True se la risposta è quella di un'operazione riuscita ----
+    def login(self):
+        stato, destinazione, _ = self.client.richiesta("POST", "/login", form={
+            "codice_titolare": self.codice_titolare, "pin": self.pin
+        })
+        return stato == 302 and destinazione.endswith("/pagina_privata")
+
+    def pagina_privata(self):
+        stato, _, _ = self.client.richiesta("GET", "/pagina_privata")
+        return stato == 200
+
+    def effettua_bonifico(self):
+        stato, destinazione, _ = self.client.richiesta("POST", "/effettua_bonifico", form={
+            "importo": "0.01", "iban": self.iban_destinatario, "descrizione": "benchmark"
+        })
+        return stato == 302 and destinazione.endswith("/pagina_privata")
+
+    def api_saldo(self):
+        stato, _, _ = self.client.richiesta("GET", f"/api/conti/{self.conto_id}/saldo", intestazioni=self._bearer())
+        return stato == 200
+
+    def api_transazioni(self):
+        stato, _, _ = self.client.richiesta("GET", f"/api/conti/{self.conto_id}/transazioni", intestazioni=self._bearer())
+        return stato == 200
+
+    def api_bonifico(self):
+        stato, _, _ = self.client.richiesta("POST", f"/api/conti/{self.conto_id}/bonifico", json={
+            "iban_destinatario": self.iban_destinatario, "importo": 0.01, "descrizione": "benchmark"
+        }, intestazioni=self._bearer())
+        return stato == 200
+
+
+class ContatoreSql:
+    """Conta le istruzioni SQL eseguite sul motore, da qualsiasi thread."""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.totale = 0
+        self._lock = threading.Lock()
+        event.listen(engine, "before_cursor_execute", self._conta)
+
+    def _conta(self, *args):
+        with self._lock:
+            self.totale += 1
+
+
+def prepara_dataset(argomenti):
+    #il database va scelto prima di importare database.py
+    cartella = tempfile.mkdtemp(prefix="bench_endpoint_")
+    percorso = os.path.join(cartella, "bench.db")
+    if argomenti.database:
+        shutil.copyfile(argomenti.database, percorso) #la copia: i bonifici del benchmark non toccano l'originale
+    os.environ["BANCA_DATABASE_URL"] = f"sqlite:///{percorso}"
+    os.environ.setdefault("BANCA_DB_PROFILO", "sqlite")
+
+    if not argomenti.database:
+        from genera_dati import genera
+        from lavori import popola_lavori
+        popola_lavori()
+        genera(argomenti.utenti, argomenti.transazioni, argomenti.anni, argomenti.seme, 50000)
+    return cartella
+
+
+def scegli_utenti(quanti):
+    """(codice_titolare, conto_id, iban_destinatario) per i conti più ricchi, un conto per utente."""
+    from sqlalchemy import select
+    from database import SessionLocal
+    from models import Conto, Utente
+    db = SessionLocal.session_factory()
+    try:
+        righe = db.execute(
+            select(Utente.codice_titolare, Conto.id, Conto.iban)
+            .join(Conto, Conto.utente_id == Utente.id)
+            .where(Conto.saldo >= SALDO_MINIMO)
+            .order_by(Conto.saldo.desc(), Conto.id)
+            .limit(quanti * 4)
+        ).all()
+    finally:
+        db.close()
+    scelti, visti = [], set()
+    for codice_titolare, conto_id, iban in righe:
+        if codice_titolare not in visti:
+            visti.add(codice_titolare)
+            scelti.append((codice_titolare, conto_id, iban))
+    if len(scelti) < 2:
+        raise SystemExit("❌ Servono almeno due conti con saldo sufficiente: aumentare --utenti o --transazioni.")
+    #ogni utente manda i bonifici al conto dell'utente successivo
+    return [
+        (codice_titolare, conto_id, scelti[(i + 1) % len(scelti)][2])
+        for i, (codice_titolare, conto_id, _) in enumerate(scelti[:quanti])
+    ]
+
+
+def misura_rotta(utilizzatori, rotta, secondi, contatore):
+    for utilizzatore in utilizzatori:
+        for _ in range(RISCALDAMENTO if rotta != "login" else 1):
+            getattr(utilizzatore, rotta)()
+
+    latenze, errori = [], 0
+    lock = threading.Lock()
+    fine = time.perf_counter() + secondi
+
+    def esegui(utilizzatore):
+        nonlocal errori
+        operazione = getattr(utilizzatore, rotta)
+        proprie, sbagliate = [], 0
+        while time.perf_counter() < fine:
+            inizio = time.perf_counter()
+            if not operazione():
+                sbagliate += 1
+            proprie.append(time.perf_counter() - inizio)
+        with lock:
+            latenze.extend(proprie)
+            errori += sbagliate
+
+    sql_iniziali = contatore.totale
+    inizio = time.perf_counter()
+    if len(utilizzatori) == 1:
+        esegui(utilizzatori[0])
+    else:
+        thread = [threading.Thread(target=esegui, args=(u,)) for u in utilizzatori]
+        for t in thread:
+            t.start()
+        for t in thread:
+            t.join()
+    durata = time.perf_counter() - inizio
+
+    latenze.sort()
+    percentile = lambda p: latenze[min(len(latenze) - 1, int(len(latenze) * p))] * 1000
+    return {
+        "richieste": len(latenze),
+        "richieste_s": round(len(latenze) / durata, 1),
+        "p50_ms": round(percentile(0.50), 3),
+        "p95_ms": round(percentile(0.95), 3),
+        "p99_ms": round(percentile(0.99), 3),
+        "sql_per_richiesta": round((contatore.totale - sql_iniziali) / len(latenze), 2),
+        "errori": errori,
+    }
+
+
+def esegui_benchmark(argomenti):
+    from app import app
+    from database import engine
+    from genera_dati import PIN_SINTETICO
+
+    contatore = ContatoreSql(engine)
+    clienti = 1 if argomenti.modo == "client" else argomenti.thread
+    server = None
+    if argomenti.modo == "client":
+        nuovo_client = lambda: ClientTest(app)
+    else:
+        import logging
+        from werkzeug.serving import make_server
+        logging.getLogger("werkzeug").setLevel(logging.WARNING) #niente riga di log per ogni richiesta
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        nuovo_client = lambda: ClientHttp(server.server_port)
+
+    try:
+        utilizzatori = [
+            Utilizzatore(nuovo_client(), codice_titolare, conto_id, PIN_SINTETICO, iban_destinatario)
+            for codice_titolare, conto_id, iban_destinatario in scegli_utenti(clienti)
+        ]
+        for utilizzatore in utilizzatori:
+            utilizzatore.accedi()
+
+        risultati = {}
+        for rotta in argomenti.rotte:
+            risultati[rotta] = misura_rotta(utilizzatori, rotta, argomenti.secondi, contatore)
+            r = risultati[rotta]
+            print(f"{rotta:>18}: {r['richieste_s']:8.1f} richieste/s   p50 {r['p50_ms']:8.2f} ms   "
+                  f"p95 {r['p95_ms']:8.2f} ms   p99 {r['p99_ms']:8.2f} ms   "
+                  f"SQL {r['sql_per_richiesta']:5.2f}   ({r['errori']} errori)")
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    return {
+        "modo": argomenti.modo,
+        "parametri": {
+            "secondi": argomenti.secondi,
+            "client": clienti,
+            "utenti": argomenti.utenti,
+            "transazioni": argomenti.transazioni,
+            "seme": argomenti.seme,
+            "database": argomenti.database,
+            "bcrypt_costo": int(os.environ.get("BANCA_BCRYPT_COSTO", "12")),
+        },
+        "ambiente": {"python": platform.python_version(), "macchina": platform.node()},
+        "rotte": risultati,
+    }
+
+
+def confronta(risultati, riferimento, soglia):
+    """Restituisce l'elenco delle regressioni rispetto al riferimento."""
+    if riferimento.get("modo") != risultati["modo"]:
+        raise SystemExit(f"❌ Riferimento misurato in modo {riferimento.get('modo')!r}, non {risultati['modo']!r}.")
+    regressioni = []
+    for rotta, attuale in risultati["rotte"].items():
+        prima = riferimento["rotte"].get(rotta)
+        if prima is None:
+            continue
+        for metrica in ("p50_ms", "p95_ms"):
+            if attuale[metrica] > prima[metrica] * (1 + soglia):
+                regressioni.append(f"{rotta}: {metrica} {prima[metrica]} -> {attuale[metrica]}")
+        #le istruzioni SQL sono quasi deterministiche: tollero mezzo statement di rumore (cache, gruppi di commit)
+        if attuale["sql_per_richiesta"] > prima["sql_per_richiesta"] + max(0.5, prima["sql_per_richiesta"] * soglia):
+            regressioni.append(f"{rotta}: sql_per_richiesta {prima['sql_per_richiesta']} -> {attuale['sql_per_richiesta']}")
+        if attuale["errori"] and not prima["errori"]:
+            regressioni.append(f"{rotta}: {attuale['errori']} errori")
+    return regressioni
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latenza, richieste/s e SQL per richiesta delle rotte principali")
+    parser.add_argument("--modo", choices=("client", "http"), default="client")
+    parser.add_argument("--secondi", type=float, default=3, help="durata della misura per ogni rotta")
+    parser.add_argument("--thread", type=int, default=8, help="client HTTP in parallelo (modo http)")
+    parser.add_argument("--rotte", nargs="+", choices=ROTTE, default=list(ROTTE))
+    parser.add_argument("--utenti", type=int, default=2000)
+    parser.add_argument("--transazioni", type=int, default=200000)
+    parser.add_argument("--anni", type=float, default=5)
+    parser.add_argument("--seme", type=int, default=42)
+    parser.add_argument("--database", help="database SQLite già generato con genera_dati.py (ne viene usata una copia)")
+    parser.add_argument("--salva-baseline", metavar="FILE", help="scrive i risultati in JSON")
+    parser.add_argument("--confronta", metavar="FILE", help="confronta con un riferimento salvato")
+    parser.add_argument("--soglia", type=float, default=0.2, help="peggioramento relativo tollerato (0.2 = 20%%)")
+    argomenti = parser.parse_args()
+
+    cartella = prepara_dataset(argomenti)
+    try:
+        print(f"\nModo {argomenti.modo}, {argomenti.secondi:.0f}s per rotta")
+        risultati = esegui_benchmark(argomenti)
+    finally:
+        shutil.rmtree(cartella, ignore_errors=True)
+
+    if argomenti.salva_baseline:
+        with open(argomenti.salva_baseline, "w", encoding="utf-8") as file:
+            json.dump(risultati, file, indent=2)
+        print(f"✔️ Riferimento salvato in {argomenti.salva_baseline}")
+
+    if argomenti.confronta:
+        with open(argomenti.confronta, encoding="utf-8") as file:
+            regressioni = confronta(risultati, json.load(file), argomenti.soglia)
+        if regressioni:
+            print(f"❌ Regressioni oltre il {argomenti.soglia:.0%}:")
+            for regressione in regressioni:
+                print("   " + regressione)
+            sys.exit(1)
+        print(f"✔️ Nessuna regressione oltre il {argomenti.soglia:.0%}")
@@ -0,0 +1,102 @@
+#Benchmark di concorrenza lettura/scrittura per i profili del motore definiti in database.py.
+#Lettori (saldo + prima pagina dello storico) e scrittori (depositi) girano in parallelo per qualche secondo
+#su un database temporaneo; per ogni profilo riporta operazioni al secondo ed errori "database is locked".
+#Uso, dalla cartella del progetto:
+#  python -m benchmark.benchmark_profili [--secondi 5] [--lettori 8] [--scrittori 4] [--url-server postgresql://...]
+#Il profilo "server" viene misurato solo se si indica --url-server (il database deve esistere ed essere vuoto).
+import argparse
+import os
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from database import Base, crea_engine
+from migrazioni import applica_migrazioni
+from models import Conto, Utente
+from storico import pagina_transazioni
+
+
+def prepara(engine):
+    Base.metadata.create_all(bind=engine)
+    applica_migrazioni(engine)
+    Sessione = sessionmaker(bind=engine)
+    with Sessione() as db:
+        utente = Utente("Bench", "Mark", "BNCMRK00A01H501X", None, db)
+        utente.pin_hash = "-"
+        db.add(utente)
+        db.flush()
+        conti = [Conto(utente.id, db) for _ in range(4)]
+        db.add_all(conti)
+        db.flush()
+        for conto in conti:
+            db.add(conto.deposito(Decimal("1000.00")))
+        db.commit()
+        return Sessione, [conto.id for conto in conti]
+
+
+def misura(profilo, url, secondi, lettori, scrittori):
+    engine = crea_engine(profilo, url)
+    Sessione, conti = prepara(engine)
+    fine = time.perf_counter() + secondi
+    conteggi = {"letture": 0, "scritture": 0, "bloccati": 0}
+    lock = threading.Lock()
+
+    def conta(chiave):
+        with lock:
+            conteggi[chiave] += 1
+
+    def lettore(i):
+        conto_id = conti[i % len(conti)]
+        while time.perf_counter() < fine:
+            with Sessione() as db:
+                try:
+                    db.get(Conto, conto_id).saldo_corrente
+                    pagina_transazioni(db, conto_id)
+                    conta("letture")
+                except OperationalError:
+                    conta("bloccati")
+
+    def scrittore(i):
+        conto_id = conti[i % len(conti)]
+        while time.perf_counter() < fine:
+            with Sessione() as db:
+                try:
+                    db.add(db.get(Conto, conto_id).deposito(Decimal("1.00")))
+                    db.commit()
+                    conta("scritture")
+                except OperationalError:
+                    db.rollback()
+                    conta("bloccati")
+
+    thread = [threading.Thread(target=lettore, args=(i,)) for i in range(lettori)]
+    thread += [threading.Thread(target=scrittore, args=(i,)) for i in range(scrittori)]
+    for t in thread:
+        t.start()
+    for t in thread:
+        t.join()
+    engine.dispose()
+    return {chiave: valore / secondi for chiave, valore in conteggi.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concorrenza lettura/scrittura per profilo del motore")
+    parser.add_argument("--secondi", type=float, default=5)
+    parser.add_argument("--lettori", type=int, default=8)
+    parser.add_argument("--scrittori", type=int, default=4)
+    parser.add_argument("--url-server", help="URL del database per il profilo server")
+    argomenti = parser.parse_args()
+
+    risultati = {}
+    with tempfile.TemporaryDirectory() as cartella:
+        for profilo in ("sviluppo", "sqlite"):
+            url = f"sqlite:///{os.path.join(cartella, profilo + '.db')}"
+            risultati[profilo] = misura(profilo, url, argomenti.secondi, argomenti.lettori, argomenti.scrittori)
+    if argomenti.url_server:
+        risultati["server"] = misura("server", argomenti.url_server, argomenti.secondi, argomenti.lettori, argomenti.scrittori)
+
+    print(f"\n{argomenti.lettori} lettori, {argomenti.scrittori} scrittori, {argomenti.secondi:g} s")
+    print(f"{'profilo':>10} {'letture/s':>10} {'scritture/s':>12} {'bloccati/s':>11}")
+    for profilo, r in risultati.items():
+        print(f"{profilo:>10} {r['letture']:>10.0f} {r['scritture']:>12.0f} {r['bloccati']:>11.1f}")
@@ -0,0 +1,122 @@
+#Stress test degli addebiti concorrenti: molti thread addebitano gli stessi pochi conti con saldo limitato,
+#così quasi ogni addebito è in gara con altri. Alla fine verifica che nessun saldo sia negativo e che i saldi
+#memorizzati coincidano con lo storico; riporta il throughput. Usa un database SQLite temporaneo.
+#Uso, dalla cartella del progetto:
+#  python -m benchmark.stress_addebiti [--thread 32] [--addebiti 4000] [--conti 10] [--saldo 2000] [--percorso modelli|coda]
+#  ("modelli" = Conto.prelievo/pagamento/bonifico con una sessione per addebito, "coda" = coda_movimenti)
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+_cartella = tempfile.TemporaryDirectory()
+os.environ["BANCA_DATABASE_URL"] = f"sqlite:///{os.path.join(_cartella.name, 'stress.db')}"
+os.environ.setdefault("BANCA_DB_PROFILO", "sqlite")
+
+from decimal import Decimal  # noqa: E402
+from sqlalchemy import func  # noqa: E402
+from sqlalchemy.exc import OperationalError  # noqa: E402
+from database import Base, SessionLocal, engine  # noqa: E402
+from migrazioni import applica_migrazioni  # noqa: E402
+from models import Conto, TipoTransazione, Utente  # noqa: E402
+import coda_movimenti  # noqa: E402
+
+def prepara(numero_conti, saldo_iniziale):
+    Base.metadata.create_all(bind=engine)
+    applica_migrazioni(engine)
+    db = SessionLocal()
+    utente = Utente("Stress", "Test", "STRTST00A01H501X", None, db)
+    utente.pin_hash = "-"
+    db.add(utente)
+    db.flush()
+    conti = [Conto(utente.id, db) for _ in range(numero_conti)]
+    db.add_all(conti)
+    db.flush()
+    for conto in conti:
+        db.add(conto.deposito(saldo_iniziale))
+    db.commit()
+    dati = utente.id, [(c.id, c.iban) for c in conti]
+    db.close()
+    return dati
+
+
+def addebito_modelli(utente_id, mittente, destinatario, importo):
+    db = SessionLocal.session_factory()
+    try:
+        conto = db.get(Conto, mittente[0])
+        scelta = random.random()
+        if scelta < 0.4:
+            trans = conto.prelievo(importo)
+        elif scelta < 0.7:
+            trans = conto.pagamento(importo, "stress")
+        else:
+            trans = conto.bonifico(db.get(Conto, destinatario[0]), importo, "stress")
+        db.add(trans)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def addebito_coda(utente_id, mittente, destinatario, importo):
+    if random.random() < 0.5:
+        coda_movimenti.esegui_movimento(TipoTransazione.PAGAMENTO, utente_id, mittente[0], importo, "stress")
+    else:
+        coda_movimenti.esegui_movimento(TipoTransazione.BONIFICO, utente_id, mittente[0], importo, "stress", destinatario[1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Addebiti concorrenti: nessun saldo deve andare in negativo")
+    parser.add_argument("--thread", type=int, default=32)
+    parser.add_argument("--addebiti", type=int, default=4000, help="addebiti totali")
+    parser.add_argument("--conti", type=int, default=10)
+    parser.add_argument("--saldo", type=Decimal, default=Decimal("2000"), help="saldo iniziale di ogni conto")
+    parser.add_argument("--percorso", choices=("modelli", "coda"), default="modelli")
+    argomenti = parser.parse_args()
+
+    utente_id, conti = prepara(argomenti.conti, argomenti.saldo)
+    addebita = addebito_modelli if argomenti.percorso == "modelli" else addebito_coda
+    esiti = {"eseguiti": 0, "saldo insufficiente": 0, "database bloccato": 0}
+    lock = threading.Lock()
+
+    def lavora(quanti):
+        for _ in range(quanti):
+            mittente, destinatario = random.sample(conti, 2)
+            try:
+                addebita(utente_id, mittente, destinatario, Decimal(random.randint(1, 30)))
+                esito = "eseguiti"
+            except ValueError:
+                esito = "saldo insufficiente"
+            except OperationalError:
+                esito = "database bloccato"
+            with lock:
+                esiti[esito] += 1
+
+    per_thread = argomenti.addebiti // argomenti.thread
+    thread = [threading.Thread(target=lavora, args=(per_thread,)) for _ in range(argomenti.thread)]
+    inizio = time.perf_counter()
+    for t in thread:
+        t.start()
+    for t in thread:
+        t.join()
+    durata = time.perf_counter() - inizio
+
+    db = SessionLocal()
+    saldo_minimo = db.query(func.min(Conto.saldo)).scalar()
+    incoerenti = Conto.saldi_incoerenti(db)
+    db.close()
+
+    totale = per_thread * argomenti.thread
+    print(f"\npercorso {argomenti.percorso}: {totale} addebiti in {durata:.2f} s ({totale / durata:.0f}/s)")
+    for esito, numero in esiti.items():
+        print(f"  {esito}: {numero}")
+    print(f"  saldo minimo: {saldo_minimo}, saldi incoerenti: {len(incoerenti)}")
+    if saldo_minimo < 0 or incoerenti:
+        print("❌ Controllo di concorrenza violato")
+        sys.exit(1)
+    print("✔️ Nessun saldo negativo")
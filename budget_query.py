@@ -0,0 +1,97 @@
+#budget_query.py conta le istruzioni SQL eseguite da una rotta o da una funzione e le confronta con un massimo
+#dichiarato, così una relazione lazy toccata da un template o da una proprietà non aggiunge query senza che
+#nessuno se ne accorga. Segnala anche le "N+1": la stessa istruzione ripetuta con parametri diversi.
+#Uso:
+#  @budget_query(2)                      su una vista o una funzione
+#  with ContatoreQuery("nome", 5) as c:  attorno a un blocco (c.totale, c.ripetute())
+#BANCA_BUDGET_QUERY sceglie cosa succede quando un budget viene superato:
+#  "avviso" (predefinito) stampa il problema, "errore" solleva BudgetSuperato (per test e CI),
+#  "spento" rende il decoratore un passaggio diretto, senza alcun costo.
+#Si conta solo il thread corrente: il lavoro del thread scrittore di coda_movimenti non rientra nel budget.
+import os
+import threading
+from collections import defaultdict
+from functools import wraps
+from sqlalchemy import event
+from database import engine
+
+MODALITA = os.environ.get("BANCA_BUDGET_QUERY", "avviso")
+SOGLIA_RIPETIZIONI = int(os.environ.get("BANCA_SOGLIA_N_PIU_UNO", "3")) #esecuzioni della stessa istruzione
+
+_locale = threading.local() #contatori attivi nel thread, dal più esterno al più interno
+
+
+class BudgetSuperato(Exception):
+    """Troppe istruzioni SQL, o un'istruzione ripetuta come in un ciclo N+1."""
+
+
+class ContatoreQuery:
+    def __init__(self, nome, massimo=None):
+        self.nome = nome
+        self.massimo = massimo
+        self.istruzioni = [] #(testo SQL, parametri)
+
+    @property
+    def totale(self):
+        return len(self.istruzioni)
+
+    def ripetute(self):
+        """Istruzioni eseguite almeno SOGLIA_RIPETIZIONI volte con parametri diversi: {testo: esecuzioni}."""
+        parametri = defaultdict(list)
+        for testo, valori in self.istruzioni:
+            parametri[testo].append(valori)
+        return {
+            testo: len(valori)
+            for testo, valori in parametri.items()
+            if len(valori) >= SOGLIA_RIPETIZIONI and len({repr(v) for v in valori}) > 1
+        }
+
+    def __enter__(self):
+        if not hasattr(_locale, "contatori"):
+            _locale.contatori = []
+        _locale.contatori.append(self)
+        return self
+
+    def __exit__(self, tipo_eccezione, eccezione, traccia):
+        _locale.contatori.remove(self)
+        if tipo_eccezione is None:
+            self.controlla()
+        return False
+
+    def controlla(self):
+        problemi = []
+        if self.massimo is not None and self.totale > self.massimo:
+            problemi.append(f"{self.totale} istruzioni SQL, massimo {self.massimo}")
+        for testo, volte in self.ripetute().items():
+            problemi.append(f"possibile N+1, eseguita {volte} volte: {' '.join(testo.split())[:200]}")
+        if problemi:
+            _segnala(f"{self.nome}: " + "; ".join(problemi))
+
+
+def _segnala(messaggio):
+    if MODALITA == "errore":
+        raise BudgetSuperato(messaggio)
+    if MODALITA != "spento":
+        print(f"❌ BUDGET QUERY {messaggio}")
+
+
+def budget_query(massimo):
+    """Decoratore: al massimo `massimo` istruzioni SQL per chiamata, e nessuna ripetizione N+1."""
+    def decoratore(funzione):
+        if MODALITA == "spento":
+            return funzione
+
+        @wraps(funzione)
+        def wrapper(*args, **kwargs):
+            with ContatoreQuery(funzione.__qualname__, massimo):
+                return funzione(*args, **kwargs)
+        return wrapper
+    return decoratore
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def _registra_istruzione(conn, cursor, statement, parameters, context, executemany):
+    contatori = getattr(_locale, "contatori", None)
+    if contatori:
+        for contatore in contatori:
+            contatore.istruzioni.append((statement, parameters))
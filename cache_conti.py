@@ -0,0 +1,195 @@
+#cache_conti.py tiene in memoria, per ogni conto letto di recente, il saldo e la prima pagina dei movimenti
+#(quella mostrata da pagina_privata e dalle API senza cursore). È una LRU limitata in byte: quando supera
+#il limite scarta i conti usati meno di recente.
+#Ogni movimento committato che tocca un conto ne scarta la voce (write-through per invalidazione):
+#le transazioni ORM tramite gli eventi di sessione qui sotto, i blocchi Core di coda_movimenti con invalida_conti().
+#La cache è del singolo processo e non vede le scritture di altri worker o di altri processi (es. stipendi.py):
+#chi conosce la versione attuale del conto (Conto.versione, letta per chiave primaria) la passa a ottieni() e una voce
+#più vecchia viene ricaricata; senza versione le scritture esterne si vedono allo scadere del TTL.
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from database import SessionLocal
+from models import Conto, Transazione
+from storico import pagina_transazioni
+
+CACHE_CONTI_KB = int(os.environ.get("BANCA_CACHE_CONTI_KB", "8192")) #0 = cache disattivata
+TTL_CACHE_CONTI = float(os.environ.get("BANCA_CACHE_CONTI_TTL", "60")) #secondi
+
+#copie immutabili, usabili dopo la chiusura della sessione (il template legge gli stessi attributi di Transazione)
+Movimento = namedtuple("Movimento", [
+    "id", "data", "importo", "tipo", "descrizione", "conto_mittente_id", "conto_destinatario_id"
+])
+VoceConto = namedtuple("VoceConto", [
+    "conto_id", "utente_id", "iban", "saldo", "versione", "transazioni", "prossimo_cursore"
+])
+
+
+def _dimensione(voce):
+    #stima dei byte occupati: basta per confrontare le voci con il limite, non serve precisione
+    totale = sys.getsizeof(voce) + sys.getsizeof(voce.iban) + sys.getsizeof(voce.saldo)
+    totale += sys.getsizeof(voce.transazioni)
+    for movimento, uscita in voce.transazioni:
+        totale += sys.getsizeof(movimento) + sum(sys.getsizeof(campo) for campo in movimento)
+    return totale
+
+
+class CacheConti:
+    def __init__(self, limite_byte=CACHE_CONTI_KB * 1024, ttl=TTL_CACHE_CONTI):
+        self.limite_byte = limite_byte
+        self.ttl = ttl
+        self._voci = OrderedDict() #conto_id -> (scadenza, dimensione, voce), dalla meno recente
+        self._byte = 0
+        self._in_caricamento = {} #conto_id -> gettone della lettura in corso
+        self._gettone = 0
+        self._lock = threading.Lock()
+        self.colpi = 0
+        self.mancati = 0
+        self.espulsioni = 0
+        self.invalidazioni = 0
+
+    def ottieni(self, conto_id, versione=None):
+        """Restituisce la VoceConto del conto (None se il conto non esiste), leggendola dal DB solo se manca.
+
+        Con versione, una voce in cache con una versione precedente è considerata mancante.
+        """
+        if self.limite_byte <= 0:
+            return self._carica(conto_id)
+
+        with self._lock:
+            elemento = self._voci.get(conto_id)
+            if (elemento is not None and elemento[0] > time.monotonic()
+                    and (versione is None or elemento[2].versione >= versione)):
+                self._voci.move_to_end(conto_id)
+                self.colpi += 1
+                return elemento[2]
+            self.mancati += 1
+            self._gettone += 1
+            gettone = self._in_caricamento[conto_id] = self._gettone
+
+        voce = self._carica(conto_id)
+
+        with self._lock:
+            #se nel frattempo un movimento ha invalidato il conto, la lettura potrebbe essere vecchia: non la salvo
+            if self._in_caricamento.get(conto_id) != gettone:
+                return voce
+            del self._in_caricamento[conto_id]
+            if voce is not None:
+                self._inserisci(conto_id, voce)
+        return voce
+
+    def _carica(self, conto_id):
+        db = SessionLocal.session_factory()
+        try:
+            conto = db.execute(
+                select(Conto.id, Conto.utente_id, Conto.iban, Conto.saldo, Conto.versione).where(Conto.id == conto_id)
+            ).first()
+            if conto is None:
+                return None
+            transazioni, prossimo_cursore = pagina_transazioni(db, conto_id)
+            return VoceConto(
+                conto.id,
+                conto.utente_id,
+                conto.iban,
+                conto.saldo or 0,
+                conto.versione,
+                tuple(
+                    (Movimento(t.id, t.data, t.importo, t.tipo, t.descrizione,
+                               t.conto_mittente_id, t.conto_destinatario_id), uscita)
+                    for t, uscita in transazioni
+                ),
+                prossimo_cursore,
+            )
+        finally:
+            db.close()
+
+    def _inserisci(self, conto_id, voce):
+        dimensione = _dimensione(voce)
+        self._rimuovi(conto_id)
+        self._voci[conto_id] = (time.monotonic() + self.ttl, dimensione, voce)
+        self._byte += dimensione
+        while self._byte > self.limite_byte and len(self._voci) > 1:
+            vecchio_id = next(iter(self._voci))
+            self._rimuovi(vecchio_id)
+            self.espulsioni += 1
+
+    def _rimuovi(self, conto_id):
+        elemento = self._voci.pop(conto_id, None)
+        if elemento is not None:
+            self._byte -= elemento[1]
+        return elemento is not None
+
+    def invalida(self, *conti_ids):
+        with self._lock:
+            for conto_id in conti_ids:
+                self._in_caricamento.pop(conto_id, None)
+                if self._rimuovi(conto_id):
+                    self.invalidazioni += 1
+
+    def svuota(self):
+        with self._lock:
+            self._voci.clear()
+            self._in_caricamento.clear()
+            self._byte = 0
+
+    def statistiche(self):
+        with self._lock:
+            richieste = self.colpi + self.mancati
+            return {
+                "voci": len(self._voci),
+                "byte": self._byte,
+                "limite_byte": self.limite_byte,
+                "colpi": self.colpi,
+                "mancati": self.mancati,
+                "espulsioni": self.espulsioni,
+                "invalidazioni": self.invalidazioni,
+                "percentuale_colpi": round(100 * self.colpi / richieste, 1) if richieste else 0.0,
+            }
+
+
+cache = CacheConti()
+
+
+def voce_conto(conto_id, versione=None):
+    return cache.ottieni(conto_id, versione)
+
+
+def versione_conto(conto_id):
+    """Restituisce (utente_id, versione) del conto o None, sempre dal DB con una lettura per chiave primaria."""
+    db = SessionLocal.session_factory()
+    try:
+        return db.execute(select(Conto.utente_id, Conto.versione).where(Conto.id == conto_id)).first()
+    finally:
+        db.close()
+
+
+def invalida_conti(*conti_ids):
+    cache.invalida(*(conto_id for conto_id in conti_ids if conto_id is not None))
+
+
+#---- Invalidazione per i movimenti ORM (deposito, bonus, bonifico/pagamento via modelli) ----
+#i conti toccati vengono raccolti a ogni insert e scartati dalla cache solo dopo il commit:
+#prima del commit le altre richieste devono continuare a vedere i dati confermati
+@event.listens_for(Transazione, "after_insert")
+def _segna_conti_modificati(mapper, connection, trans):
+    sessione = Session.object_session(trans)
+    if sessione is not None:
+        sessione.info.setdefault("conti_cache_modificati", set()).update(
+            (trans.conto_mittente_id, trans.conto_destinatario_id)
+        )
+
+
+@event.listens_for(Session, "after_commit")
+def _invalida_dopo_commit(session):
+    conti_ids = session.info.pop("conti_cache_modificati", None)
+    if conti_ids:
+        invalida_conti(*conti_ids)
+
+
+@event.listens_for(Session, "after_rollback")
+def _scarta_dopo_rollback(session):
+    session.info.pop("conti_cache_modificati", None)
@@ -0,0 +1,301 @@
+#coda_movimenti.py applica bonifici e pagamenti tramite un unico thread scrittore.
+#Le richieste vengono messe in coda; lo scrittore le raccoglie a blocchi e le applica in una sola transazione
+#(un solo commit, quindi un solo fsync, per tutto il blocco), controllando il saldo di ogni movimento in memoria
+#a partire dai saldi letti sotto lock. Ogni richiedente riceve l'esito del proprio movimento.
+#Una richiesta con chiave di idempotenza (idempotenza.py) viene applicata solo se la chiave è ancora sua, e la
+#chiave riceve l'id del movimento nello stesso commit: un movimento committato non resta mai senza la sua chiave.
+import os
+import queue
+import threading
+from collections import defaultdict
+from concurrent.futures import Future, TimeoutError as AttesaScaduta
+from decimal import Decimal
+from sqlalchemy import bindparam, insert, or_, select, tuple_, update
+from cache_conti import invalida_conti
+from database import SessionLocal
+from eventi import bacheca
+from models import ChiaveIdempotenza, Conto, TipoTransazione, Transazione
+
+#0 = nessun thread scrittore: il movimento viene applicato subito nel thread chiamante (blocco da uno)
+CODA_ATTIVA = os.environ.get("BANCA_CODA_MOVIMENTI", "1") != "0"
+BLOCCO_MAX = int(os.environ.get("BANCA_CODA_BLOCCO_MAX", "256"))
+ATTESA_ESITO = float(os.environ.get("BANCA_CODA_TIMEOUT", "30")) #secondi
+
+
+class MovimentoRifiutato(ValueError):
+    """Movimento non applicabile; motivo è "conto", "iban", "importo", "saldo", "chiave", "annullato" o "occupato"."""
+
+    def __init__(self, messaggio, motivo):
+        super().__init__(messaggio)
+        self.motivo = motivo
+
+
+class MovimentoInSospeso(Exception):
+    """Esito non arrivato in tempo ma movimento già preso dallo scrittore: può ancora essere applicato."""
+
+
+class Richiesta:
+    __slots__ = ("tipo", "utente_id", "conto_id", "importo", "descrizione", "iban_destinatario", "chiave", "futuro")
+
+    def __init__(self, tipo, utente_id, conto_id, importo, descrizione, iban_destinatario, chiave=None):
+        self.tipo = tipo
+        self.utente_id = utente_id
+        self.conto_id = conto_id
+        self.importo = Decimal(importo)
+        self.descrizione = descrizione
+        self.iban_destinatario = iban_destinatario
+        self.chiave = chiave #(utente_id, chiave, proprietario, scadenza) da idempotenza.chiave_corrente(), o None
+        self.futuro = Future()
+
+
+def _inizia_scrittura(db, conti_ids, ibans):
+    #legge i conti coinvolti dopo aver preso il lock di scrittura, così nessun altro può cambiare i saldi
+    #tra il controllo e l'applicazione: BEGIN IMMEDIATE su SQLite, SELECT ... FOR UPDATE sui server
+    query = select(Conto.id, Conto.iban, Conto.utente_id, Conto.saldo).where(
+        or_(Conto.id.in_(conti_ids), Conto.iban.in_(ibans))
+    )
+    if db.get_bind().dialect.name == "sqlite":
+        db.connection().exec_driver_sql("BEGIN IMMEDIATE")
+    else:
+        query = query.with_for_update()
+    return db.execute(query).all()
+
+
+def _chiavi_possedute(db, richieste):
+    #(utente_id, chiave, proprietario) delle chiavi ancora prenotate da queste richieste e senza movimento, lette
+    #sotto lo stesso lock dei saldi: una chiave scaduta e ripresa da un'altra richiesta non risulta più posseduta
+    chiavi = [r.chiave[:2] for r in richieste if r.chiave is not None]
+    if not chiavi:
+        return set()
+    tabella = ChiaveIdempotenza.__table__
+    query = select(tabella.c.utente_id, tabella.c.chiave, tabella.c.proprietario).where(
+        tuple_(tabella.c.utente_id, tabella.c.chiave).in_(chiavi), tabella.c.movimento_id.is_(None)
+    )
+    if db.get_bind().dialect.name != "sqlite":
+        query = query.with_for_update()
+    return {tuple(riga) for riga in db.execute(query)}
+
+
+def _registra_chiavi(db, accettate, nuove):
+    #movimento e scadenza definitiva della chiave nella stessa transazione del movimento
+    valori = [
+        {"b_utente_id": r.chiave[0], "b_chiave": r.chiave[1], "b_proprietario": r.chiave[2],
+         "b_movimento_id": riga.id, "b_scadenza": r.chiave[3]}
+        for (r, _), riga in zip(accettate, nuove) if r.chiave is not None
+    ]
+    if not valori:
+        return
+    tabella = ChiaveIdempotenza.__table__
+    db.execute(
+        update(tabella)
+        .where(tabella.c.utente_id == bindparam("b_utente_id"), tabella.c.chiave == bindparam("b_chiave"),
+               tabella.c.proprietario == bindparam("b_proprietario"))
+        .values(movimento_id=bindparam("b_movimento_id"), scadenza=bindparam("b_scadenza")),
+        valori,
+    )
+
+
+def _inserisci_transazioni(db, accettate):
+    #(id, data) delle nuove transazioni, nello stesso ordine di accettate
+    transazioni = Transazione.__table__
+    valori = [
+        {
+            "importo": r.importo,
+            "tipo": r.tipo,
+            "descrizione": r.descrizione,
+            "conto_mittente_id": r.conto_id,
+            "conto_destinatario_id": destinatario_id,
+        }
+        for r, destinatario_id in accettate
+    ]
+    if db.get_bind().dialect.name != "sqlite":
+        return db.execute(
+            insert(transazioni).returning(transazioni.c.id, transazioni.c.data, sort_by_parameter_order=True), valori
+        ).all()
+    #su SQLite sort_by_parameter_order ripiega su un INSERT per riga. Qui non serve: siamo sotto BEGIN IMMEDIATE,
+    #quindi nessun altro inserisce, e senza AUTOINCREMENT ogni riga prende max(id) + 1 nell'ordine dei VALUES.
+    #Gli id sono consecutivi e basta ordinarli (RETURNING non garantisce l'ordine delle righe restituite)
+    nuove = sorted(
+        db.execute(insert(transazioni).returning(transazioni.c.id, transazioni.c.data), valori).all(),
+        key=lambda riga: riga.id,
+    )
+    if nuove[-1].id - nuove[0].id != len(nuove) - 1:
+        raise RuntimeError("Id delle transazioni non consecutivi: impossibile associarli ai movimenti.")
+    return nuove
+
+
+def applica_blocco(db, richieste, tutto_o_niente=False):
+    """Applica le richieste in una transazione e restituisce [(richiesta, esito o eccezione)] nello stesso ordine.
+
+    Con tutto_o_niente basta una richiesta rifiutata per annullare tutte le altre.
+    """
+    righe = _inizia_scrittura(
+        db,
+        {r.conto_id for r in richieste},
+        {r.iban_destinatario for r in richieste if r.iban_destinatario},
+    )
+    conti = {r.id: r for r in righe}
+    conti_per_iban = {r.iban: r.id for r in righe}
+    saldi = {r.id: r.saldo for r in righe}
+    chiavi = _chiavi_possedute(db, richieste)
+
+    esiti = {}
+    accettate = []
+    for r in richieste:
+        try:
+            if r.chiave is not None and tuple(r.chiave[:3]) not in chiavi:
+                raise MovimentoRifiutato("Chiave di idempotenza scaduta o usata da un'altra richiesta.", "chiave")
+            mittente = conti.get(r.conto_id)
+            if mittente is None or mittente.utente_id != r.utente_id:
+                raise MovimentoRifiutato("Conto non trovato o non accessibile.", "conto")
+            destinatario_id = None
+            if r.tipo is TipoTransazione.BONIFICO:
+                destinatario_id = conti_per_iban.get(r.iban_destinatario)
+                if destinatario_id is None:
+                    raise MovimentoRifiutato("IBAN destinatario non valido.", "iban")
+            if r.importo <= 0:
+                raise MovimentoRifiutato("L'importo non valido.", "importo")
+            if saldi[r.conto_id] < r.importo:
+                raise MovimentoRifiutato("Saldo insufficiente.", "saldo")
+        except MovimentoRifiutato as e:
+            esiti[id(r)] = e
+            continue
+
+        saldi[r.conto_id] -= r.importo
+        if destinatario_id is not None:
+            saldi[destinatario_id] += r.importo
+        accettate.append((r, destinatario_id))
+
+    if tutto_o_niente and len(accettate) < len(richieste):
+        db.rollback()
+        annullato = MovimentoRifiutato("Annullato: un altro bonifico del gruppo è stato rifiutato.", "annullato")
+        return [(r, esiti.get(id(r), annullato)) for r in richieste]
+
+    if accettate:
+        nuove = _inserisci_transazioni(db, accettate)
+        _registra_chiavi(db, accettate, nuove)
+
+        #un UPDATE per conto con la variazione netta del blocco (gli insert Core non passano dall'evento di models.py)
+        variazioni = defaultdict(Decimal)
+        for r, destinatario_id in accettate:
+            variazioni[r.conto_id] -= r.importo
+            if destinatario_id is not None:
+                variazioni[destinatario_id] += r.importo
+        #anche con variazione zero (bonifico verso lo stesso conto) la versione sale: lo storico è cambiato
+        tabella_conti = Conto.__table__
+        db.execute(
+            update(tabella_conti)
+            .where(tabella_conti.c.id == bindparam("b_conto_id"))
+            .values(saldo=tabella_conti.c.saldo + bindparam("b_variazione"), versione=tabella_conti.c.versione + 1),
+            [{"b_conto_id": conto_id, "b_variazione": v} for conto_id, v in variazioni.items()],
+        )
+
+        for (r, destinatario_id), riga in zip(accettate, nuove):
+            esiti[id(r)] = {
+                "id": riga.id,
+                "importo": r.importo,
+                "tipo": r.tipo,
+                "descrizione": r.descrizione,
+                "data": riga.data,
+                "conto_mittente_id": r.conto_id,
+                "conto_destinatario_id": destinatario_id,
+            }
+
+    db.commit()
+    #gli insert Core non passano dagli eventi ORM: scarto io dalla cache i conti toccati dal blocco
+    invalida_conti(*{conto_id for r, destinatario_id in accettate for conto_id in (r.conto_id, destinatario_id)})
+    for r, _ in accettate:
+        bacheca.pubblica_movimento(**esiti[id(r)])
+    return [(r, esiti[id(r)]) for r in richieste]
+
+
+class CodaMovimenti:
+    def __init__(self, blocco_max=BLOCCO_MAX):
+        self.blocco_max = blocco_max
+        self._coda = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _avvia(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._scrittore, name="scrittore-movimenti", daemon=True)
+                self._thread.start()
+
+    def invia(self, richiesta):
+        if self._thread is None:
+            self._avvia()
+        self._coda.put(richiesta)
+        return richiesta.futuro
+
+    def _prossimo_blocco(self):
+        #attende la prima richiesta, poi prende tutte quelle già in coda: mentre un blocco viene scritto
+        #le nuove richieste si accumulano e finiscono insieme nel commit successivo
+        #le richieste annullate dal richiedente (attesa scaduta) vengono scartate; le altre passano a "in esecuzione"
+        #e da qui non si possono più annullare
+        blocco = [self._coda.get()]
+        while len(blocco) < self.blocco_max:
+            try:
+                blocco.append(self._coda.get_nowait())
+            except queue.Empty:
+                break
+        return [r for r in blocco if r.futuro.set_running_or_notify_cancel()]
+
+    def _scrittore(self):
+        while True:
+            blocco = self._prossimo_blocco()
+            if not blocco:
+                continue
+            db = SessionLocal.session_factory()
+            try:
+                esiti = applica_blocco(db, blocco)
+            except Exception as e:
+                db.rollback()
+                print("❌ ERRORE scrittore movimenti:", e)
+                for r in blocco:
+                    r.futuro.set_exception(e)
+                continue
+            finally:
+                db.close()
+            for r, esito in esiti:
+                if isinstance(esito, Exception):
+                    r.futuro.set_exception(esito)
+                else:
+                    r.futuro.set_result(esito)
+
+
+coda = CodaMovimenti()
+
+
+def esegui_movimento(tipo, utente_id, conto_id, importo, descrizione, iban_destinatario=None, chiave=None):
+    """Applica un bonifico o un pagamento e restituisce i dati della transazione.
+
+    chiave è la prenotazione della chiave di idempotenza della richiesta (idempotenza.chiave_corrente()), se c'è.
+
+    Solleva MovimentoRifiutato se il movimento non è stato applicato, MovimentoInSospeso se l'esito non è arrivato
+    entro ATTESA_ESITO ma lo scrittore lo sta già applicando.
+    """
+    richiesta = Richiesta(tipo, utente_id, conto_id, importo, descrizione, iban_destinatario, chiave)
+    if not CODA_ATTIVA:
+        db = SessionLocal.session_factory()
+        try:
+            (_, esito), = applica_blocco(db, [richiesta])
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+    else:
+        futuro = coda.invia(richiesta)
+        try:
+            esito = futuro.result(timeout=ATTESA_ESITO)
+        except AttesaScaduta:
+            #ancora in coda: l'annullamento è atomico rispetto al prelievo dello scrittore, quindi non verrà mai applicato
+            if futuro.cancel():
+                raise MovimentoRifiutato("Troppi movimenti in attesa, riprova tra poco.", "occupato") from None
+            if not futuro.done():
+                raise MovimentoInSospeso("Movimento in elaborazione: controlla i movimenti del conto prima di riprovare.") from None
+            esito = futuro.result()
+    if isinstance(esito, Exception):
+        raise esito
+    return esito
@@ -0,0 +1,43 @@
+#codici.py trasforma il numero progressivo di una sequenza in un codice a 6 cifre (codice titolare, conto dell'IBAN).
+#La trasformazione è una permutazione con chiave (rete di Feistel su 1000 x 1000): numeri diversi danno sempre
+#codici diversi, quindi non servono controlli di unicità, ma senza la chiave i codici non sono prevedibili.
+import hashlib
+import hmac
+
+DOMINIO = 1000 * 1000 #codici da 000001 a 999999 (lo 000000 viene saltato)
+_META = 1000
+_GIRI = 4
+
+
+def _f(chiave, giro, valore):
+    digest = hmac.new(chiave.encode(), f"{giro}:{valore}".encode(), hashlib.sha256).digest()
+    return int.from_bytes(digest[:4], "big") % _META
+
+
+def _feistel(n, chiave):
+    sinistra, destra = divmod(n, _META)
+    for giro in range(_GIRI):
+        sinistra, destra = destra, (sinistra + _f(chiave, giro, destra)) % _META
+    return sinistra * _META + destra
+
+
+def _feistel_inversa(n, chiave):
+    sinistra, destra = divmod(n, _META)
+    for giro in reversed(range(_GIRI)):
+        sinistra, destra = (destra - _f(chiave, giro, sinistra)) % _META, sinistra
+    return sinistra * _META + destra
+
+
+def permuta(n, chiave):
+    #n in 1..999999 -> codice in 1..999999; se esce 0 riapplico la permutazione (cycle walking)
+    codice = _feistel(n, chiave)
+    while codice == 0:
+        codice = _feistel(codice, chiave)
+    return codice
+
+
+def inverti(codice, chiave):
+    n = _feistel_inversa(codice, chiave)
+    while n == 0:
+        n = _feistel_inversa(n, chiave)
+    return n
@@ -1,9 +1,73 @@
-from sqlalchemy import create_engine
+import os
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, declarative_base, scoped_session
+from query_lente import collega_se_attivo
 
 # Connessione (da cambiare echo=False prima di consegnare)
-DATABASE_URL = "sqlite:///db_banca.db"
-engine = create_engine(DATABASE_URL, echo=False, connect_args={"check_same_thread": False})#check è per sqlite in modo da gestire più thread in app
+DATABASE_URL = os.environ.get("BANCA_DATABASE_URL", "sqlite:///db_banca.db")
+
+# Profilo del motore:
+#  - "sviluppo": SQLite con le impostazioni predefinite (comportamento originale)
+#  - "sqlite":   SQLite per la produzione, con WAL (i lettori non bloccano lo scrittore) e attesa sui lock
+#  - "server":   database server (es. PostgreSQL) con pool di connessioni dimensionato esplicitamente
+PROFILO_DB = os.environ.get("BANCA_DB_PROFILO", "sviluppo")
+
+PRAGMA_SQLITE = {
+    "journal_mode": "WAL",
+    "synchronous": os.environ.get("BANCA_SQLITE_SYNCHRONOUS", "NORMAL"), #con WAL resta consistente anche dopo un crash
+    "cache_size": -int(os.environ.get("BANCA_SQLITE_CACHE_KB", "65536")), #valore negativo = KiB
+    "mmap_size": int(os.environ.get("BANCA_SQLITE_MMAP_MB", "256")) * 1024 * 1024,
+    "busy_timeout": int(os.environ.get("BANCA_SQLITE_BUSY_TIMEOUT_MS", "5000")), #attende invece di "database is locked"
+}
+
+POOL_SERVER = {
+    "pool_size": int(os.environ.get("BANCA_DB_POOL_SIZE", "10")),
+    "max_overflow": int(os.environ.get("BANCA_DB_MAX_OVERFLOW", "20")),
+    "pool_timeout": int(os.environ.get("BANCA_DB_POOL_TIMEOUT", "10")),
+    "pool_recycle": int(os.environ.get("BANCA_DB_POOL_RECYCLE", "1800")), #secondi, prima dei timeout lato server
+    "pool_pre_ping": True, #scarta le connessioni chiuse dal server prima di usarle
+}
+
+
+def _imposta_pragma(connessione_dbapi, record):
+    #eseguito su ogni nuova connessione del pool: i PRAGMA valgono per la singola connessione
+    cursore = connessione_dbapi.cursor()
+    for nome, valore in PRAGMA_SQLITE.items():
+        cursore.execute(f"PRAGMA {nome}={valore}")
+    cursore.close()
+
+
+def crea_engine(profilo=PROFILO_DB, url=DATABASE_URL, echo=False):
+    if profilo == "sviluppo":
+        return create_engine(url, echo=echo, connect_args={"check_same_thread": False})#check è per sqlite in modo da gestire più thread in app
+
+    if profilo == "sqlite":
+        motore = create_engine(url, echo=echo, connect_args={"check_same_thread": False})
+        event.listen(motore, "connect", _imposta_pragma)
+        return motore
+
+    if profilo == "server":
+        return create_engine(url, echo=echo, **POOL_SERVER)
+
+    raise ValueError(f"Profilo database sconosciuto: {profilo}")
+
+
+def crea_engine_async(profilo=PROFILO_DB, url=DATABASE_URL):
+    #motore asincrono per app_async.py (richiede sqlalchemy[asyncio] e aiosqlite, o il driver async del server);
+    #l'URL è lo stesso di DATABASE_URL con il driver asincrono, oppure BANCA_DATABASE_URL_ASYNC se indicato
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    url = os.environ.get("BANCA_DATABASE_URL_ASYNC") or url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    if profilo == "server":
+        return create_async_engine(url, **POOL_SERVER)
+    motore = create_async_engine(url)
+    if profilo == "sqlite":
+        event.listen(motore.sync_engine, "connect", _imposta_pragma)
+    return motore
+
+
+engine = crea_engine()
+collega_se_attivo(engine) #registro delle query lente, solo con BANCA_QUERY_LENTE_MS
 
 #scoped_session assicura che ogni thread (o contesto) ottenga la propria Session isolata. In Flask questo impedisce che due richieste condividano la stessa sessione.
 SessionLocal = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
@@ -16,4 +80,4 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
@@ -0,0 +1,244 @@
+#eventi.py distribuisce i nuovi movimenti a chi è in ascolto su un conto (flusso Server-Sent Events).
+#I movimenti vengono pubblicati dopo il commit, sia dai modelli (eventi di sessione) sia da coda_movimenti.
+#Ogni iscritto ha un buffer limitato: se si riempie (client lento) o un evento arriva senza dati completi,
+#l'iscritto viene segnato "da recuperare" e rilegge dal DB i movimenti successivi all'ultimo inviato.
+#Un iscritto fermo non occupa risorse oltre al buffer e a una Condition: nessun thread dedicato, ma su app.py (WSGI)
+#ogni flusso aperto tiene occupato un thread del server. app_async.py serve lo stesso flusso con flusso_eventi_async:
+#lì l'iscrizione sveglia il loop asyncio e un flusso aperto costa solo una coroutine.
+import asyncio
+import json
+import os
+import threading
+from collections import deque
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+from database import SessionLocal
+from models import Transazione
+from storico import PAGINA_TRANSAZIONI_MAX, movimenti_successivi
+
+BUFFER_ISCRITTO = int(os.environ.get("BANCA_SSE_BUFFER", "100")) #eventi in attesa per iscritto
+ISCRITTI_MAX = int(os.environ.get("BANCA_SSE_ISCRITTI_MAX", "5000")) #per processo
+KEEPALIVE = float(os.environ.get("BANCA_SSE_KEEPALIVE", "15")) #secondi tra due commenti di keepalive
+
+
+class TroppiIscritti(Exception):
+    """Raggiunto il numero massimo di flussi aperti nel processo."""
+
+
+def evento_movimento(id, data, importo, tipo, descrizione, conto_mittente_id, conto_destinatario_id, uscita):
+    #stessi campi di /api/conti/<id>/transazioni
+    return {
+        "id": id,
+        "importo": float(importo),
+        "tipo": tipo.value,
+        "descrizione": descrizione,
+        "data": data.isoformat(),
+        "uscita": uscita,
+        "conto_mittente_id": conto_mittente_id,
+        "conto_destinatario_id": conto_destinatario_id,
+    }
+
+
+class Iscrizione:
+    def __init__(self, conto_id, loop=None):
+        self.conto_id = conto_id
+        self._buffer = deque()
+        self._da_recuperare = False
+        self._condizione = threading.Condition()
+        #iscrizioni asyncio: chi pubblica può essere un altro thread, quindi la sveglia passa da call_soon_threadsafe
+        self._loop = loop
+        self._sveglia = asyncio.Event() if loop is not None else None
+
+    def consegna(self, evento):
+        #chiamato da chi pubblica: non blocca mai
+        with self._condizione:
+            if evento is None or len(self._buffer) >= BUFFER_ISCRITTO:
+                #buffer pieno o evento incompleto: scarto e faccio rileggere dal DB
+                self._buffer.clear()
+                self._da_recuperare = True
+            else:
+                self._buffer.append(evento)
+            self._condizione.notify()
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._sveglia.set)
+            except RuntimeError:
+                pass #loop già chiuso: il flusso non c'è più
+
+    def attendi(self, timeout):
+        """Restituisce (eventi, da_recuperare) appena c'è qualcosa, o ([], False) allo scadere del timeout."""
+        with self._condizione:
+            if not self._buffer and not self._da_recuperare:
+                self._condizione.wait(timeout)
+            eventi = list(self._buffer)
+            self._buffer.clear()
+            da_recuperare, self._da_recuperare = self._da_recuperare, False
+            return eventi, da_recuperare
+
+    async def attendi_async(self, timeout):
+        """Come attendi, ma sospende la coroutine invece del thread (solo per iscrizioni create con un loop)."""
+        try:
+            await asyncio.wait_for(self._sveglia.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        #la sveglia va spenta prima di leggere il buffer: un evento consegnato nel frattempo la riaccende
+        self._sveglia.clear()
+        return self.attendi(0)
+
+
+class Bacheca:
+    def __init__(self):
+        self._iscritti = {} #conto_id -> set di Iscrizione
+        self._totale = 0
+        self._lock = threading.Lock()
+
+    def iscrivi(self, conto_id, loop=None):
+        iscrizione = Iscrizione(conto_id, loop)
+        with self._lock:
+            if self._totale >= ISCRITTI_MAX:
+                raise TroppiIscritti("Troppi flussi di eventi aperti. Riprovare più tardi.")
+            self._iscritti.setdefault(conto_id, set()).add(iscrizione)
+            self._totale += 1
+        return iscrizione
+
+    def disiscrivi(self, iscrizione):
+        with self._lock:
+            iscritti = self._iscritti.get(iscrizione.conto_id)
+            if iscritti and iscrizione in iscritti:
+                iscritti.discard(iscrizione)
+                self._totale -= 1
+                if not iscritti:
+                    del self._iscritti[iscrizione.conto_id]
+
+    def pubblica(self, conto_id, evento):
+        with self._lock:
+            iscritti = tuple(self._iscritti.get(conto_id, ()))
+        for iscrizione in iscritti:
+            iscrizione.consegna(evento)
+
+    def pubblica_movimento(self, id, data, importo, tipo, descrizione, conto_mittente_id, conto_destinatario_id):
+        #un movimento genera un evento per il mittente (uscita) e uno per il destinatario (entrata)
+        if not self._iscritti:
+            return
+        dati = (id, data, importo, tipo, descrizione, conto_mittente_id, conto_destinatario_id)
+        completo = all(valore is not None for valore in (id, data, importo, tipo))
+        if conto_mittente_id is not None:
+            self.pubblica(conto_mittente_id, evento_movimento(*dati, True) if completo else None)
+        if conto_destinatario_id is not None and conto_destinatario_id != conto_mittente_id:
+            self.pubblica(conto_destinatario_id, evento_movimento(*dati, False) if completo else None)
+
+    def iscritti(self):
+        with self._lock:
+            return self._totale
+
+
+bacheca = Bacheca()
+
+
+def _formatta(evento):
+    return f"id: {evento['id']}\nevent: movimento\ndata: {json.dumps(evento)}\n\n"
+
+
+def _recupera(conto_id, dopo_id):
+    db = SessionLocal.session_factory()
+    try:
+        while True:
+            righe = movimenti_successivi(db, conto_id, dopo_id)
+            for riga, uscita in righe:
+                yield evento_movimento(*riga[:7], uscita)
+                dopo_id = riga.id
+            if len(righe) < PAGINA_TRANSAZIONI_MAX:
+                return
+    finally:
+        db.close()
+
+
+def ultimo_movimento_id():
+    """Id dell'ultimo movimento committato: il punto di partenza di un nuovo client, da leggere prima di iscriversi."""
+    db = SessionLocal.session_factory()
+    try:
+        return db.execute(select(func.max(Transazione.id))).scalar() or 0
+    finally:
+        db.close()
+
+
+def flusso_eventi(iscrizione, ultimo_id):
+    """Generatore del testo SSE per un'iscrizione già aperta; ultimo_id è il Last-Event-ID del client.
+
+    Per un nuovo client ultimo_id va letto con ultimo_movimento_id prima di iscriversi: un movimento committato tra
+    la lettura e l'iscrizione viene ritrovato dal recupero, uno committato dopo è già nel buffer.
+    """
+    try:
+        #l'iscrizione è già aperta prima di rileggere: i movimenti committati durante il recupero restano nel buffer
+        for evento in _recupera(iscrizione.conto_id, ultimo_id):
+            ultimo_id = evento["id"]
+            yield _formatta(evento)
+        yield ": connesso\n\n"
+
+        while True:
+            eventi, da_recuperare = iscrizione.attendi(KEEPALIVE)
+            if da_recuperare:
+                eventi = list(_recupera(iscrizione.conto_id, ultimo_id))
+            if not eventi:
+                yield ": keepalive\n\n" #tiene aperta la connessione e fa notare al server i client disconnessi
+                continue
+            for evento in eventi:
+                if evento["id"] <= ultimo_id:
+                    continue #già inviato dal recupero
+                ultimo_id = evento["id"]
+                yield _formatta(evento)
+    finally:
+        bacheca.disiscrivi(iscrizione)
+
+
+async def flusso_eventi_async(iscrizione, ultimo_id):
+    """Come flusso_eventi per app_async.py: le letture dal DB vanno in un thread, l'attesa non ne occupa nessuno."""
+    try:
+        for evento in await asyncio.to_thread(lambda: list(_recupera(iscrizione.conto_id, ultimo_id))):
+            ultimo_id = evento["id"]
+            yield _formatta(evento)
+        yield ": connesso\n\n"
+
+        while True:
+            eventi, da_recuperare = await iscrizione.attendi_async(KEEPALIVE)
+            if da_recuperare:
+                dopo_id = ultimo_id
+                eventi = await asyncio.to_thread(lambda: list(_recupera(iscrizione.conto_id, dopo_id)))
+            if not eventi:
+                yield ": keepalive\n\n"
+                continue
+            for evento in eventi:
+                if evento["id"] <= ultimo_id:
+                    continue
+                ultimo_id = evento["id"]
+                yield _formatta(evento)
+    finally:
+        bacheca.disiscrivi(iscrizione)
+
+
+#---- Pubblicazione dei movimenti ORM (bonus di registrazione, depositi, bonifici via modelli) ----
+@event.listens_for(Transazione, "after_insert")
+def _raccogli_movimento(mapper, connection, trans):
+    sessione = Session.object_session(trans)
+    if sessione is not None and bacheca.iscritti():
+        #data arriva dal DB: se il dialetto non la restituisce con l'insert l'evento sarà incompleto (e riletto)
+        sessione.info.setdefault("movimenti_da_pubblicare", []).append((
+            trans.id,
+            trans.__dict__.get("data"),
+            trans.importo,
+            trans.tipo,
+            trans.descrizione,
+            trans.conto_mittente_id,
+            trans.conto_destinatario_id,
+        ))
+
+
+@event.listens_for(Session, "after_commit")
+def _pubblica_dopo_commit(session):
+    for movimento in session.info.pop("movimenti_da_pubblicare", ()):
+        bacheca.pubblica_movimento(*movimento)
+
+
+@event.listens_for(Session, "after_rollback")
+def _scarta_dopo_rollback(session):
+    session.info.pop("movimenti_da_pubblicare", None)
@@ -0,0 +1,307 @@
+#genera_dati.py popola un database vuoto con utenti, conti e transazioni sintetici per le prove di carico.
+#Uso: python genera_dati.py [--utenti 200000] [--transazioni 10000000] [--anni 5] [--seme 42] [--blocco 50000]
+#Il risultato dipende solo dal seme e dai parametri: due esecuzioni uguali producono lo stesso database
+#(stessi id, codici, date e importi), così i benchmark restano confrontabili.
+#Distribuzioni:
+# - i conti vengono aperti nel corso degli anni (un utente su cinque ne apre più di uno), ognuno con il bonus di benvenuto;
+# - l'attività per conto segue una legge di potenza (Pareto): pochi conti fanno la maggior parte dei movimenti;
+# - i movimenti sono in ordine cronologico e crescono con il numero di conti aperti; un addebito che supera
+#   il saldo diventa un deposito, quindi nessun saldo va mai sotto zero.
+#Tutti gli utenti sintetici hanno PIN 135790: gli hash bcrypt sono calcolati una volta sola e riusati.
+import argparse
+import base64
+import bisect
+import hashlib
+import math
+import random
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+import bcrypt
+from sqlalchemy import bindparam, func, insert, select, update
+from database import Base, SessionLocal, engine
+from hash_pin import BCRYPT_COSTO
+from migrazioni import applica_migrazioni
+from models import Conto, Lavoro, Sequenza, TipoTransazione, Transazione, Utente
+
+PIN_SINTETICO = "135790"
+HASH_DISTINTI = 8 #hash diversi (stesso PIN, sale diverso) distribuiti tra gli utenti
+FINE_PREDEFINITA = "2025-12-31"
+ESPONENTE_ATTIVITA = 1.16 #Pareto 80/20
+BLOCCHI_TEMPORALI = 1000 #la finestra temporale è divisa in intervalli generati uno dopo l'altro
+
+NOMI = ["Marco", "Giulia", "Luca", "Francesca", "Andrea", "Chiara", "Matteo", "Sara", "Alessandro", "Elena",
+        "Davide", "Martina", "Simone", "Laura", "Federico", "Valentina", "Roberto", "Anna", "Giorgio", "Paola"]
+COGNOMI = ["Rossi", "Russo", "Ferrari", "Esposito", "Bianchi", "Romano", "Colombo", "Ricci", "Marino", "Greco",
+           "Bruno", "Gallo", "Conti", "De Luca", "Mancini", "Costa", "Giordano", "Rizzo", "Lombardi", "Moretti"]
+
+#(tipo, peso) dei movimenti generati, oltre ai bonus di benvenuto
+TIPI = [
+    (TipoTransazione.PAGAMENTO, 40),
+    (TipoTransazione.BONIFICO, 30),
+    (TipoTransazione.DEPOSITO, 16),
+    (TipoTransazione.PRELIEVO, 12),
+    (TipoTransazione.BONUS, 2),
+]
+#importi in centesimi: (mediana, dispersione) di una lognormale
+IMPORTI = {
+    TipoTransazione.PAGAMENTO: (3500, 0.9),
+    TipoTransazione.BONIFICO: (8000, 1.0),
+    TipoTransazione.DEPOSITO: (30000, 0.8),
+    TipoTransazione.PRELIEVO: (10000, 0.6),
+    TipoTransazione.BONUS: (2000, 0.5),
+}
+DESCRIZIONI = {
+    TipoTransazione.PAGAMENTO: ["Supermercato", "Carburante", "Ristorante", "Farmacia", "Abbonamento", "Acquisto online"],
+    TipoTransazione.BONIFICO: ["Affitto", "Rimborso", "Regalo", "Quota condominio", "Cena"],
+    TipoTransazione.DEPOSITO: ["Deposito da ATM"],
+    TipoTransazione.PRELIEVO: ["Prelievo da ATM"],
+    TipoTransazione.BONUS: ["Cashback"],
+}
+BONUS_BENVENUTO = 10000 #centesimi, come in registrazione
+
+
+def _sale(rng):
+    #sale bcrypt deterministico: 16 byte in base64 con l'alfabeto di bcrypt
+    standard = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+    alfabeto = "./ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
+    testo = base64.b64encode(rng.getrandbits(128).to_bytes(16, "big")).decode()[:22]
+    return f"$2b${BCRYPT_COSTO:02d}${testo.translate(str.maketrans(standard, alfabeto))}".encode()
+
+
+def hash_precalcolati(rng):
+    return [bcrypt.hashpw(PIN_SINTETICO.encode(), _sale(rng)).decode() for _ in range(HASH_DISTINTI)]
+
+
+def _secondi_casuali(rng, inizio, fine):
+    return inizio + int(rng.random() * (fine - inizio))
+
+
+def _importo(rng, tipo):
+    mediana, dispersione = IMPORTI[tipo]
+    return max(100, int(mediana * math.exp(dispersione * rng.gauss(0, 1))))
+
+
+def _centesimi(valore):
+    return Decimal(valore).scaleb(-2)
+
+
+def prepara_database(db, seme):
+    if db.execute(select(func.count()).select_from(Utente)).scalar():
+        raise SystemExit("❌ Il database contiene già utenti: genera_dati.py va eseguito su un database vuoto.")
+    lavori = list(db.execute(select(Lavoro.id).order_by(Lavoro.id)).scalars())
+    if not lavori:
+        raise SystemExit("❌ Nessun lavoro presente: eseguire prima python lavori.py.")
+    #chiavi delle sequenze ricavate dal seme (solo se non hanno ancora prodotto codici): stessi codici a ogni esecuzione
+    sequenze = Sequenza.__table__
+    for nome in ("codice_titolare", "iban"):
+        db.execute(
+            update(sequenze)
+            .where(sequenze.c.nome == nome, sequenze.c.valore == 0)
+            .values(chiave=hashlib.sha256(f"{seme}:{nome}".encode()).hexdigest()[:32])
+        )
+    db.commit()
+    return lavori
+
+
+def genera_utenti_e_conti(db, rng, numero_utenti, lavori, inizio, fine, blocco):
+    """Inserisce utenti e conti; restituisce i secondi di apertura dei conti, in ordine di id."""
+    hash_utenti = hash_precalcolati(rng)
+    codici_titolare = Sequenza.riserva_codici(db, "codice_titolare", numero_utenti)
+
+    #utenti in ordine di registrazione; un utente su cinque apre altri conti più avanti
+    registrazioni = sorted(_secondi_casuali(rng, inizio, fine) for _ in range(numero_utenti))
+    aperture = []
+    for utente_id, registrazione in enumerate(registrazioni, start=1):
+        aperture.append((registrazione, utente_id))
+        if rng.random() < 0.2:
+            for _ in range(1 if rng.random() < 0.75 else 2):
+                aperture.append((_secondi_casuali(rng, registrazione, fine), utente_id))
+    aperture.sort()
+    iban = Sequenza.riserva_codici(db, "iban", len(aperture))
+
+    for primo in range(0, numero_utenti, blocco):
+        db.execute(insert(Utente.__table__), [
+            {
+                "id": utente_id,
+                "nome": rng.choice(NOMI),
+                "cognome": rng.choice(COGNOMI),
+                "codice_fiscale": f"SNT{utente_id:013d}",
+                "codice_titolare": f"CT{codici_titolare[utente_id - 1]:06d}",
+                "pin_hash": hash_utenti[utente_id % HASH_DISTINTI],
+                "lavoro_id": rng.choice(lavori),
+            }
+            for utente_id in range(primo + 1, min(primo + blocco, numero_utenti) + 1)
+        ])
+    base = datetime.fromisoformat(FINE_PREDEFINITA) #solo per convertire i secondi in date
+    for primo in range(0, len(aperture), blocco):
+        db.execute(insert(Conto.__table__), [
+            {
+                "id": conto_id,
+                "iban": f"IT123456{iban[conto_id - 1]:06d}",
+                "data_creazione": base + timedelta(seconds=aperture[conto_id - 1][0]),
+                "saldo": 0,
+                "versione": 0,
+                "utente_id": aperture[conto_id - 1][1],
+            }
+            for conto_id in range(primo + 1, min(primo + blocco, len(aperture)) + 1)
+        ])
+    db.commit()
+    print(f"  {numero_utenti} utenti e {len(aperture)} conti")
+    return [secondi for secondi, _ in aperture]
+
+
+def genera_transazioni(db, rng, aperture, numero_transazioni, inizio, fine, blocco):
+    """Inserisce le transazioni in ordine cronologico; restituisce (saldi, versioni) per conto in centesimi."""
+    numero_conti = len(aperture)
+    saldi = [0] * numero_conti
+    versioni = [0] * numero_conti
+    #peso di attività per conto e pesi cumulati: scegliere tra i primi k conti = bisect su cumulati[k-1]
+    cumulati = []
+    totale = 0.0
+    for _ in range(numero_conti):
+        totale += rng.paretovariate(ESPONENTE_ATTIVITA)
+        cumulati.append(totale)
+    tipi = [tipo for tipo, _ in TIPI]
+    pesi_tipi = [peso for _, peso in TIPI]
+
+    #i movimenti di ogni intervallo sono proporzionali ai conti già aperti
+    durata = (fine - inizio) / BLOCCHI_TEMPORALI
+    confini = [inizio + int(durata * k) for k in range(BLOCCHI_TEMPORALI)] + [fine]
+    aperti = [bisect.bisect_right(aperture, (confini[k] + confini[k + 1]) // 2) for k in range(BLOCCHI_TEMPORALI)]
+    casuali = max(0, numero_transazioni - numero_conti)
+    quote = [casuali * a // max(1, sum(aperti)) for a in aperti]
+    quote[-1] += casuali - sum(quote)
+
+    base = datetime.fromisoformat(FINE_PREDEFINITA)
+    tabella = Transazione.__table__
+    righe = []
+    prossimo_id = 1
+    prossimo_bonus = 0 #primo conto che non ha ancora ricevuto il bonus
+
+    def scrivi():
+        db.execute(insert(tabella), righe)
+        db.commit()
+        righe.clear()
+
+    for k in range(BLOCCHI_TEMPORALI):
+        eventi = []
+        #bonus di benvenuto dei conti aperti in questo intervallo (sono già in ordine di apertura)
+        while prossimo_bonus < numero_conti and aperture[prossimo_bonus] < confini[k + 1]:
+            eventi.append((aperture[prossimo_bonus], prossimo_bonus))
+            prossimo_bonus += 1
+        for _ in range(quote[k]):
+            eventi.append((_secondi_casuali(rng, confini[k], confini[k + 1]), None))
+        eventi.sort(key=lambda e: e[0])
+
+        for secondi, conto_bonus in eventi:
+            if conto_bonus is not None:
+                tipo, mittente, destinatario, importo = TipoTransazione.BONUS, None, conto_bonus, BONUS_BENVENUTO
+                descrizione = "Bonus benvenuto nuovo conto"
+            else:
+                disponibili = bisect.bisect_right(aperture, secondi)
+                if disponibili == 0:
+                    continue
+                conto = bisect.bisect_left(cumulati, rng.random() * cumulati[disponibili - 1])
+                tipo = rng.choices(tipi, pesi_tipi)[0]
+                importo = _importo(rng, tipo)
+                descrizione = rng.choice(DESCRIZIONI[tipo])
+                if tipo in (TipoTransazione.PAGAMENTO, TipoTransazione.PRELIEVO, TipoTransazione.BONIFICO) \
+                        and saldi[conto] < importo:
+                    tipo, descrizione = TipoTransazione.DEPOSITO, DESCRIZIONI[TipoTransazione.DEPOSITO][0]
+                mittente = destinatario = None
+                if tipo is TipoTransazione.BONIFICO:
+                    mittente = conto
+                    destinatario = bisect.bisect_left(cumulati, rng.random() * cumulati[disponibili - 1])
+                    if destinatario == conto:
+                        destinatario = (conto + 1) % disponibili
+                elif tipo in (TipoTransazione.PAGAMENTO, TipoTransazione.PRELIEVO):
+                    mittente = conto
+                else:
+                    destinatario = conto
+
+            if mittente is not None:
+                saldi[mittente] -= importo
+                versioni[mittente] += 1
+            if destinatario is not None:
+                saldi[destinatario] += importo
+                versioni[destinatario] += 1
+            righe.append({
+                "id": prossimo_id,
+                "importo": _centesimi(importo),
+                "data": base + timedelta(seconds=secondi),
+                "descrizione": descrizione,
+                "tipo": tipo,
+                "conto_mittente_id": None if mittente is None else mittente + 1,
+                "conto_destinatario_id": None if destinatario is None else destinatario + 1,
+            })
+            prossimo_id += 1
+            if len(righe) >= blocco:
+                scrivi()
+        if k % (BLOCCHI_TEMPORALI // 10) == 0:
+            print(f"  {prossimo_id - 1} transazioni ({k * 100 // BLOCCHI_TEMPORALI}% del periodo)")
+    if righe:
+        scrivi()
+    print(f"  {prossimo_id - 1} transazioni")
+    return saldi, versioni
+
+
+def aggiorna_saldi(db, saldi, versioni, blocco):
+    conti = Conto.__table__
+    for primo in range(0, len(saldi), blocco):
+        db.execute(
+            update(conti)
+            .where(conti.c.id == bindparam("b_conto_id"))
+            .values(saldo=bindparam("b_saldo"), versione=bindparam("b_versione")),
+            [
+                {"b_conto_id": i + 1, "b_saldo": _centesimi(saldi[i]), "b_versione": versioni[i]}
+                for i in range(primo, min(primo + blocco, len(saldi)))
+            ],
+        )
+    db.commit()
+
+
+def genera(utenti, transazioni, anni, seme, blocco):
+    rng = random.Random(seme)
+    #le date sono in secondi relativi alla fine del periodo (negativi = passato)
+    inizio, fine = -int(anni * 365 * 86400), 0
+    Base.metadata.create_all(bind=engine)
+    applica_migrazioni(engine)
+
+    db = SessionLocal()
+    indici = list(Transazione.__table__.indexes)
+    try:
+        if engine.dialect.name == "sqlite":
+            #caricamento iniziale: se si interrompe si rigenera da capo, quindi niente fsync a ogni commit
+            db.connection().exec_driver_sql("PRAGMA synchronous=OFF")
+        lavori = prepara_database(db, seme)
+        partenza = time.perf_counter()
+        print(f"Generazione con seme {seme}...")
+        aperture = genera_utenti_e_conti(db, rng, utenti, lavori, inizio, fine, blocco)
+
+        #gli indici dello storico si ricostruiscono una volta alla fine: molto più veloce che aggiornarli riga per riga
+        for indice in indici:
+            indice.drop(db.connection())
+        db.commit()
+        saldi, versioni = genera_transazioni(db, rng, aperture, transazioni, inizio, fine, blocco)
+        aggiorna_saldi(db, saldi, versioni, blocco)
+        for indice in indici:
+            indice.create(db.connection())
+        db.commit()
+        print(f"✔️ Dati generati in {time.perf_counter() - partenza:.0f}s (PIN degli utenti: {PIN_SINTETICO}).")
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dati sintetici deterministici per le prove di carico")
+    parser.add_argument("--utenti", type=int, default=200000, help="al massimo 999999 (codici a 6 cifre)")
+    parser.add_argument("--transazioni", type=int, default=10000000, help="compresi i bonus di benvenuto")
+    parser.add_argument("--anni", type=float, default=5, help="periodo coperto, fino al " + FINE_PREDEFINITA)
+    parser.add_argument("--seme", type=int, default=42)
+    parser.add_argument("--blocco", type=int, default=50000, help="righe per insert e per commit")
+    argomenti = parser.parse_args()
+    genera(argomenti.utenti, argomenti.transazioni, argomenti.anni, argomenti.seme, argomenti.blocco)
@@ -0,0 +1,108 @@
+#hash_pin.py esegue il lavoro di bcrypt (hash e verifica dei PIN) in un pool di processi dedicato,
+#dimensionato a parte rispetto ai thread che servono le richieste: un picco di login non blocca le altre pagine.
+import asyncio
+import atexit
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import bcrypt
+from metriche import aggiungi_bcrypt
+
+#fattore di costo di bcrypt per i nuovi hash; se cambia, i PIN vengono riletti e aggiornati al login successivo
+BCRYPT_COSTO = int(os.environ.get("BANCA_BCRYPT_COSTO", "12"))
+#processi dedicati a bcrypt (0 = calcolo direttamente nel thread della richiesta, utile negli script)
+PIN_WORKER = int(os.environ.get("BANCA_PIN_WORKER", str(max(1, (os.cpu_count() or 2) // 2))))
+#richieste che possono attendere un processo libero prima di rispondere subito "servizio occupato"
+PIN_CODA_MAX = int(os.environ.get("BANCA_PIN_CODA_MAX", "32"))
+
+
+class ServizioPinOccupato(Exception):
+    """Il pool di bcrypt ha già troppe richieste in coda."""
+
+
+def _hashpw(pin_bytes, costo):
+    return bcrypt.hashpw(pin_bytes, bcrypt.gensalt(rounds=costo))
+
+
+def _checkpw(pin_bytes, hash_bytes):
+    return bcrypt.checkpw(pin_bytes, hash_bytes)
+
+
+_pool = None
+_posti = threading.BoundedSemaphore(PIN_WORKER + PIN_CODA_MAX)
+_lock_pool = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _lock_pool:
+        if _pool is None:
+            #fork dove disponibile: i figli non rieseguono lo script principale (spawn lo reimporterebbe)
+            metodo = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+            _pool = ProcessPoolExecutor(max_workers=PIN_WORKER, mp_context=multiprocessing.get_context(metodo))
+            atexit.register(_pool.shutdown, wait=False, cancel_futures=True)
+        return _pool
+
+
+def avvia_pool():
+    #da chiamare all'avvio dell'app, prima che partano i thread delle richieste: con fork i processi
+    #vengono creati tutti alla prima richiesta, quindi li creo subito da un processo ancora senza thread
+    if PIN_WORKER > 0:
+        _get_pool().submit(costo_hash, f"$2b${BCRYPT_COSTO}$").result()
+
+
+def _invia(funzione, *args):
+    #restituisce il Future del pool senza attenderlo; il posto si libera quando il calcolo finisce
+    if not _posti.acquire(blocking=False):
+        raise ServizioPinOccupato("Troppe richieste di verifica PIN in corso. Riprovare tra qualche secondo.")
+    try:
+        futuro = _get_pool().submit(funzione, *args)
+    except Exception:
+        _posti.release()
+        raise
+    futuro.add_done_callback(lambda _: _posti.release())
+    return futuro
+
+
+def _esegui(funzione, *args):
+    inizio = time.perf_counter()
+    try:
+        if PIN_WORKER <= 0:
+            return funzione(*args)
+        return _invia(funzione, *args).result()
+    finally:
+        aggiungi_bcrypt(time.perf_counter() - inizio) #attesa del pool compresa: è tempo perso dalla richiesta
+
+
+async def _esegui_async(funzione, *args):
+    #per app_async.py: il loop resta libero mentre bcrypt gira nel pool (o in un thread se PIN_WORKER = 0)
+    if PIN_WORKER <= 0:
+        return await asyncio.get_running_loop().run_in_executor(None, funzione, *args)
+    return await asyncio.wrap_future(_invia(funzione, *args))
+
+
+def calcola_hash(pin):
+    return _esegui(_hashpw, pin.encode('utf-8'), BCRYPT_COSTO).decode('utf-8')
+
+
+def controlla_pin(pin, pin_hash):
+    return _esegui(_checkpw, pin.encode('utf-8'), pin_hash.encode('utf-8'))
+
+
+async def calcola_hash_async(pin):
+    return (await _esegui_async(_hashpw, pin.encode('utf-8'), BCRYPT_COSTO)).decode('utf-8')
+
+
+async def controlla_pin_async(pin, pin_hash):
+    return await _esegui_async(_checkpw, pin.encode('utf-8'), pin_hash.encode('utf-8'))
+
+
+def costo_hash(pin_hash):
+    #formato bcrypt: $2b$<costo>$<salt+hash>
+    return int(pin_hash.split("$")[2])
+
+
+def da_aggiornare(pin_hash):
+    return costo_hash(pin_hash) != BCRYPT_COSTO
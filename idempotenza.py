@@ -0,0 +1,227 @@
+#idempotenza.py rende ripetibili senza effetti doppi le richieste che muovono denaro (bonifici e pagamenti).
+#Il client invia una chiave a sua scelta (intestazione Idempotency-Key, o il campo nascosto chiave_idempotenza
+#dei moduli HTML): la prima richiesta con quella chiave viene eseguita e il suo esito salvato; le ripetizioni
+#ricevono lo stesso esito senza rieseguire controlli sul saldo né insert.
+# - la prenotazione è un solo upsert con RETURNING: dice in un colpo se la chiave è nuova, in corso o già conclusa;
+# - gli esiti conclusi restano anche in una cache in memoria (BANCA_IDEMPOTENZA_CACHE voci): la ripetizione
+#   servita da questo processo non tocca il database;
+# - le chiavi valgono BANCA_IDEMPOTENZA_TTL secondi (24 ore); quelle scadute vengono cancellate ogni tanto.
+#Una chiave "in corso" vale solo BANCA_IDEMPOTENZA_PRENOTAZIONE secondi: se la richiesta che l'ha prenotata si
+#ferma (processo terminato) la chiave torna utilizzabile. Per i movimenti della coda (coda_movimenti.py) la chiave
+#riceve l'id del movimento nello stesso commit del movimento, e lo scrittore applica il movimento solo se la chiave
+#è ancora della richiesta: se il processo si ferma dopo il commit, la ripetizione ricostruisce l'esito dal movimento
+#(vedi ripresa in idempotente) invece di ricevere 409 o, peggio, di rieseguirlo.
+import hashlib
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, flash, g, make_response, request, session
+from sqlalchemy import case, delete, update
+from coda_movimenti import MovimentoInSospeso
+from database import engine
+from models import ChiaveIdempotenza
+
+TTL = int(os.environ.get("BANCA_IDEMPOTENZA_TTL", "86400")) #secondi
+PRENOTAZIONE = int(os.environ.get("BANCA_IDEMPOTENZA_PRENOTAZIONE", "60")) #secondi di validità di una chiave in corso
+CACHE_MAX = int(os.environ.get("BANCA_IDEMPOTENZA_CACHE", "10000")) #esiti conclusi tenuti in memoria
+LUNGHEZZA_MAX = 64
+CAMPO_MODULO = "chiave_idempotenza"
+PULIZIA_OGNI = 1000 #prenotazioni tra una pulizia delle chiavi scadute e l'altra
+
+
+class ChiaveNonUtilizzabile(Exception):
+    """La richiesta non può usare la chiave: stato è 400 (non valida), 409 (in corso) o 422 (altri dati)."""
+
+    def __init__(self, messaggio, stato):
+        super().__init__(messaggio)
+        self.stato = stato
+
+
+def _insert():
+    #upsert con ON CONFLICT: SQLite e PostgreSQL hanno la stessa forma
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+
+class RegistroIdempotenza:
+    def __init__(self, cache_max=CACHE_MAX):
+        self._conclusi = OrderedDict() #(utente_id, chiave) -> (impronta, stato, esito, scadenza)
+        self._cache_max = cache_max
+        self._prenotazioni = 0
+        self._lock = threading.Lock()
+
+    def prenota(self, utente_id, chiave, impronta):
+        """Restituisce (proprietario, None, None) se la chiave è nuova, (None, (stato, esito), None) se è già conclusa,
+        (proprietario, None, movimento_id) se il movimento è committato ma l'esito non è stato salvato."""
+        adesso = int(time.time())
+        with self._lock:
+            concluso = self._conclusi.get((utente_id, chiave))
+        if concluso is not None and concluso[3] >= adesso:
+            return None, self._confronta(impronta, *concluso[:3]), None
+
+        tabella = ChiaveIdempotenza.__table__
+        proprietario = secrets.token_hex(16)
+        istruzione = _insert()(tabella).values(
+            utente_id=utente_id, chiave=chiave, proprietario=proprietario, impronta=impronta,
+            stato=None, esito=None, scadenza=adesso + PRENOTAZIONE, movimento_id=None,
+        )
+        #chiave scaduta (o prenotazione abbandonata) ma non ancora cancellata: la riga viene riusata come se fosse nuova
+        scaduta = tabella.c.scadenza < adesso
+        istruzione = istruzione.on_conflict_do_update(
+            index_elements=[tabella.c.utente_id, tabella.c.chiave],
+            set_={
+                nome: case((scaduta, istruzione.excluded[nome]), else_=tabella.c[nome])
+                for nome in ("proprietario", "impronta", "stato", "esito", "scadenza", "movimento_id")
+            },
+        ).returning(tabella.c.proprietario, tabella.c.impronta, tabella.c.stato, tabella.c.esito, tabella.c.scadenza,
+                    tabella.c.movimento_id)
+
+        with engine.begin() as conn:
+            riga = conn.execute(istruzione).one()
+            self._prenotazioni += 1
+            if self._prenotazioni % PULIZIA_OGNI == 0:
+                conn.execute(delete(tabella).where(tabella.c.scadenza < adesso))
+
+        if riga.proprietario == proprietario:
+            return proprietario, None, None
+        if riga.stato is None and riga.movimento_id is not None and riga.impronta == impronta:
+            return riga.proprietario, None, riga.movimento_id
+        if riga.stato is not None:
+            self._ricorda(utente_id, chiave, riga.impronta, riga.stato, riga.esito, riga.scadenza)
+        return None, self._confronta(impronta, riga.impronta, riga.stato, riga.esito), None
+
+    @staticmethod
+    def _confronta(impronta, impronta_salvata, stato, esito):
+        if impronta != impronta_salvata:
+            raise ChiaveNonUtilizzabile("Chiave di idempotenza già usata per una richiesta diversa.", 422)
+        if stato is None:
+            raise ChiaveNonUtilizzabile("Richiesta con questa chiave ancora in corso. Riprovare tra poco.", 409)
+        return stato, esito
+
+    def completa(self, utente_id, chiave, proprietario, impronta, stato, esito):
+        tabella = ChiaveIdempotenza.__table__
+        scadenza = int(time.time()) + TTL
+        with engine.begin() as conn:
+            aggiornate = conn.execute(
+                update(tabella)
+                .where(tabella.c.utente_id == utente_id, tabella.c.chiave == chiave,
+                       tabella.c.proprietario == proprietario)
+                .values(stato=stato, esito=esito, scadenza=scadenza)
+            ).rowcount
+        #prenotazione scaduta e chiave ripresa da un'altra richiesta: l'esito salvato (e da ripetere) è il suo
+        if aggiornate:
+            self._ricorda(utente_id, chiave, impronta, stato, esito, scadenza)
+
+    def annulla(self, utente_id, chiave, proprietario):
+        #errore imprevisto (eccezione o 5xx): la chiave si libera e la richiesta potrà essere ripetuta,
+        #a meno che il movimento sia già stato committato con la chiave
+        tabella = ChiaveIdempotenza.__table__
+        with engine.begin() as conn:
+            conn.execute(delete(tabella).where(
+                tabella.c.utente_id == utente_id, tabella.c.chiave == chiave, tabella.c.proprietario == proprietario,
+                tabella.c.movimento_id.is_(None),
+            ))
+
+    def _ricorda(self, utente_id, chiave, impronta, stato, esito, scadenza):
+        with self._lock:
+            self._conclusi[(utente_id, chiave)] = (impronta, stato, esito, scadenza)
+            self._conclusi.move_to_end((utente_id, chiave))
+            while len(self._conclusi) > self._cache_max:
+                self._conclusi.popitem(last=False)
+
+
+registro = RegistroIdempotenza()
+
+
+def nuova_chiave():
+    #per il campo nascosto dei moduli: una chiave per ogni modulo mostrato
+    return secrets.token_hex(16)
+
+
+def chiave_corrente():
+    """Prenotazione della chiave della richiesta in corso, da passare a esegui_movimento (None senza chiave)."""
+    return g.get("chiave_idempotenza")
+
+
+def impronta(endpoint, parametri, modulo, dati):
+    #rotta, parametri del percorso e dati inviati (senza la chiave stessa); usata anche da app_async.py
+    return hashlib.sha256(json.dumps([endpoint, parametri, modulo, dati], sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _impronta(kwargs):
+    modulo = sorted((k, v) for k, v in request.form.items(multi=True) if k != CAMPO_MODULO)
+    return impronta(request.endpoint, kwargs, modulo, request.get_json(silent=True))
+
+
+def serializza_esito(corpo, tipo, location=None, messaggi=()):
+    return json.dumps({"corpo": corpo, "tipo": tipo, "location": location, "flash": list(messaggi)})
+
+
+def _serializza(risposta, messaggi):
+    return serializza_esito(risposta.get_data(as_text=True), risposta.mimetype, risposta.headers.get("Location"), messaggi)
+
+
+def _ripeti(stato, esito):
+    dati = json.loads(esito)
+    for categoria, messaggio in dati["flash"]:
+        flash(messaggio, categoria)
+    risposta = Response(dati["corpo"], status=stato, mimetype=dati["tipo"])
+    if dati["location"]:
+        risposta.headers["Location"] = dati["location"]
+    risposta.headers["Idempotent-Replayed"] = "true"
+    return risposta
+
+
+def idempotente(vista=None, *, ripresa=None):
+    """Decoratore per le viste POST che muovono denaro; va sotto login_required/api_token_required.
+
+    ripresa(movimento_id, *args, **kwargs) ricostruisce la risposta di una richiesta il cui movimento è stato
+    committato (con esegui_movimento e chiave_corrente()) senza che l'esito venisse salvato.
+    """
+    if vista is None:
+        return lambda vista: idempotente(vista, ripresa=ripresa)
+
+    @wraps(vista)
+    def wrapper(*args, **kwargs):
+        chiave = request.headers.get("Idempotency-Key") or request.form.get(CAMPO_MODULO)
+        if request.method != "POST" or not chiave:
+            return vista(*args, **kwargs)
+        if len(chiave) > LUNGHEZZA_MAX:
+            raise ChiaveNonUtilizzabile(f"Chiave di idempotenza oltre {LUNGHEZZA_MAX} caratteri.", 400)
+
+        utente_id = g.get("utente_id") or session.get("utente_id")
+        impronta_richiesta = _impronta(kwargs)
+        proprietario, concluso, movimento_id = registro.prenota(utente_id, chiave, impronta_richiesta)
+        if concluso is not None:
+            return _ripeti(*concluso)
+        if movimento_id is not None and ripresa is None:
+            raise ChiaveNonUtilizzabile("Richiesta con questa chiave ancora in corso. Riprovare tra poco.", 409)
+
+        messaggi_prima = len(session.get("_flashes", []))
+        g.chiave_idempotenza = (utente_id, chiave, proprietario, int(time.time()) + TTL)
+        try:
+            if movimento_id is not None:
+                risposta = make_response(ripresa(movimento_id, *args, **kwargs))
+            else:
+                risposta = make_response(vista(*args, **kwargs))
+        except MovimentoInSospeso:
+            #il movimento può ancora essere applicato: la chiave resta prenotata, così un nuovo invio non lo ripete
+            raise
+        except Exception:
+            registro.annulla(utente_id, chiave, proprietario)
+            raise
+        if risposta.status_code >= 500:
+            registro.annulla(utente_id, chiave, proprietario)
+        else:
+            messaggi = [list(m) for m in session.get("_flashes", [])[messaggi_prima:]]
+            registro.completa(utente_id, chiave, proprietario, impronta_richiesta, risposta.status_code,
+                              _serializza(risposta, messaggi))
+        return risposta
+    return wrapper
@@ -0,0 +1,165 @@
+#limiti_accesso.py limita i tentativi di verifica del PIN (login, login API, conferme con PIN) per codice
+#titolare e per indirizzo del client, con un secchiello di gettoni per chiave: ogni tentativo consuma un gettone,
+#i gettoni si ricaricano nel tempo fino alla capienza. Il controllo avviene prima di leggere l'utente e prima di
+#bcrypt, così un'ondata di tentativi viene respinta senza consumare il pool di hash_pin. Un PIN corretto restituisce
+#il gettone (tentativo_riuscito): contano solo i tentativi falliti e chi usa il proprio PIN non resta bloccato.
+#Limiti nel formato "tentativi/secondi": BANCA_LIMITE_TITOLARE (predefinito 5/300) e BANCA_LIMITE_IP (30/60).
+#In memoria ogni chiave occupa una tupla (gettoni, istante, limite); oltre BANCA_LIMITI_CHIAVI chiavi si scartano
+#quelle toccate meno di recente, ma solo se il loro secchiello si è già ricaricato del tutto: scartare un secchiello
+#vuoto ridarebbe i tentativi a chi li ha esauriti, semplicemente riempiendo la tabella di altre chiavi. Il limite di
+#chiavi può quindi essere superato, al massimo dalle chiavi toccate nell'ultima ricarica completa.
+#Con più processi (gunicorn a più worker) si può indicare BANCA_LIMITI_DB: i secchielli stanno allora in un file
+#SQLite condiviso.
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def _limite(nome, predefinito):
+    tentativi, secondi = os.environ.get(nome, predefinito).split("/")
+    return float(tentativi), float(tentativi) / float(secondi) #capienza, gettoni al secondo
+
+
+LIMITE_TITOLARE = _limite("BANCA_LIMITE_TITOLARE", "5/300")
+LIMITE_IP = _limite("BANCA_LIMITE_IP", "30/60")
+CHIAVI_MAX = int(os.environ.get("BANCA_LIMITI_CHIAVI", "100000"))
+PERCORSO_DB = os.environ.get("BANCA_LIMITI_DB") #None = secchielli in memoria, per processo
+
+
+class TroppiTentativi(Exception):
+    """Tentativi di verifica del PIN esauriti per il titolare o per l'indirizzo."""
+
+    def __init__(self, attesa):
+        super().__init__(f"Troppi tentativi. Riprovare tra {attesa} secondi.")
+        self.attesa = attesa
+
+
+def _ricarica(gettoni, istante, adesso, limite):
+    capienza, al_secondo = limite
+    return min(capienza, gettoni + (adesso - istante) * al_secondo)
+
+
+def _attesa(gettoni, limite):
+    #secondi prima che il secchiello torni ad avere un gettone intero
+    return max(1, math.ceil((1 - gettoni) / limite[1]))
+
+
+class SecchielliMemoria:
+    def __init__(self, chiavi_max=CHIAVI_MAX):
+        self._secchielli = OrderedDict() #chiave -> (gettoni, istante, limite), dal meno al più recente
+        self._chiavi_max = chiavi_max
+        self._lock = threading.Lock()
+
+    def preleva(self, richieste):
+        """richieste = [(chiave, limite)]: toglie un gettone da ognuna o da nessuna; restituisce 0 o i secondi di attesa."""
+        adesso = time.monotonic()
+        with self._lock:
+            stati = []
+            for chiave, limite in richieste:
+                gettoni, istante, _ = self._secchielli.get(chiave, (limite[0], adesso, limite))
+                stati.append(_ricarica(gettoni, istante, adesso, limite))
+            attese = [_attesa(g, limite) for g, (_, limite) in zip(stati, richieste) if g < 1]
+            if attese:
+                return max(attese)
+            for gettoni, (chiave, limite) in zip(stati, richieste):
+                self._secchielli[chiave] = (gettoni - 1, adesso, limite)
+                self._secchielli.move_to_end(chiave)
+            while len(self._secchielli) > self._chiavi_max:
+                gettoni, istante, limite = next(iter(self._secchielli.values()))
+                if _ricarica(gettoni, istante, adesso, limite) < limite[0]:
+                    break #il meno recente non è ancora pieno: scartarlo azzererebbe i suoi tentativi falliti
+                self._secchielli.popitem(last=False)
+            return 0
+
+    def restituisci(self, richieste):
+        """Rimette un gettone in ognuna delle chiavi (senza superare la capienza)."""
+        adesso = time.monotonic()
+        with self._lock:
+            for chiave, limite in richieste:
+                stato = self._secchielli.get(chiave)
+                if stato is None:
+                    continue #già scartato: era pieno
+                gettoni, istante, _ = stato
+                self._secchielli[chiave] = (min(limite[0], _ricarica(gettoni, istante, adesso, limite) + 1), adesso, limite)
+
+
+class SecchielliSqlite:
+    #stesso algoritmo su una tabella condivisa tra processi; BEGIN IMMEDIATE rende atomico leggi-e-preleva
+    PULIZIA_OGNI = 1000 #prelievi tra una pulizia e l'altra
+
+    def __init__(self, percorso):
+        self._percorso = percorso
+        self._locale = threading.local() #una connessione per thread
+        self._prelievi = 0
+        self._ricarica_completa = max(capienza / al_secondo for capienza, al_secondo in (LIMITE_TITOLARE, LIMITE_IP))
+
+    def _db(self):
+        connessione = getattr(self._locale, "connessione", None)
+        if connessione is None:
+            connessione = sqlite3.connect(self._percorso, timeout=5, isolation_level=None)
+            connessione.execute("PRAGMA journal_mode=WAL")
+            connessione.execute(
+                "CREATE TABLE IF NOT EXISTS secchielli (chiave TEXT PRIMARY KEY, gettoni REAL NOT NULL, "
+                "istante REAL NOT NULL) WITHOUT ROWID"
+            )
+            self._locale.connessione = connessione
+        return connessione
+
+    def preleva(self, richieste):
+        adesso = time.time() #orologio condiviso tra processi
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            stati = []
+            for chiave, limite in richieste:
+                riga = db.execute("SELECT gettoni, istante FROM secchielli WHERE chiave = ?", (chiave,)).fetchone()
+                gettoni, istante = riga or (limite[0], adesso)
+                stati.append(_ricarica(gettoni, istante, adesso, limite))
+            attese = [_attesa(g, limite) for g, (_, limite) in zip(stati, richieste) if g < 1]
+            if not attese:
+                db.executemany(
+                    "INSERT OR REPLACE INTO secchielli (chiave, gettoni, istante) VALUES (?, ?, ?)",
+                    [(chiave, gettoni - 1, adesso) for gettoni, (chiave, _) in zip(stati, richieste)]
+                )
+            self._prelievi += 1
+            if self._prelievi % self.PULIZIA_OGNI == 0:
+                #i secchielli fermi da più di una ricarica completa sono pieni: equivalgono a una chiave assente
+                db.execute("DELETE FROM secchielli WHERE istante < ?", (adesso - self._ricarica_completa,))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return max(attese) if attese else 0
+
+    def restituisci(self, richieste):
+        adesso = time.time()
+        #un solo UPDATE in autocommit: ricarica fino ad adesso più il gettone restituito, entro la capienza
+        self._db().executemany(
+            "UPDATE secchielli SET gettoni = MIN(?, gettoni + (? - istante) * ? + 1), istante = ? WHERE chiave = ?",
+            [(capienza, adesso, al_secondo, adesso, chiave) for chiave, (capienza, al_secondo) in richieste]
+        )
+
+
+secchielli = SecchielliSqlite(PERCORSO_DB) if PERCORSO_DB else SecchielliMemoria()
+
+
+def _richieste(codice_titolare, indirizzo):
+    richieste = [(f"ip:{indirizzo}", LIMITE_IP)]
+    if codice_titolare:
+        richieste.append((f"titolare:{str(codice_titolare)[:32]}", LIMITE_TITOLARE)) #chiave corta anche con input anomali
+    return richieste
+
+
+def controlla_tentativo(codice_titolare, indirizzo):
+    """Da chiamare prima di ogni verifica del PIN; solleva TroppiTentativi se uno dei due limiti è esaurito."""
+    attesa = secchielli.preleva(_richieste(codice_titolare, indirizzo))
+    if attesa:
+        raise TroppiTentativi(attesa)
+
+
+def tentativo_riuscito(codice_titolare, indirizzo):
+    """Da chiamare quando il PIN è corretto, con gli stessi argomenti di controlla_tentativo: restituisce il gettone."""
+    secchielli.restituisci(_richieste(codice_titolare, indirizzo))
@@ -0,0 +1,213 @@
+#metriche.py misura dove va il tempo di ogni richiesta Flask, per rotta: latenza (istogramma), istruzioni SQL,
+#tempo SQL, righe lette, tempo di bcrypt e di rendering dei template. app.py espone i totali su /metrics
+#nel formato testuale di Prometheus.
+#Con BANCA_METRICHE_CAMPIONE < 1 viene misurata solo quella frazione delle richieste (scelta a caso): le altre
+#pagano un solo confronto. I totali esposti sono quelli delle richieste campionate (banca_metriche_campione
+#dice per quanto moltiplicarli). Si misura il thread della richiesta: il lavoro del thread scrittore di
+#coda_movimenti non rientra nell'SQL della rotta, ma nella sua latenza sì.
+import os
+import random
+import threading
+import time
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+from database import engine
+
+CAMPIONE = float(os.environ.get("BANCA_METRICHE_CAMPIONE", "1")) #frazione di richieste misurate, 0 = disattivo
+LIMITI_LATENZA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) #secondi
+
+_locale = threading.local() #misura della richiesta in corso in questo thread
+
+
+class Misura:
+    __slots__ = ("inizio", "sql_istruzioni", "sql_secondi", "sql_righe", "bcrypt_secondi", "template_secondi",
+                 "_inizio_template")
+
+    def __init__(self):
+        self.inizio = time.perf_counter()
+        self.sql_istruzioni = 0
+        self.sql_secondi = 0.0
+        self.sql_righe = 0
+        self.bcrypt_secondi = 0.0
+        self.template_secondi = 0.0
+        self._inizio_template = None
+
+
+class _TotaliRotta:
+    __slots__ = ("secchi", "durata", "richieste", "stati", "sql_istruzioni", "sql_secondi", "sql_righe",
+                 "bcrypt_secondi", "template_secondi")
+
+    def __init__(self):
+        self.secchi = [0] * len(LIMITI_LATENZA)
+        self.durata = 0.0
+        self.richieste = 0
+        self.stati = {}
+        self.sql_istruzioni = 0
+        self.sql_secondi = 0.0
+        self.sql_righe = 0
+        self.bcrypt_secondi = 0.0
+        self.template_secondi = 0.0
+
+
+class Registro:
+    def __init__(self):
+        self._rotte = {} #(rotta, metodo) -> _TotaliRotta
+        self._lock = threading.Lock()
+
+    def registra(self, rotta, metodo, stato, misura):
+        durata = time.perf_counter() - misura.inizio
+        with self._lock:
+            totali = self._rotte.get((rotta, metodo))
+            if totali is None:
+                totali = self._rotte[(rotta, metodo)] = _TotaliRotta()
+            for i, limite in enumerate(LIMITI_LATENZA):
+                if durata <= limite:
+                    totali.secchi[i] += 1
+                    break
+            totali.durata += durata
+            totali.richieste += 1
+            totali.stati[stato] = totali.stati.get(stato, 0) + 1
+            totali.sql_istruzioni += misura.sql_istruzioni
+            totali.sql_secondi += misura.sql_secondi
+            totali.sql_righe += misura.sql_righe
+            totali.bcrypt_secondi += misura.bcrypt_secondi
+            totali.template_secondi += misura.template_secondi
+
+    def testo_prometheus(self):
+        with self._lock:
+            rotte = sorted(self._rotte.items())
+            copie = [(chiave, totali.secchi[:], dict(totali.stati), totali.durata, totali.richieste,
+                      totali.sql_istruzioni, totali.sql_secondi, totali.sql_righe, totali.bcrypt_secondi,
+                      totali.template_secondi) for chiave, totali in rotte]
+
+        righe = [
+            "# HELP banca_metriche_campione Frazione delle richieste misurate.",
+            "# TYPE banca_metriche_campione gauge",
+            f"banca_metriche_campione {CAMPIONE}",
+            "# HELP banca_richiesta_durata_seconds Durata delle richieste misurate.",
+            "# TYPE banca_richiesta_durata_seconds histogram",
+        ]
+        for (rotta, metodo), secchi, _, durata, richieste, *_ in copie:
+            etichette = f'rotta="{rotta}",metodo="{metodo}"'
+            cumulato = 0
+            for limite, quante in zip(LIMITI_LATENZA, secchi):
+                cumulato += quante
+                righe.append(f'banca_richiesta_durata_seconds_bucket{{{etichette},le="{limite}"}} {cumulato}')
+            righe.append(f'banca_richiesta_durata_seconds_bucket{{{etichette},le="+Inf"}} {richieste}')
+            righe.append(f"banca_richiesta_durata_seconds_sum{{{etichette}}} {durata}")
+            righe.append(f"banca_richiesta_durata_seconds_count{{{etichette}}} {richieste}")
+
+        righe += [
+            "# HELP banca_richieste_total Richieste misurate per codice di stato.",
+            "# TYPE banca_richieste_total counter",
+        ]
+        for (rotta, metodo), _, stati, *_ in copie:
+            for stato, quante in sorted(stati.items()):
+                righe.append(f'banca_richieste_total{{rotta="{rotta}",metodo="{metodo}",stato="{stato}"}} {quante}')
+
+        contatori = (
+            ("banca_sql_istruzioni_total", "Istruzioni SQL eseguite.", 5),
+            ("banca_sql_durata_seconds_total", "Tempo passato ad eseguire istruzioni SQL.", 6),
+            ("banca_sql_righe_total", "Righe lette dai risultati delle query.", 7),
+            ("banca_bcrypt_durata_seconds_total", "Tempo di attesa di hash e verifiche dei PIN.", 8),
+            ("banca_template_durata_seconds_total", "Tempo di rendering dei template Jinja.", 9),
+        )
+        for nome, descrizione, posizione in contatori:
+            righe += [f"# HELP {nome} {descrizione}", f"# TYPE {nome} counter"]
+            for copia in copie:
+                rotta, metodo = copia[0]
+                righe.append(f'{nome}{{rotta="{rotta}",metodo="{metodo}"}} {copia[posizione]}')
+        return "\n".join(righe) + "\n"
+
+    def svuota(self):
+        with self._lock:
+            self._rotte.clear()
+
+
+registro = Registro()
+
+
+def misura_corrente():
+    return getattr(_locale, "misura", None)
+
+
+def inizia_richiesta():
+    #prima della richiesta: decide se campionarla
+    if CAMPIONE > 0 and (CAMPIONE >= 1 or random.random() < CAMPIONE):
+        _locale.misura = Misura()
+
+
+def concludi_richiesta(rotta, metodo, stato):
+    misura = misura_corrente()
+    if misura is not None:
+        _locale.misura = None
+        registro.registra(rotta, metodo, stato, misura)
+
+
+def aggiungi_bcrypt(secondi):
+    misura = misura_corrente()
+    if misura is not None:
+        misura.bcrypt_secondi += secondi
+
+
+class _CursoreContato:
+    """Inoltra tutto al cursore DBAPI e conta le righe lette con fetch*."""
+
+    def __init__(self, cursore, misura):
+        self._cursore = cursore
+        self._misura = misura
+
+    def fetchone(self):
+        riga = self._cursore.fetchone()
+        if riga is not None:
+            self._misura.sql_righe += 1
+        return riga
+
+    def fetchmany(self, *args):
+        righe = self._cursore.fetchmany(*args)
+        self._misura.sql_righe += len(righe)
+        return righe
+
+    def fetchall(self):
+        righe = self._cursore.fetchall()
+        self._misura.sql_righe += len(righe)
+        return righe
+
+    def __getattr__(self, nome):
+        return getattr(self._cursore, nome)
+
+
+#---- Ascoltatori: motore SQLAlchemy e segnali dei template di Flask ----
+@event.listens_for(engine, "before_cursor_execute")
+def _prima_sql(conn, cursor, statement, parameters, context, executemany):
+    if misura_corrente() is not None:
+        conn.info.setdefault("metriche_inizio", []).append(time.perf_counter())
+
+
+@event.listens_for(engine, "after_cursor_execute")
+def _dopo_sql(conn, cursor, statement, parameters, context, executemany):
+    misura = misura_corrente()
+    inizi = conn.info.get("metriche_inizio")
+    if misura is None or not inizi:
+        return
+    misura.sql_istruzioni += 1
+    misura.sql_secondi += time.perf_counter() - inizi.pop()
+    if context is not None and not executemany and cursor.description is not None and context.cursor is cursor:
+        #SQLAlchemy costruisce il risultato da context.cursor subito dopo questo evento:
+        #sostituirlo con un inoltro è l'unico modo di contare le righe lette senza toccare le query
+        context.cursor = _CursoreContato(cursor, misura)
+
+
+@before_render_template.connect
+def _prima_template(sender, template, context, **extra):
+    misura = misura_corrente()
+    if misura is not None:
+        misura._inizio_template = time.perf_counter()
+
+
+@template_rendered.connect
+def _dopo_template(sender, template, context, **extra):
+    misura = misura_corrente()
+    if misura is not None and misura._inizio_template is not None:
+        misura.template_secondi += time.perf_counter() - misura._inizio_template
+        misura._inizio_template = None
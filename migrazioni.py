@@ -0,0 +1,179 @@
+#migrazioni.py aggiorna lo schema dei database già esistenti (es. db_banca.db).
+#Base.metadata.create_all crea solo le tabelle mancanti e non modifica quelle già presenti,
+#quindi ogni modifica allo schema va aggiunta qui come nuova migrazione in coda alla lista.
+import secrets
+from datetime import datetime
+from sqlalchemy import inspect, text
+import codici
+from database import Base
+from models import Conto, Utente
+from storico import PAGINA_TRANSAZIONI, PAGINA_TRANSAZIONI_MAX, query_blocco_estratto, query_movimenti_successivi, query_pagina_transazioni
+
+
+def _colonne(conn, tabella):
+    return {c["name"] for c in inspect(conn).get_columns(tabella)}
+
+
+def _m001_saldo_conti(conn):
+    #colonna del saldo memorizzato, valorizzata ricalcolando lo storico una sola volta
+    if "saldo" not in _colonne(conn, "conti"):
+        conn.execute(text("ALTER TABLE conti ADD COLUMN saldo NUMERIC(12, 2) NOT NULL DEFAULT 0"))
+    conn.execute(text("""
+        UPDATE conti SET saldo =
+            COALESCE((SELECT SUM(importo) FROM transazioni WHERE conto_destinatario_id = conti.id), 0)
+          - COALESCE((SELECT SUM(importo) FROM transazioni WHERE conto_mittente_id = conti.id), 0)
+    """))
+
+
+def _m002_indici(conn):
+    #indici per le ricerche più frequenti (stessi nomi di __table_args__ in models.py)
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_utenti_codice_fiscale ON utenti (codice_fiscale)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_conti_utente_data_creazione ON conti (utente_id, data_creazione)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_transazioni_mittente_data ON transazioni (conto_mittente_id, data, id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_transazioni_destinatario_data ON transazioni (conto_destinatario_id, data, id)"))
+
+
+def _m003_sequenze(conn):
+    #sequenze per codice titolare e IBAN; la chiave è generata qui e non deve più cambiare.
+    #I codici già assegnati a caso vengono riservati, così la sequenza non li produrrà mai.
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS sequenze (nome VARCHAR NOT NULL PRIMARY KEY, "
+        "valore INTEGER NOT NULL, chiave VARCHAR NOT NULL, riservati VARCHAR)"
+    ))
+    esistenti = {
+        "codice_titolare": "SELECT codice_titolare FROM utenti",
+        "iban": "SELECT iban FROM conti",
+    }
+    for nome, query in esistenti.items():
+        if conn.execute(text("SELECT 1 FROM sequenze WHERE nome = :n"), {"n": nome}).first():
+            continue
+        chiave = secrets.token_hex(16)
+        #le ultime 6 cifre sono il numero generato (CT000123, IT123456000123)
+        numeri = (int(codice[-6:]) for codice in conn.execute(text(query)).scalars())
+        riservati = sorted(codici.inverti(numero, chiave) for numero in numeri if numero)
+        conn.execute(
+            text("INSERT INTO sequenze (nome, valore, chiave, riservati) VALUES (:n, 0, :c, :r)"),
+            {"n": nome, "c": chiave, "r": ",".join(map(str, riservati)) or None},
+        )
+
+
+def _m004_versione_conti(conn):
+    if "versione" not in _colonne(conn, "conti"):
+        conn.execute(text("ALTER TABLE conti ADD COLUMN versione INTEGER NOT NULL DEFAULT 0"))
+
+
+
+def _m005_movimento_chiavi(conn):
+    #la tabella nasce con create_all; qui solo i database creati prima della colonna
+    if inspect(conn).has_table("chiavi_idempotenza") and "movimento_id" not in _colonne(conn, "chiavi_idempotenza"):
+        conn.execute(text("ALTER TABLE chiavi_idempotenza ADD COLUMN movimento_id INTEGER"))
+
+
+def _m006_indici_successivi(conn):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_transazioni_mittente_id ON transazioni (conto_mittente_id, id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_transazioni_destinatario_id ON transazioni (conto_destinatario_id, id)"))
+
+
+#(versione, descrizione, funzione): le versioni sono crescenti e non vanno mai riutilizzate
+MIGRAZIONI = [
+    (1, "saldo memorizzato sui conti", _m001_saldo_conti),
+    (2, "indici su codice fiscale, conti per utente e storico transazioni", _m002_indici),
+    (3, "sequenze per codice titolare e IBAN", _m003_sequenze),
+    (4, "versione dei conti", _m004_versione_conti),
+    (5, "movimento delle chiavi di idempotenza", _m005_movimento_chiavi),
+    (6, "indici per id sulle transazioni di un conto", _m006_indici_successivi),
+]
+
+
+def piani_attesi():
+    """[(descrizione, istruzione, indici)]: le istruzioni costruite dalle route stesse, con gli indici che devono usare."""
+    storico = {"ix_transazioni_mittente_data", "ix_transazioni_destinatario_data"}
+    return [
+        ("registrazione: utente per codice fiscale", Utente.query_codice_fiscale("X"), {"ix_utenti_codice_fiscale"}),
+        ("apri_nuovo_conto: ultimo conto aperto", Conto.query_ultimo_aperto(1), {"ix_conti_utente_data_creazione"}),
+        ("storico: prima pagina", query_pagina_transazioni(1, None, PAGINA_TRANSAZIONI + 1), storico),
+        ("storico: pagina successiva",
+         query_pagina_transazioni(1, (datetime(2025, 1, 1), 1), PAGINA_TRANSAZIONI + 1), storico),
+        ("estratto: blocco successivo", query_blocco_estratto(1, None, datetime(2026, 1, 1), (datetime(2025, 1, 1), 1)),
+         storico),
+        ("eventi: movimenti successivi", query_movimenti_successivi(1, 1000, PAGINA_TRANSAZIONI_MAX),
+         {"ix_transazioni_mittente_id", "ix_transazioni_destinatario_id"}),
+    ]
+
+
+def piano(conn, istruzione):
+    """Piano di SQLite per un'istruzione SQLAlchemy, compilata con i valori dentro il testo: [(id, genitore, dettaglio)]."""
+    testo = str(istruzione.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True}))
+    return [(riga[0], riga[1], riga[-1]) for riga in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + testo)]
+
+
+def problemi_piano(righe, indici, tabelle):
+    problemi = []
+    dettagli = [dettaglio for _, _, dettaglio in righe]
+    for indice in sorted(indici):
+        if not any(f"USING INDEX {indice} " in d or f"USING COVERING INDEX {indice} " in d for d in dettagli):
+            problemi.append(f"non usa {indice}")
+    letture = {} #genitore -> letture dirette di una tabella (non di una sottoquery)
+    for _, genitore, dettaglio in righe:
+        parole = dettaglio.split()
+        if parole[0] in ("SCAN", "SEARCH") and parole[1] in tabelle:
+            letture.setdefault(genitore, []).append(dettaglio)
+            if parole[0] == "SCAN" and "USING" not in parole:
+                problemi.append(f"scansione completa: {dettaglio}")
+    #un ordinamento accanto alla lettura di una tabella vuol dire che l'indice non copre l'ORDER BY;
+    #quello della fusione UNION ALL (sulle poche righe dei rami) sta accanto alla sottoquery ed è previsto
+    for _, genitore, dettaglio in righe:
+        if dettaglio.startswith("USE TEMP B-TREE FOR ORDER BY") and genitore in letture:
+            problemi.append(f"ordinamento non coperto dall'indice: {letture[genitore][0]}")
+    return problemi
+
+
+def verifica_piani(engine):
+    #controlla con EXPLAIN QUERY PLAN che le query delle route usino ancora gli indici (solo SQLite)
+    problemi = []
+    with engine.connect() as conn:
+        for descrizione, istruzione, indici in piani_attesi():
+            righe = piano(conn, istruzione)
+            for problema in problemi_piano(righe, indici, Base.metadata.tables):
+                testo = " | ".join(dettaglio for _, _, dettaglio in righe)
+                problemi.append(f"{descrizione}: {problema}\n    piano: {testo}")
+    return problemi
+
+
+def applica_migrazioni(engine):
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS migrazioni_schema ("
+            "versione INTEGER PRIMARY KEY, descrizione VARCHAR NOT NULL, "
+            "applicata_il DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL)"
+        ))
+        applicate = set(conn.execute(text("SELECT versione FROM migrazioni_schema")).scalars())
+
+    for versione, descrizione, migrazione in MIGRAZIONI:
+        if versione in applicate:
+            continue
+        #ogni migrazione gira nella propria transazione insieme alla sua registrazione
+        with engine.begin() as conn:
+            migrazione(conn)
+            conn.execute(
+                text("INSERT INTO migrazioni_schema (versione, descrizione) VALUES (:v, :d)"),
+                {"v": versione, "d": descrizione},
+            )
+        print(f"[OK] migrazione {versione} applicata: {descrizione}")
+
+
+if __name__ == "__main__":
+    #python migrazioni.py [--verifica-piani]
+    import sys
+    from database import engine
+
+    Base.metadata.create_all(bind=engine)
+    applica_migrazioni(engine)
+
+    if "--verifica-piani" in sys.argv:
+        problemi = verifica_piani(engine)
+        for problema in problemi:
+            print("❌", problema)
+        if problemi:
+            sys.exit(1)
+        print("✔️ Tutte le query usano gli indici previsti.")
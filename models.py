@@ -1,14 +1,28 @@
-import random
-import bcrypt, re
-from sqlalchemy import Boolean, Column, DateTime, Numeric, Integer, String, ForeignKey, func
-from sqlalchemy.orm import relationship, validates
+import re
+from functools import lru_cache
+import codici
+import hash_pin
+from sqlalchemy import Boolean, Column, DateTime, Index, Numeric, Integer, String, Text, ForeignKey, func, event, select, update
+from sqlalchemy.orm import Session, object_session, relationship, validates
 from enum import Enum as PyEnum
 from sqlalchemy import Enum as SqlEnum
+from sqlalchemy.dialects import sqlite
 from database import Base
+from budget_query import budget_query
 from decimal import ROUND_HALF_UP, Decimal
 
+#Su SQLite le date sono testo: uso lo stesso formato di CURRENT_TIMESTAMP (al secondo) anche per i valori
+#passati da Python, così i confronti sulle date (es. paginazione per (data, id)) sono coerenti.
+DataOra = DateTime(timezone=True).with_variant(
+    sqlite.DATETIME(storage_format="%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d:%(second)02d"),
+    "sqlite",
+)
+
 class Utente(Base):
     __tablename__ = 'utenti'
+    __table_args__ = (
+        Index("ix_utenti_codice_fiscale", "codice_fiscale"), #controllo duplicati in registrazione
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     nome = Column(String, nullable=False)
     cognome = Column(String, nullable=False)
@@ -31,34 +45,41 @@ class Utente(Base):
         self.lavoro_id = lavoro_id
         
     def genera_codice_titolare(self, session):
-        while True:
-            numero = random.randint(1, 999999)
-            codice = f"CT{numero:06d}"
-            print(f"[OK] sono in genera codice: {codice}")
+        #codice univoco dalla sequenza, senza tentativi a caso (vedi Sequenza)
+        return f"CT{Sequenza.prossimo_codice(session, 'codice_titolare'):06d}"
 
-            if not session.query(Utente).filter_by(codice_titolare=codice).first():
-                return codice             
+    @staticmethod
+    def query_codice_fiscale(codice_fiscale):
+        #controllo duplicati in registrazione: basta l'indice ix_utenti_codice_fiscale, senza leggere la tabella
+        return select(Utente.id).where(Utente.codice_fiscale == codice_fiscale).limit(1)
 
-    def crea_pin(self, pin):
+    @staticmethod
+    def controlla_formato_pin(pin):
         if len(pin)<6: 
             raise ValueError("Il PIN deve essere di almeno 6 cifre.")
        
         if re.search(r"(\d)\1\1", pin): 
             raise ValueError("Il PIN da lei inserito contiene una cifra ripetuta tre volte di seguito.")
+
+    def crea_pin(self, pin):
+        self.controlla_formato_pin(pin)
         
-        pin_bytes = pin.encode('utf-8') 
-        salt = bcrypt.gensalt()         
-        pin_hash_bytes = bcrypt.hashpw(pin_bytes, salt)
-        self.pin_hash = pin_hash_bytes.decode('utf-8')               
+        #bcrypt gira nel pool dedicato di hash_pin, con il costo configurato
+        self.pin_hash = hash_pin.calcola_hash(pin)
        
 
     def verifica_pin(self, pin_inserito):
         if not pin_inserito:
             raise ValueError("PIN vuoto: impossibile verificare.")
         
-        pin_bytes = pin_inserito.encode('utf-8') #Ricontrolla automaticamente con lo stesso salt e serve per il main che controlla sia la stessa password e dovrebbe ritornare true se matchano
-        db_hash_bytes = self.pin_hash.encode('utf-8')
-        return bcrypt.checkpw(pin_bytes, db_hash_bytes)
+        #Ricontrolla automaticamente con lo stesso salt e dovrebbe ritornare true se matchano
+        if not hash_pin.controlla_pin(pin_inserito, self.pin_hash):
+            return False
+
+        #se il costo configurato è cambiato ricalcolo l'hash ora che ho il PIN in chiaro (va salvato con commit)
+        if hash_pin.da_aggiornare(self.pin_hash):
+            self.pin_hash = hash_pin.calcola_hash(pin_inserito)
+        return True
 
 
 class Lavoro(Base):
@@ -73,9 +94,16 @@ class Lavoro(Base):
 
 class Conto(Base):
     __tablename__ = 'conti'
+    __table_args__ = (
+        Index("ix_conti_utente_data_creazione", "utente_id", "data_creazione"), #conti dell'utente, ultimo conto aperto
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     iban = Column(String, nullable=False, unique=True)
-    data_creazione = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    data_creazione = Column(DataOra, server_default=func.now(), nullable=False)
+    #saldo memorizzato: aggiornato nella stessa transazione di ogni movimento (vedi _aggiorna_saldo più in basso)
+    saldo = Column(Numeric(12,2), nullable=False, default=Decimal("0.00"), server_default="0")
+    #incrementata a ogni variazione del saldo
+    versione = Column(Integer, nullable=False, default=0, server_default="0")
 
     #chiavi esterne
     utente_id = Column(Integer, ForeignKey('utenti.id'), nullable=False)
@@ -94,20 +122,50 @@ class Conto(Base):
         abi = "123"     #codice banca
         cab = "456"     #codice filiale
 
-        while True:
-            numero = random.randint(1, 999999)
-            conto = f"{numero:06d}"
-            iban = f"IT{abi}{cab}{conto}"
+        conto = f"{Sequenza.prossimo_codice(session, 'iban'):06d}"
+        return f"IT{abi}{cab}{conto}"
 
-            if not session.query(Conto).filter_by(iban=iban).first():
-                return iban
 
+    @staticmethod
+    def query_ultimo_aperto(utente_id):
+        #ultimo conto aperto dall'utente (limite di un conto ogni 24 ore), sull'indice ix_conti_utente_data_creazione
+        return select(Conto).where(Conto.utente_id == utente_id).order_by(Conto.data_creazione.desc()).limit(1)
 
     @property #in questo modo posso usarlo come attributo
     def saldo_corrente(self):
+        #lettura O(1) del saldo memorizzato, senza caricare lo storico
+        if self.saldo is None: #conto non ancora salvato
+            return Decimal("0.00")
+        return self.saldo
+
+    @property
+    @budget_query(2) #le due relazioni dello storico, una query ciascuna
+    def saldo_da_registro(self):
+        #ricalcolo completo dallo storico: serve solo per i controlli di coerenza
         entrate = sum(t.importo for t in self.transazioni_ricevute)
         uscite = sum(t.importo for t in self.transazioni_effettuate)
         return entrate - uscite
+
+    @staticmethod
+    def saldi_incoerenti(session):
+        #confronta il saldo memorizzato con la somma dei movimenti, restituisce (id, saldo, saldo_registro)
+        entrate = (
+            select(func.coalesce(func.sum(Transazione.importo), 0))
+            .where(Transazione.conto_destinatario_id == Conto.id)
+            .scalar_subquery()
+        )
+        uscite = (
+            select(func.coalesce(func.sum(Transazione.importo), 0))
+            .where(Transazione.conto_mittente_id == Conto.id)
+            .scalar_subquery()
+        )
+        registro = (entrate - uscite).label("saldo_registro")
+        righe = session.execute(
+            select(Conto.id, Conto.saldo, registro)
+            .where(func.abs(Conto.saldo - (entrate - uscite)) >= Decimal("0.005"))
+            .order_by(Conto.id)
+        ).all()
+        return [(r.id, r.saldo, r.saldo_registro) for r in righe]
     
     def verifica_importo(self,importo):
         importo = Decimal(importo)
@@ -116,6 +174,11 @@ class Conto(Base):
         
     def verifica_saldo(self, importo):
         self.verifica_importo(importo)
+        sessione = object_session(self)
+        if sessione is not None and self.id is not None and sessione.get_bind().dialect.name != "sqlite":
+            #database server: rileggo il saldo con SELECT ... FOR UPDATE, il conto resta bloccato fino al commit
+            sessione.refresh(self, ["saldo", "versione"], with_for_update=True)
+        #su SQLite (niente lock di riga) la garanzia è l'UPDATE condizionato in _aggiorna_saldo
         if self.saldo_corrente < importo:
             raise ValueError("Saldo insufficiente.")   
 
@@ -170,19 +233,107 @@ class Conto(Base):
         return trans
 
 
+class Sequenza(Base):
+    #contatori per i codici univoci: il progressivo passa per codici.permuta con la chiave del database
+    __tablename__ = "sequenze"
+    nome = Column(String, primary_key=True)
+    valore = Column(Integer, nullable=False, default=0)
+    chiave = Column(String, nullable=False)
+    riservati = Column(String, nullable=True) #progressivi da saltare: corrispondono a codici creati prima delle sequenze
+
+    @staticmethod
+    def prossimo_codice(session, nome):
+        #un solo UPDATE ... RETURNING: l'incremento è atomico e fa parte della transazione di chi crea il codice
+        sequenze = Sequenza.__table__
+        while True:
+            riga = session.execute(
+                update(sequenze)
+                .where(sequenze.c.nome == nome)
+                .values(valore=sequenze.c.valore + 1)
+                .returning(sequenze.c.valore, sequenze.c.chiave, sequenze.c.riservati)
+            ).one()
+            if riga.valore >= codici.DOMINIO:
+                raise ValueError("Codici disponibili esauriti.")
+            if riga.valore not in _progressivi_riservati(riga.riservati):
+                return codici.permuta(riga.valore, riga.chiave)
+
+    @staticmethod
+    def riserva_codici(session, nome, quanti):
+        #come prossimo_codice ma per un blocco: un solo UPDATE avanza la sequenza di quanti (più i riservati saltati)
+        sequenze = Sequenza.__table__
+        codici_blocco = []
+        while len(codici_blocco) < quanti:
+            mancanti = quanti - len(codici_blocco)
+            riga = session.execute(
+                update(sequenze)
+                .where(sequenze.c.nome == nome)
+                .values(valore=sequenze.c.valore + mancanti)
+                .returning(sequenze.c.valore, sequenze.c.chiave, sequenze.c.riservati)
+            ).one()
+            if riga.valore >= codici.DOMINIO:
+                raise ValueError("Codici disponibili esauriti.")
+            riservati = _progressivi_riservati(riga.riservati)
+            codici_blocco.extend(
+                codici.permuta(valore, riga.chiave)
+                for valore in range(riga.valore - mancanti + 1, riga.valore + 1)
+                if valore not in riservati
+            )
+        return codici_blocco
+
+
+@lru_cache(maxsize=16)
+def _progressivi_riservati(riservati):
+    return frozenset(int(v) for v in riservati.split(",")) if riservati else frozenset()
+
+
+class EsecuzioneStipendi(Base):
+    #avanzamento dell'accredito stipendi di un mese: ultimo_utente_id viene salvato nella stessa transazione
+    #di ogni blocco di accrediti, quindi dopo un'interruzione si riparte dal blocco successivo
+    __tablename__ = "esecuzioni_stipendi"
+    mese = Column(String(7), primary_key=True) #AAAA-MM
+    ultimo_utente_id = Column(Integer, nullable=False, default=0)
+    accrediti = Column(Integer, nullable=False, default=0)
+    completata = Column(Boolean, nullable=False, default=False)
+
+
+class ChiaveIdempotenza(Base):
+    #esito di una richiesta inviata con Idempotency-Key (vedi idempotenza.py): ripeterla restituisce lo stesso esito
+    __tablename__ = "chiavi_idempotenza"
+    __table_args__ = (
+        Index("ix_chiavi_idempotenza_scadenza", "scadenza"), #pulizia delle chiavi scadute
+    )
+    utente_id = Column(Integer, primary_key=True)
+    chiave = Column(String(64), primary_key=True)
+    proprietario = Column(String(32), nullable=False) #richiesta che ha prenotato la chiave
+    impronta = Column(String(64), nullable=False) #hash di rotta e dati: la stessa chiave con altri dati è un errore
+    stato = Column(Integer, nullable=True) #codice HTTP dell'esito, NULL finché la richiesta è in corso
+    esito = Column(Text, nullable=True) #JSON con corpo, redirect e messaggi flash
+    scadenza = Column(Integer, nullable=False) #secondi epoch
+    movimento_id = Column(Integer, nullable=True) #transazione applicata con la chiave, scritta nello stesso commit
+
+
 class TipoTransazione(PyEnum):
     BONIFICO = "Bonifico"  #richiede mittente e destinatario
     DEPOSITO = "Deposito"  #solo destinatario. da atm
     PRELIEVO = "Prelievo"  #solo mittente. da atm
     PAGAMENTO = "Pagamento" #come bonifico ma a un esercente
     BONUS = "Bonus"     #solo destinatario, da parte della banca
+    STIPENDIO = "Stipendio" #solo destinatario, accredito mensile da stipendi.py
 
 
 class Transazione(Base):
     __tablename__ = 'transazioni'
+    __table_args__ = (
+        #storico per conto in ordine di data, una per direzione del movimento
+        Index("ix_transazioni_mittente_data", "conto_mittente_id", "data", "id"),
+        Index("ix_transazioni_destinatario_data", "conto_destinatario_id", "data", "id"),
+        #movimenti successivi a un id, per la ripresa dei flussi di eventi
+        Index("ix_transazioni_mittente_id", "conto_mittente_id", "id"),
+        Index("ix_transazioni_destinatario_id", "conto_destinatario_id", "id"),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     importo = Column(Numeric(10,2), nullable=False)
-    data = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    data = Column(DataOra, server_default=func.now(), nullable=False)
     descrizione = Column(String, nullable=True)
     tipo = Column(SqlEnum(TipoTransazione, name="tipo_transazione"), nullable=False)
 
@@ -195,4 +346,42 @@ class Transazione(Base):
     conto_destinatario = relationship("Conto", foreign_keys=[conto_destinatario_id], back_populates="transazioni_ricevute")
 
 
-    
+#---- Aggiornamento del saldo memorizzato ----
+#Ogni Transazione inserita sposta il saldo dei conti coinvolti con un UPDATE atomico (saldo = saldo +/- importo)
+#eseguito sulla stessa connessione del flush, quindi nella stessa transazione del movimento.
+#L'addebito è condizionato a saldo >= importo: se nel frattempo un'altra transazione ha speso il saldo letto
+#da verifica_saldo, l'UPDATE non modifica righe e il movimento viene annullato (nessun conto va in negativo).
+
+@event.listens_for(Transazione, "after_insert")
+def _aggiorna_saldo(mapper, connection, trans):
+    conti = Conto.__table__
+    modificati = []
+    if trans.conto_mittente_id is not None:
+        addebito = connection.execute(
+            update(conti)
+            .where(conti.c.id == trans.conto_mittente_id, conti.c.saldo >= trans.importo)
+            .values(saldo=conti.c.saldo - trans.importo, versione=conti.c.versione + 1)
+        )
+        if addebito.rowcount == 0:
+            raise ValueError("Saldo insufficiente.")
+        modificati.append(trans.conto_mittente_id)
+    if trans.conto_destinatario_id is not None:
+        connection.execute(
+            update(conti)
+            .where(conti.c.id == trans.conto_destinatario_id)
+            .values(saldo=conti.c.saldo + trans.importo, versione=conti.c.versione + 1)
+        )
+        modificati.append(trans.conto_destinatario_id)
+
+    sessione = object_session(trans)
+    if sessione is not None:
+        sessione.info.setdefault("saldi_modificati", set()).update(modificati)
+
+
+@event.listens_for(Session, "after_flush_postexec")
+def _scadi_saldi_modificati(session, flush_context):
+    #i Conto già caricati in sessione hanno il saldo vecchio: lo faccio rileggere al prossimo accesso
+    for conto_id in session.info.pop("saldi_modificati", ()):
+        conto = session.identity_map.get(session.identity_key(Conto, conto_id))
+        if conto is not None:
+            session.expire(conto, ["saldo", "versione"])
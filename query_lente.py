@@ -0,0 +1,226 @@
+#query_lente.py registra le istruzioni SQL più lente di una soglia, con il loro piano di esecuzione.
+#Si attiva con BANCA_QUERY_LENTE_MS (millisecondi, anche 0 per registrare tutto): database.py collega allora
+#il registratore al motore. Per ogni istruzione lenta salva testo, forma dei parametri (tipi, non valori),
+#durata e rotta di provenienza; le istruzioni sono raggruppate per testo normalizzato (costanti e liste IN
+#ridotte a "?"), e il piano (EXPLAIN QUERY PLAN su SQLite, EXPLAIN sugli altri) viene letto una volta sola per gruppo.
+#Il registro è un piccolo database SQLite a parte (BANCA_QUERY_LENTE_DB), limitato a BANCA_QUERY_LENTE_MAX
+#istruzioni distinte: oltre, si scartano quelle viste meno di recente.
+#Uso da riga di comando, per vedere le istruzioni che costano di più in totale:
+#  python query_lente.py [--top 20] [--ordina totale|massimo|esecuzioni] [--piani] [--svuota]
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import event
+
+SOGLIA_MS = os.environ.get("BANCA_QUERY_LENTE_MS") #None = registratore spento
+PERCORSO_REGISTRO = os.environ.get("BANCA_QUERY_LENTE_DB", "query_lente.db")
+MASSIMO_ISTRUZIONI = int(os.environ.get("BANCA_QUERY_LENTE_MAX", "1000"))
+
+_TABELLA = """
+CREATE TABLE IF NOT EXISTS query_lente (
+    impronta TEXT PRIMARY KEY,
+    istruzione TEXT NOT NULL,
+    esempio TEXT NOT NULL,
+    forma_parametri TEXT NOT NULL,
+    piano TEXT,
+    esecuzioni INTEGER NOT NULL,
+    totale_ms REAL NOT NULL,
+    massimo_ms REAL NOT NULL,
+    ultima_rotta TEXT,
+    prima_vista TEXT NOT NULL,
+    ultima_vista TEXT NOT NULL
+)
+"""
+
+
+def normalizza(istruzione):
+    """Testo con spazi uniformi, costanti e liste di segnaposto ridotte: una riga per forma di query."""
+    testo = " ".join(istruzione.split())
+    testo = re.sub(r"'(?:[^']|'')*'", "?", testo)
+    testo = re.sub(r"\b\d+(?:\.\d+)?\b", "?", testo)
+    testo = re.sub(r"\(\s*\?(?:\s*,\s*\?)+\s*\)", "(?, ...)", testo) #IN (?, ?, ?) e VALUES (?, ?)
+    testo = re.sub(r"(\(\?, \.\.\.\))(?:, \(\?, \.\.\.\))+", r"\1, ...", testo) #più righe di VALUES
+    return testo
+
+
+def forma_parametri(parametri, executemany):
+    def tipi(valori):
+        if isinstance(valori, dict):
+            return "{" + ", ".join(f"{nome}: {type(v).__name__}" for nome, v in valori.items()) + "}"
+        return "(" + ", ".join(type(v).__name__ for v in valori or ()) + ")"
+    if _molte_righe(parametri, executemany):
+        return f"{len(parametri)} x {tipi(parametri[0])}"
+    return tipi(parametri)
+
+
+def _molte_righe(parametri, executemany):
+    #executemany con una sequenza di righe (gli insert "insertmanyvalues" arrivano già appiattiti)
+    return executemany and parametri and isinstance(parametri[0], (tuple, list, dict))
+
+
+def _rotta():
+    #la rotta Flask se l'istruzione arriva da una richiesta, altrimenti il nome del thread (es. lo scrittore)
+    try:
+        from flask import has_request_context, request
+        if has_request_context():
+            return f"{request.method} {request.endpoint or request.path}"
+    except ImportError:
+        pass
+    return threading.current_thread().name
+
+
+class RegistroQueryLente:
+    def __init__(self, percorso=PERCORSO_REGISTRO, massimo_istruzioni=MASSIMO_ISTRUZIONI):
+        self._percorso = percorso
+        self._massimo = massimo_istruzioni
+        self._connessione = None
+        self._piani_letti = set() #impronte già nel registro: il piano non va riletto
+        self._lock = threading.Lock()
+
+    def _db(self):
+        if self._connessione is None:
+            self._connessione = sqlite3.connect(self._percorso, check_same_thread=False, isolation_level=None)
+            self._connessione.execute("PRAGMA journal_mode=WAL")
+            self._connessione.execute(_TABELLA)
+            self._piani_letti = {r[0] for r in self._connessione.execute("SELECT impronta FROM query_lente")}
+        return self._connessione
+
+    def collega(self, engine, soglia_ms):
+        soglia = soglia_ms / 1000
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def _inizio(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("query_lente_inizio", []).append(time.perf_counter())
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def _fine(conn, cursor, statement, parameters, context, executemany):
+            inizi = conn.info.get("query_lente_inizio")
+            if not inizi:
+                return
+            durata = time.perf_counter() - inizi.pop()
+            if durata >= soglia:
+                self.registra(conn, statement, parameters, executemany, durata)
+
+    def registra(self, conn, istruzione, parametri, executemany, durata):
+        normale = normalizza(istruzione)
+        impronta = hashlib.sha1(normale.encode()).hexdigest()[:16]
+        adesso = datetime.now().isoformat(timespec="seconds")
+        durata_ms = durata * 1000
+        with self._lock:
+            db = self._db()
+            piano = None
+            nuova = impronta not in self._piani_letti
+            if nuova:
+                piano = self._piano(conn, istruzione, parametri[0] if _molte_righe(parametri, executemany) else parametri)
+                self._piani_letti.add(impronta)
+            db.execute(
+                """
+                INSERT INTO query_lente (impronta, istruzione, esempio, forma_parametri, piano, esecuzioni,
+                                         totale_ms, massimo_ms, ultima_rotta, prima_vista, ultima_vista)
+                VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?, ?, ?)
+                ON CONFLICT (impronta) DO UPDATE SET
+                    esecuzioni = esecuzioni + 1,
+                    totale_ms = totale_ms + excluded.totale_ms,
+                    massimo_ms = max(massimo_ms, excluded.massimo_ms),
+                    forma_parametri = excluded.forma_parametri,
+                    ultima_rotta = excluded.ultima_rotta,
+                    ultima_vista = excluded.ultima_vista
+                """,
+                (impronta, normale, " ".join(istruzione.split()), forma_parametri(parametri, executemany), piano,
+                 durata_ms, durata_ms, _rotta(), adesso, adesso),
+            )
+            if nuova and len(self._piani_letti) > self._massimo:
+                #registro pieno: tengo le istruzioni viste più di recente
+                scartate = [r[0] for r in db.execute(
+                    "SELECT impronta FROM query_lente ORDER BY ultima_vista, totale_ms LIMIT ?",
+                    (len(self._piani_letti) - self._massimo,)
+                )]
+                db.executemany("DELETE FROM query_lente WHERE impronta = ?", [(i,) for i in scartate])
+                self._piani_letti.difference_update(scartate)
+
+    @staticmethod
+    def _piano(conn, istruzione, parametri):
+        #sulla stessa connessione (stessa transazione, stesse tabelle temporanee) ma con un cursore DBAPI a parte:
+        #EXPLAIN non esegue l'istruzione e non passa dagli eventi del motore
+        if not istruzione.lstrip().upper().startswith(("SELECT", "WITH", "UPDATE", "DELETE", "INSERT")):
+            return None
+        sqlite = conn.dialect.name == "sqlite"
+        cursore = conn.connection.dbapi_connection.cursor()
+        try:
+            cursore.execute(("EXPLAIN QUERY PLAN " if sqlite else "EXPLAIN ") + istruzione, parametri or ())
+            righe = cursore.fetchall()
+        except Exception as e:
+            return f"piano non disponibile: {e}"
+        finally:
+            cursore.close()
+        if sqlite:
+            #(id, genitore, _, dettaglio): rientro in base alla profondità dell'albero
+            profondita = {0: -1}
+            testo = []
+            for id, genitore, _, dettaglio in righe:
+                profondita[id] = profondita.get(genitore, -1) + 1
+                testo.append("  " * profondita[id] + dettaglio)
+            return "\n".join(testo)
+        return "\n".join(str(riga[0]) for riga in righe)
+
+    def peggiori(self, quante=20, ordina="totale"):
+        colonna = {"totale": "totale_ms", "massimo": "massimo_ms", "esecuzioni": "esecuzioni"}[ordina]
+        with self._lock:
+            return self._db().execute(
+                f"SELECT istruzione, forma_parametri, piano, esecuzioni, totale_ms, massimo_ms, ultima_rotta "
+                f"FROM query_lente ORDER BY {colonna} DESC LIMIT ?",
+                (quante,)
+            ).fetchall()
+
+    def svuota(self):
+        with self._lock:
+            self._db().execute("DELETE FROM query_lente")
+            self._piani_letti.clear()
+
+
+registro = RegistroQueryLente()
+
+
+def collega_se_attivo(engine):
+    #chiamato da database.py: senza BANCA_QUERY_LENTE_MS il motore non riceve alcun ascoltatore
+    if SOGLIA_MS is not None and SOGLIA_MS != "":
+        registro.collega(engine, float(SOGLIA_MS))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Istruzioni SQL lente registrate con BANCA_QUERY_LENTE_MS")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--ordina", choices=("totale", "massimo", "esecuzioni"), default="totale")
+    parser.add_argument("--piani", action="store_true", help="mostra anche il piano di esecuzione")
+    parser.add_argument("--svuota", action="store_true", help="cancella il registro")
+    argomenti = parser.parse_args()
+
+    if not os.path.exists(PERCORSO_REGISTRO):
+        raise SystemExit(f"❌ Nessun registro in {PERCORSO_REGISTRO}: avviare l'app con BANCA_QUERY_LENTE_MS impostato.")
+    if argomenti.svuota:
+        registro.svuota()
+        print("✔️ Registro svuotato.")
+        raise SystemExit(0)
+
+    righe = registro.peggiori(argomenti.top, argomenti.ordina)
+    if not righe:
+        print("✔️ Nessuna istruzione lenta registrata.")
+    for posizione, (istruzione, forma, piano, esecuzioni, totale_ms, massimo_ms, rotta) in enumerate(righe, 1):
+        print(f"\n{posizione}. totale {totale_ms:.1f} ms   esecuzioni {esecuzioni}   "
+              f"media {totale_ms / esecuzioni:.2f} ms   massimo {massimo_ms:.2f} ms   ultima rotta {rotta}")
+        print(f"   {istruzione}")
+        print(f"   parametri: {forma}")
+        if argomenti.piani and piano:
+            sottoquery = set()
+            for riga in piano.splitlines():
+                #SCAN di una tabella (non di una sottoquery) senza USING ... INDEX: la tabella viene letta tutta
+                parole = riga.split()
+                if parole[0] in ("CO-ROUTINE", "MATERIALIZE"):
+                    sottoquery.add(parole[1])
+                scansione = parole[0] == "SCAN" and "USING" not in parole and parole[1] not in sottoquery | {"CONSTANT"}
+                print(f"   | {riga}" + ("   ❌ scansione senza indice" if scansione else ""))
@@ -0,0 +1,101 @@
+#riferimenti.py tiene in memoria i dati di riferimento che cambiano di rado (per ora il catalogo dei lavori).
+#Ogni voce ha una scadenza (TTL) e può essere invalidata esplicitamente da chi modifica le tabelle:
+#le pagine che li mostrano non interrogano il database a ogni richiesta.
+import os
+import threading
+import time
+from collections import namedtuple
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from database import SessionLocal
+from models import Lavoro
+
+TTL_RIFERIMENTI = float(os.environ.get("BANCA_RIFERIMENTI_TTL", "300")) #secondi
+
+#copie immutabili delle righe: non sono legate a una sessione, quindi si possono usare dopo la chiusura
+LavoroRif = namedtuple("LavoroRif", ["id", "nome_lavoro", "stipendio_mensile"])
+
+
+class CacheRiferimenti:
+    def __init__(self, ttl=TTL_RIFERIMENTI):
+        self.ttl = ttl
+        self._caricatori = {}
+        self._valori = {} #nome -> (scadenza, valore)
+        self._lock = threading.Lock()
+
+    def registra(self, nome, caricatore):
+        #caricatore(db) restituisce un valore immutabile (tuple, namedtuple, frozenset...)
+        self._caricatori[nome] = caricatore
+
+    def ottieni(self, nome):
+        voce = self._valori.get(nome)
+        if voce is not None and voce[0] > time.monotonic():
+            return voce[1]
+        with self._lock:
+            #un solo thread ricarica: gli altri trovano il valore appena letto
+            voce = self._valori.get(nome)
+            if voce is not None and voce[0] > time.monotonic():
+                return voce[1]
+            db = SessionLocal.session_factory()
+            try:
+                valore = self._caricatori[nome](db)
+            finally:
+                db.close()
+            self._valori[nome] = (time.monotonic() + self.ttl, valore)
+            return valore
+
+    def invalida(self, *nomi):
+        #senza nomi svuota tutto
+        with self._lock:
+            if not nomi:
+                self._valori.clear()
+            for nome in nomi:
+                self._valori.pop(nome, None)
+
+
+cache = CacheRiferimenti()
+
+
+def _carica_lavori(db):
+    righe = db.execute(
+        select(Lavoro.id, Lavoro.nome_lavoro, Lavoro.stipendio_mensile).order_by(Lavoro.id)
+    ).all()
+    return tuple(LavoroRif(*riga) for riga in righe)
+
+
+cache.registra("lavori", _carica_lavori)
+
+
+def catalogo_lavori():
+    return cache.ottieni("lavori")
+
+
+def invalida_lavori():
+    #da chiamare dopo ogni modifica alla tabella lavori (lavori.py, interventi amministrativi)
+    cache.invalida("lavori")
+
+
+#---- Invalidazione automatica per le scritture fatte nello stesso processo ----
+#se una sessione committa modifiche a Lavoro la voce viene scartata subito, senza aspettare il TTL;
+#gli script separati (lavori.py) agiscono su un altro processo, lì vale il TTL
+_TABELLE_RIFERIMENTO = {Lavoro: "lavori"}
+
+
+@event.listens_for(Session, "after_flush")
+def _segna_riferimenti_modificati(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        nome = _TABELLE_RIFERIMENTO.get(type(obj))
+        if nome:
+            session.info.setdefault("riferimenti_modificati", set()).add(nome)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalida_dopo_commit(session):
+    nomi = session.info.pop("riferimenti_modificati", None)
+    if nomi:
+        cache.invalida(*nomi)
+
+
+@event.listens_for(Session, "after_rollback")
+def _scarta_dopo_rollback(session):
+    session.info.pop("riferimenti_modificati", None)
@@ -0,0 +1,142 @@
+#stipendi.py accredita lo stipendio mensile (Lavoro.stipendio_mensile) sul conto principale di ogni utente con un lavoro.
+#Uso: python stipendi.py [--mese AAAA-MM] [--blocco N]
+#Gli utenti sono lavorati a blocchi in ordine di id, un blocco per transazione. Ogni mese viene accreditato una sola
+#volta: se l'esecuzione si interrompe, rilanciando il comando si riparte dal primo blocco non salvato; se due
+#esecuzioni dello stesso mese si sovrappongono, ogni blocco viene accreditato da una sola delle due.
+import argparse
+from datetime import date, datetime
+from sqlalchemy import bindparam, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from database import SessionLocal, engine, Base
+from models import Conto, EsecuzioneStipendi, Lavoro, TipoTransazione, Transazione, Utente
+from migrazioni import applica_migrazioni
+
+BLOCCO_PREDEFINITO = 5000
+
+
+def prossimo_blocco(db, ultimo_utente_id, blocco):
+    #(utente, conto principale = primo conto aperto, stipendio) per i prossimi utenti con stipendio
+    return db.execute(
+        select(Utente.id, func.min(Conto.id).label("conto_id"), Lavoro.stipendio_mensile)
+        .join(Lavoro, Utente.lavoro_id == Lavoro.id)
+        .join(Conto, Conto.utente_id == Utente.id)
+        .where(Utente.id > ultimo_utente_id, Lavoro.stipendio_mensile > 0)
+        .group_by(Utente.id, Lavoro.stipendio_mensile)
+        .order_by(Utente.id)
+        .limit(blocco)
+    ).all()
+
+
+def prenota_blocco(db, mese, ultimo_utente_id, righe):
+    #UPDATE condizionato sull'avanzamento letto: se un'altra esecuzione dello stesso mese ha già preso questo blocco
+    #(o uno successivo) non modifica righe. È la prima scrittura della transazione: su SQLite prende il lock di
+    #scrittura, sui server il lock della riga, quindi due esecuzioni non possono prenotare lo stesso blocco
+    esecuzioni = EsecuzioneStipendi.__table__
+    prenotazione = db.execute(
+        update(esecuzioni)
+        .where(esecuzioni.c.mese == mese, esecuzioni.c.ultimo_utente_id == ultimo_utente_id)
+        .values(ultimo_utente_id=righe[-1].id, accrediti=esecuzioni.c.accrediti + len(righe))
+    )
+    return prenotazione.rowcount == 1
+
+
+def accredita_blocco(db, mese, righe):
+    descrizione = f"Accredito stipendio {mese}"
+    #insert e update "executemany" in Core: niente oggetti ORM né flush per singolo conto.
+    #Il saldo memorizzato va aggiornato qui perché gli insert Core non passano dall'evento di models.py
+    db.execute(insert(Transazione.__table__), [
+        {
+            "importo": r.stipendio_mensile,
+            "descrizione": descrizione,
+            "tipo": TipoTransazione.STIPENDIO,
+            "conto_mittente_id": None,
+            "conto_destinatario_id": r.conto_id,
+        }
+        for r in righe
+    ])
+    conti = Conto.__table__
+    db.execute(
+        update(conti)
+        .where(conti.c.id == bindparam("b_conto_id"))
+        .values(saldo=conti.c.saldo + bindparam("b_importo"), versione=conti.c.versione + 1),
+        [{"b_conto_id": r.conto_id, "b_importo": r.stipendio_mensile} for r in righe],
+    )
+
+
+def _esecuzione(db, mese):
+    #riga di avanzamento del mese, creata se manca (due esecuzioni possono provarci insieme: una sola la inserisce)
+    esecuzione = db.get(EsecuzioneStipendi, mese)
+    if esecuzione is None:
+        db.add(EsecuzioneStipendi(mese=mese, ultimo_utente_id=0, accrediti=0, completata=False))
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+        esecuzione = db.get(EsecuzioneStipendi, mese)
+    return esecuzione
+
+
+def accredita_stipendi(mese, blocco=BLOCCO_PREDEFINITO):
+    """Accredita gli stipendi del mese e restituisce gli accrediti fatti da questa esecuzione.
+
+    Più esecuzioni dello stesso mese possono partire insieme (es. due cron sovrapposti): ogni blocco viene
+    prenotato con prenota_blocco nella stessa transazione dei suoi accrediti, e l'esecuzione che trova il blocco
+    già preso si ferma lasciando il resto all'altra.
+    """
+    db = SessionLocal()
+    try:
+        esecuzione = _esecuzione(db, mese)
+        if esecuzione.completata:
+            print(f"✔️ Stipendi di {mese} già accreditati ({esecuzione.accrediti} accrediti).")
+            return 0
+        ultimo_utente_id = esecuzione.ultimo_utente_id
+        if ultimo_utente_id:
+            print(f"Ripresa accredito stipendi {mese} dall'utente {ultimo_utente_id + 1}...")
+
+        accrediti = 0
+        while True:
+            righe = prossimo_blocco(db, ultimo_utente_id, blocco)
+            if not righe:
+                break
+            if not prenota_blocco(db, mese, ultimo_utente_id, righe):
+                db.rollback()
+                print(f"❌ Un'altra esecuzione sta accreditando gli stipendi di {mese}: interrotta dopo {accrediti} accrediti.")
+                return accrediti
+            accredita_blocco(db, mese, righe)
+            db.commit() #prenotazione, accrediti del blocco e avanzamento insieme
+            ultimo_utente_id = righe[-1].id
+            accrediti += len(righe)
+            print(f"  {accrediti} accrediti (fino all'utente {ultimo_utente_id})")
+
+        esecuzioni = EsecuzioneStipendi.__table__
+        db.execute(update(esecuzioni).where(esecuzioni.c.mese == mese).values(completata=True))
+        db.commit()
+        print(f"✔️ Stipendi di {mese} accreditati: {accrediti} in questa esecuzione.")
+        return accrediti
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def mese_valido(testo):
+    try:
+        return datetime.strptime(testo, "%Y-%m").strftime("%Y-%m")
+    except ValueError:
+        raise argparse.ArgumentTypeError("usare il formato AAAA-MM")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Accredito mensile degli stipendi")
+    parser.add_argument("--mese", type=mese_valido, default=date.today().strftime("%Y-%m"), help="mese da accreditare (AAAA-MM)")
+    parser.add_argument("--blocco", type=int, default=BLOCCO_PREDEFINITO, help="utenti per transazione")
+    argomenti = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    applica_migrazioni(engine)
+    try:
+        accredita_stipendi(argomenti.mese, argomenti.blocco)
+    except Exception as e:
+        print("❌ Errore:", e)
+        raise SystemExit(1)
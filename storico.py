@@ -0,0 +1,155 @@
+#storico.py contiene le query sullo storico movimenti di un conto, condivise da pagina_privata e dalle API.
+from datetime import datetime
+from sqlalchemy import literal, or_, select, tuple_, union_all
+from sqlalchemy.orm import aliased
+from database import SessionLocal
+from models import Transazione
+
+#Paginazione "a cursore" su (data, id): ogni pagina riparte dall'ultima riga vista invece di usare OFFSET,
+#quindi il costo di una pagina non cresce con l'anzianità del conto.
+PAGINA_TRANSAZIONI = 20
+PAGINA_TRANSAZIONI_MAX = 100
+
+
+def codifica_cursore(trans):
+    return f"{trans.data:%Y%m%d%H%M%S}-{trans.id}"
+
+
+def decodifica_cursore(cursore):
+    data, _, trans_id = cursore.partition("-")
+    return datetime.strptime(data, "%Y%m%d%H%M%S"), int(trans_id)
+
+
+def _ramo(conto_id, uscita, cursore, limite):
+    #una sola direzione del movimento: è una scansione di intervallo su uno degli indici (conto, data, id)
+    colonna = Transazione.conto_mittente_id if uscita else Transazione.conto_destinatario_id
+    query = select(Transazione, literal(uscita).label("uscita")).where(colonna == conto_id)
+    if not uscita:
+        #un bonifico verso lo stesso conto compare una volta sola, come uscita
+        query = query.where(or_(
+            Transazione.conto_mittente_id.is_(None),
+            Transazione.conto_mittente_id != conto_id
+        ))
+    if cursore:
+        query = query.where(tuple_(Transazione.data, Transazione.id) < cursore)
+    return select(query.order_by(Transazione.data.desc(), Transazione.id.desc()).limit(limite).subquery())
+
+
+def query_pagina_transazioni(conto_id, posizione, limite):
+    #istruzione eseguita da pagina_transazioni (usata anche da migrazioni.verifica_piani per controllarne il piano)
+    rami = union_all(
+        _ramo(conto_id, True, posizione, limite),
+        _ramo(conto_id, False, posizione, limite),
+    ).subquery()
+    trans = aliased(Transazione, rami)
+    return select(trans, rami.c.uscita).order_by(rami.c.data.desc(), rami.c.id.desc()).limit(limite)
+
+
+def pagina_transazioni(db, conto_id, cursore=None, limite=PAGINA_TRANSAZIONI):
+    """Restituisce ([(transazione, uscita), ...], prossimo_cursore) dalla più recente.
+
+    Invece di un unico filtro mittente OR destinatario (che costringe SQLite a ordinare tutto lo storico)
+    unisce con UNION ALL due scansioni indicizzate già ordinate, ognuna limitata alla dimensione della pagina.
+    """
+    limite = max(1, min(limite, PAGINA_TRANSAZIONI_MAX))
+    posizione = decodifica_cursore(cursore) if cursore else None
+
+    #leggo una riga in più per sapere se esiste una pagina successiva
+    righe = db.execute(query_pagina_transazioni(conto_id, posizione, limite + 1)).all()
+
+    prossimo_cursore = codifica_cursore(righe[limite - 1][0]) if len(righe) > limite else None
+    return [(t, bool(uscita)) for t, uscita in righe[:limite]], prossimo_cursore
+
+
+#---- Estratto conto completo ----
+COLONNE_ESTRATTO = (
+    Transazione.id,
+    Transazione.data,
+    Transazione.importo,
+    Transazione.tipo,
+    Transazione.descrizione,
+    Transazione.conto_mittente_id,
+    Transazione.conto_destinatario_id,
+)
+BLOCCO_ESTRATTO = 1000
+
+
+def _ramo_estratto(conto_id, uscita, dal, al, dopo):
+    #come _ramo, ma in ordine cronologico e ripartendo dopo (data, id) dell'ultima riga del blocco precedente
+    colonna = Transazione.conto_mittente_id if uscita else Transazione.conto_destinatario_id
+    query = select(*COLONNE_ESTRATTO, literal(uscita).label("uscita")).where(colonna == conto_id)
+    if not uscita:
+        query = query.where(or_(
+            Transazione.conto_mittente_id.is_(None),
+            Transazione.conto_mittente_id != conto_id
+        ))
+    if dopo:
+        query = query.where(tuple_(Transazione.data, Transazione.id) > dopo)
+    elif dal:
+        query = query.where(Transazione.data >= dal)
+    if al:
+        query = query.where(Transazione.data < al)
+    return select(query.order_by(Transazione.data, Transazione.id).limit(BLOCCO_ESTRATTO).subquery())
+
+
+def query_blocco_estratto(conto_id, dal, al, dopo):
+    rami = union_all(
+        _ramo_estratto(conto_id, True, dal, al, dopo),
+        _ramo_estratto(conto_id, False, dal, al, dopo),
+    ).subquery()
+    return select(rami).order_by(rami.c.data, rami.c.id).limit(BLOCCO_ESTRATTO)
+
+
+def blocco_estratto(db, conto_id, dal=None, al=None, dopo=None):
+    """Al massimo BLOCCO_ESTRATTO movimenti successivi a dopo = (data, id), in ordine cronologico."""
+    righe = db.execute(query_blocco_estratto(conto_id, dal, al, dopo)).all()
+    return [(riga, bool(riga.uscita)) for riga in righe]
+
+
+def movimenti_estratto(conto_id, dal=None, al=None):
+    """Scorre tutti i movimenti del conto in ordine cronologico come coppie (riga, uscita).
+
+    Legge a blocchi di BLOCCO_ESTRATTO righe, ognuno con una propria sessione chiusa prima di restituire le righe:
+    la transazione di lettura dura una query, non tutto lo scaricamento (che va al ritmo del client), quindi
+    su SQLite senza WAL non tiene il lock condiviso che bloccherebbe i bonifici. Il blocco successivo riparte
+    da (data, id) dell'ultima riga: la memoria usata non dipende dal numero di movimenti.
+    """
+    dopo = None
+    while True:
+        db = SessionLocal.session_factory()
+        try:
+            blocco = blocco_estratto(db, conto_id, dal, al, dopo)
+        finally:
+            db.close()
+        yield from blocco
+        if len(blocco) < BLOCCO_ESTRATTO:
+            return
+        ultima = blocco[-1][0]
+        dopo = (ultima.data, ultima.id)
+
+
+#---- Movimenti successivi a un id (ripresa dei flussi di eventi) ----
+def _ramo_successivi(conto_id, uscita, dopo_id, limite):
+    #una direzione del movimento in ordine di id: scansione di intervallo sugli indici (conto, id)
+    colonna = Transazione.conto_mittente_id if uscita else Transazione.conto_destinatario_id
+    query = select(*COLONNE_ESTRATTO, literal(uscita).label("uscita")).where(colonna == conto_id, Transazione.id > dopo_id)
+    if not uscita:
+        query = query.where(or_(
+            Transazione.conto_mittente_id.is_(None),
+            Transazione.conto_mittente_id != conto_id
+        ))
+    return select(query.order_by(Transazione.id).limit(limite).subquery())
+
+
+def query_movimenti_successivi(conto_id, dopo_id, limite):
+    rami = union_all(
+        _ramo_successivi(conto_id, True, dopo_id, limite),
+        _ramo_successivi(conto_id, False, dopo_id, limite),
+    ).subquery()
+    return select(rami).order_by(rami.c.id).limit(limite)
+
+
+def movimenti_successivi(db, conto_id, dopo_id, limite=PAGINA_TRANSAZIONI_MAX):
+    """Restituisce al massimo limite coppie (riga, uscita) con id > dopo_id, in ordine di id."""
+    righe = db.execute(query_movimenti_successivi(conto_id, dopo_id, limite)).all()
+    return [(riga, bool(riga.uscita)) for riga in righe]
@@ -0,0 +1,27 @@
+#configurazione comune dei test: il progetto è fatto di moduli al primo livello, quindi la cartella va nel path,
+#e database.py crea il motore all'import: BANCA_DATABASE_URL va impostato prima, su un file temporaneo
+#(i test non devono mai toccare db_banca.db)
+import os
+import sys
+import tempfile
+import pytest
+
+CARTELLA_PROGETTO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, CARTELLA_PROGETTO)
+
+_cartella_db = tempfile.mkdtemp(prefix="test_banca_")
+os.environ["BANCA_DATABASE_URL"] = f"sqlite:///{os.path.join(_cartella_db, 'test.db')}"
+os.environ["BANCA_BUDGET_QUERY"] = "errore"
+
+
+@pytest.fixture
+def engine():
+    #schema ricreato da zero per ogni test
+    from database import Base, SessionLocal, engine
+    import models  # noqa: F401 registra le tabelle su Base
+
+    SessionLocal.remove()
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    yield engine
+    SessionLocal.remove()
@@ -0,0 +1,101 @@
+#attesa scaduta in esegui_movimento: il movimento o viene annullato prima dello scrittore o viene dato in sospeso
+import threading
+from decimal import Decimal
+import pytest
+from sqlalchemy import func, insert, select
+
+
+@pytest.fixture
+def conto(engine):
+    from models import Conto, Utente
+
+    with engine.begin() as conn:
+        conn.execute(insert(Utente.__table__).values(
+            id=1, nome="Nome", cognome="Cognome", codice_fiscale="CF00000000000001", codice_titolare="00000001", pin_hash="x"
+        ))
+        conn.execute(insert(Conto.__table__).values(id=1, iban="IT" + "1" * 25, utente_id=1, saldo=Decimal("100.00")))
+    return 1
+
+
+def _movimenti(engine):
+    from models import Transazione
+
+    with engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(Transazione)).scalar_one()
+
+
+def _paga(conto_id):
+    import coda_movimenti
+    from models import TipoTransazione
+
+    return coda_movimenti.esegui_movimento(TipoTransazione.PAGAMENTO, 1, conto_id, Decimal("10.00"), "prova")
+
+
+def test_attesa_scaduta_in_coda_annulla_il_movimento(engine, conto, monkeypatch):
+    import coda_movimenti
+
+    coda = coda_movimenti.CodaMovimenti()
+    coda._thread = object() #scrittore "fermo": la richiesta resta in coda
+    monkeypatch.setattr(coda_movimenti, "coda", coda)
+    monkeypatch.setattr(coda_movimenti, "ATTESA_ESITO", 0.05)
+
+    with pytest.raises(coda_movimenti.MovimentoRifiutato) as errore:
+        _paga(conto)
+    assert errore.value.motivo == "occupato"
+    #lo scrittore che riparte scarta la richiesta annullata
+    assert coda._prossimo_blocco() == []
+    assert _movimenti(engine) == 0
+
+
+def test_attesa_scaduta_in_scrittura_resta_in_sospeso(engine, conto, monkeypatch):
+    import coda_movimenti
+
+    in_scrittura, sblocca = threading.Event(), threading.Event()
+    originale = coda_movimenti.applica_blocco
+
+    def applica_lenta(db, richieste, tutto_o_niente=False):
+        in_scrittura.set()
+        sblocca.wait(10)
+        return originale(db, richieste, tutto_o_niente)
+
+    coda = coda_movimenti.CodaMovimenti()
+    monkeypatch.setattr(coda_movimenti, "coda", coda)
+    monkeypatch.setattr(coda_movimenti, "applica_blocco", applica_lenta)
+    monkeypatch.setattr(coda_movimenti, "ATTESA_ESITO", 0.2)
+
+    with pytest.raises(coda_movimenti.MovimentoInSospeso):
+        _paga(conto)
+    assert in_scrittura.is_set()
+    #lo scrittore completa comunque il movimento: per questo non va segnalato come fallito
+    fine = coda_movimenti.Richiesta(coda_movimenti.TipoTransazione.PAGAMENTO, 1, conto, Decimal("1.00"), "dopo", None)
+    sblocca.set()
+    coda.invia(fine).result(timeout=10)
+    assert _movimenti(engine) == 2
+
+
+def test_blocco_inserisce_le_transazioni_con_un_solo_insert(engine, conto):
+    import coda_movimenti
+    from budget_query import ContatoreQuery
+    from database import SessionLocal
+    from models import Conto, TipoTransazione, Transazione
+
+    with engine.begin() as conn:
+        conn.execute(insert(Conto.__table__).values(id=2, iban="IT" + "2" * 25, utente_id=1, saldo=Decimal("0.00")))
+    richieste = [
+        coda_movimenti.Richiesta(TipoTransazione.BONIFICO, 1, conto, Decimal("0.25"), f"bonifico {i}", "IT" + "2" * 25)
+        for i in range(200)
+    ]
+    db = SessionLocal.session_factory()
+    try:
+        with ContatoreQuery("blocco") as contatore:
+            esiti = coda_movimenti.applica_blocco(db, richieste)
+    finally:
+        db.close()
+
+    inserimenti = [s for s, _ in contatore.istruzioni if s.lstrip().upper().startswith("INSERT")]
+    assert len(inserimenti) == 1
+    assert contatore.ripetute() == {}
+    #ogni richiesta riceve l'id della propria riga
+    with engine.connect() as conn:
+        descrizioni = dict(conn.execute(select(Transazione.id, Transazione.descrizione)).all())
+    assert [descrizioni[esito["id"]] for _, esito in esiti] == [r.descrizione for r in richieste]
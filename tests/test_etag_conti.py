@@ -0,0 +1,57 @@
+#ETag di saldo e transazioni: una scrittura che non passa dalla cache del processo (altro worker, stipendi.py)
+#deve cambiare subito l'ETag e il corpo, senza aspettare il TTL della cache
+from decimal import Decimal
+import pytest
+from sqlalchemy import insert, update
+
+
+@pytest.fixture
+def client(engine):
+    import app as applicazione
+    from cache_conti import cache
+    from models import Conto, Utente
+
+    with engine.begin() as conn:
+        conn.execute(insert(Utente.__table__).values(
+            id=1, nome="Nome", cognome="Cognome", codice_fiscale="CF00000000000001", codice_titolare="00000001", pin_hash="x"
+        ))
+        conn.execute(insert(Conto.__table__).values(id=1, iban="IT" + "1" * 25, utente_id=1, saldo=Decimal("100.00")))
+    cache.svuota()
+    token = applicazione.firma_token_api.dumps({"utente": 1, "conti": [1]})
+    client = applicazione.app.test_client()
+    client.environ_base["HTTP_AUTHORIZATION"] = f"Bearer {token}"
+    yield client
+    cache.svuota()
+
+
+def _scrittura_esterna(engine):
+    #come un altro processo: niente eventi di sessione, quindi niente invalidazione della cache di questo processo
+    from models import Conto
+
+    conti = Conto.__table__
+    with engine.begin() as conn:
+        conn.execute(update(conti).where(conti.c.id == 1).values(saldo=Decimal("250.00"), versione=conti.c.versione + 1))
+
+
+def test_saldo_vede_subito_le_scritture_esterne(engine, client):
+    prima = client.get("/api/conti/1/saldo")
+    assert prima.status_code == 200
+    assert prima.get_json()["saldo_corrente"] == 100.0
+    assert client.get("/api/conti/1/saldo", headers={"If-None-Match": prima.headers["ETag"]}).status_code == 304
+
+    _scrittura_esterna(engine)
+    dopo = client.get("/api/conti/1/saldo", headers={"If-None-Match": prima.headers["ETag"]})
+    assert dopo.status_code == 200
+    assert dopo.headers["ETag"] != prima.headers["ETag"]
+    assert dopo.get_json()["saldo_corrente"] == 250.0
+
+
+def test_transazioni_con_etag_nuovo_non_usano_la_voce_vecchia(engine, client):
+    from cache_conti import cache
+
+    prima = client.get("/api/conti/1/transazioni")
+    assert prima.status_code == 200
+    _scrittura_esterna(engine)
+    dopo = client.get("/api/conti/1/transazioni", headers={"If-None-Match": prima.headers["ETag"]})
+    assert dopo.status_code == 200
+    assert cache.ottieni(1).versione == 1
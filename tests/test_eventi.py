@@ -0,0 +1,235 @@
+#flusso SSE dei movimenti: ripresa da Last-Event-ID, buffer pieno riletto dal DB, pubblicazione solo dopo il commit
+#e nessun movimento perso tra il punto di partenza di un nuovo client e la sua iscrizione
+import asyncio
+import threading
+from datetime import datetime, timedelta
+from decimal import Decimal
+import pytest
+from sqlalchemy import insert
+
+
+@pytest.fixture
+def conti(engine, monkeypatch):
+    import app  # noqa: F401 importare app.py applica le migrazioni (che ricalcolano i saldi): prima dei dati
+    import eventi
+    from models import Conto, Utente
+
+    with engine.begin() as conn:
+        conn.execute(insert(Utente.__table__).values(
+            id=1, nome="Nome", cognome="Cognome", codice_fiscale="CF00000000000001", codice_titolare="00000001", pin_hash="x"
+        ))
+        conn.execute(insert(Conto.__table__), [
+            {"id": 1, "iban": "IT" + "1" * 25, "utente_id": 1, "saldo": Decimal("1000.00")},
+            {"id": 2, "iban": "IT" + "2" * 25, "utente_id": 1, "saldo": Decimal("0.00")},
+        ])
+    monkeypatch.setattr(eventi, "KEEPALIVE", 0.01)
+    yield engine
+    assert eventi.bacheca.iscritti() == 0
+
+
+def _scrivi_movimenti(engine, movimenti):
+    #come un altro processo: niente eventi di sessione, quindi niente pubblicazione sulla bacheca
+    from models import TipoTransazione, Transazione
+
+    inizio = datetime(2026, 10, 18)
+    with engine.begin() as conn:
+        conn.execute(insert(Transazione.__table__), [
+            {"importo": Decimal("1.00"), "data": inizio + timedelta(seconds=i), "descrizione": f"movimento {i}",
+             "tipo": TipoTransazione.BONIFICO, "conto_mittente_id": mittente, "conto_destinatario_id": destinatario}
+            for i, (mittente, destinatario) in enumerate(movimenti)
+        ])
+
+
+def _deposita(descrizione):
+    #movimento ORM: viene pubblicato dagli eventi di sessione dopo il commit
+    from database import SessionLocal
+    from models import TipoTransazione, Transazione
+
+    db = SessionLocal.session_factory()
+    try:
+        trans = Transazione(importo=Decimal("5.00"), descrizione=descrizione, tipo=TipoTransazione.DEPOSITO,
+                            conto_destinatario_id=1)
+        db.add(trans)
+        db.commit()
+        return trans.id
+    finally:
+        db.close()
+
+
+def _leggi_fino_al_keepalive(flusso):
+    """[(id, uscita)] degli eventi inviati e i commenti, fino al primo keepalive (il flusso non ha altro da dire)."""
+    import json
+
+    eventi, commenti = [], []
+    for testo in flusso:
+        if testo == ": keepalive\n\n":
+            return eventi, commenti
+        if testo.startswith(":"):
+            commenti.append(testo)
+            continue
+        righe = dict(riga.split(": ", 1) for riga in testo.strip().split("\n"))
+        dati = json.loads(righe["data"])
+        assert righe["event"] == "movimento" and int(righe["id"]) == dati["id"]
+        eventi.append((dati["id"], dati["uscita"]))
+    raise AssertionError("flusso terminato")
+
+
+def test_ripresa_da_last_event_id_rilegge_i_movimenti_persi(conti):
+    from eventi import bacheca, flusso_eventi
+
+    #più di una pagina di recupero; il movimento 3 non riguarda il conto 1, il 5 è un bonifico in uscita
+    movimenti = [(2, 1)] * 250
+    movimenti[2] = (2, 2)
+    movimenti[4] = (1, 2)
+    _scrivi_movimenti(conti, movimenti)
+
+    flusso = flusso_eventi(bacheca.iscrivi(1), 1)
+    eventi, commenti = _leggi_fino_al_keepalive(flusso)
+    flusso.close()
+    assert [id for id, _ in eventi] == [2] + list(range(4, 251))
+    assert dict(eventi)[5] is True and dict(eventi)[4] is False
+    assert commenti == [": connesso\n\n"]
+
+
+def test_buffer_pieno_rilegge_dal_db(conti, monkeypatch):
+    import eventi
+    from eventi import bacheca, flusso_eventi, ultimo_movimento_id
+    from models import TipoTransazione
+
+    monkeypatch.setattr(eventi, "BUFFER_ISCRITTO", 3)
+    iscrizione = bacheca.iscrivi(1)
+    flusso = flusso_eventi(iscrizione, ultimo_movimento_id())
+    assert next(flusso) == ": connesso\n\n"
+
+    #il movimento 1 non viene mai pubblicato: può arrivare solo dalla rilettura
+    _scrivi_movimenti(conti, [(2, 1)] * 6)
+    for id in range(2, 7):
+        bacheca.pubblica_movimento(id, datetime(2026, 10, 18), Decimal("1.00"), TipoTransazione.BONIFICO, "x", 2, 1)
+    assert iscrizione._da_recuperare
+
+    eventi_inviati, _ = _leggi_fino_al_keepalive(flusso)
+    flusso.close()
+    assert [id for id, _ in eventi_inviati] == [1, 2, 3, 4, 5, 6]
+    assert not iscrizione._da_recuperare
+
+
+def test_pubblicazione_dopo_il_commit_e_non_dopo_il_rollback(conti):
+    from database import SessionLocal
+    from eventi import bacheca
+    from models import TipoTransazione, Transazione
+
+    iscrizione = bacheca.iscrivi(1)
+    try:
+        db = SessionLocal.session_factory()
+        try:
+            db.add(Transazione(importo=Decimal("5.00"), descrizione="annullato", tipo=TipoTransazione.DEPOSITO,
+                               conto_destinatario_id=1))
+            db.flush()
+            assert iscrizione.attendi(0) == ([], False) #non ancora committato
+            db.rollback()
+            assert iscrizione.attendi(0) == ([], False)
+
+            db.add(Transazione(importo=Decimal("5.00"), descrizione="confermato", tipo=TipoTransazione.DEPOSITO,
+                               conto_destinatario_id=1))
+            db.commit()
+        finally:
+            db.close()
+        eventi, da_recuperare = iscrizione.attendi(0)
+        assert [(e["descrizione"], e["uscita"]) for e in eventi] == [("confermato", False)]
+        assert not da_recuperare
+    finally:
+        bacheca.disiscrivi(iscrizione)
+
+
+@pytest.fixture
+def movimento_dopo_iscrizione(conti, monkeypatch):
+    #un movimento committato subito dopo l'iscrizione, prima che il flusso parta: [id] una volta scritto
+    from eventi import bacheca
+
+    scritti = []
+    iscrivi = bacheca.iscrivi
+
+    def iscrivi_e_scrivi(conto_id, loop=None):
+        iscrizione = iscrivi(conto_id, loop)
+        scritti.append(_deposita("durante l'apertura"))
+        return iscrizione
+
+    monkeypatch.setattr(bacheca, "iscrivi", iscrivi_e_scrivi)
+    return scritti
+
+
+def test_nuovo_client_non_perde_il_movimento_committato_durante_l_iscrizione(conti, movimento_dopo_iscrizione):
+    import app as applicazione
+
+    _deposita("prima dell'apertura")
+    token = applicazione.firma_token_api.dumps({"utente": 1, "conti": [1]})
+    client = applicazione.app.test_client()
+    risposta = client.get("/api/conti/1/eventi", headers={"Authorization": f"Bearer {token}"}, buffered=False)
+    assert risposta.status_code == 200
+    testi = (parte.decode() for parte in risposta.response)
+    eventi, commenti = _leggi_fino_al_keepalive(testi)
+    risposta.close()
+    #solo il movimento successivo all'apertura, una volta sola
+    assert [id for id, _ in eventi] == movimento_dopo_iscrizione
+    assert commenti == [": connesso\n\n"]
+
+
+def test_nuovo_client_asgi_non_perde_il_movimento_committato_durante_l_iscrizione(conti, movimento_dopo_iscrizione):
+    import app as applicazione
+    import app_async
+
+    _deposita("prima dell'apertura")
+    token = applicazione.firma_token_api.dumps({"utente": 1, "conti": [1]})
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": "/api/conti/1/eventi", "raw_path": b"/api/conti/1/eventi", "query_string": b"", "root_path": "",
+        "headers": [(b"authorization", f"Bearer {token}".encode())], "client": ("test", 1), "server": ("test", 80),
+    }
+
+    async def leggi():
+        #la richiesta si chiude (disconnessione del client) al primo keepalive
+        testi, chiuso = [], asyncio.Event()
+
+        async def receive():
+            await chiuso.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(messaggio):
+            if messaggio["type"] == "http.response.body" and messaggio.get("body"):
+                testi.append(messaggio["body"].decode())
+                if testi[-1] == ": keepalive\n\n":
+                    chiuso.set()
+
+        try:
+            await asyncio.wait_for(app_async.app(scope, receive, send), 10)
+        finally:
+            await app_async.engine_async.dispose()
+        return testi
+
+    eventi, commenti = _leggi_fino_al_keepalive(asyncio.run(leggi()))
+    assert [id for id, _ in eventi] == movimento_dopo_iscrizione
+    assert commenti == [": connesso\n\n"]
+
+
+def test_iscrizione_async_svegliata_da_un_altro_thread():
+    from eventi import Bacheca
+    from models import TipoTransazione
+
+    bacheca = Bacheca()
+
+    async def ascolta():
+        iscrizione = bacheca.iscrivi(7, asyncio.get_running_loop())
+        threading.Timer(0.05, bacheca.pubblica_movimento, (
+            1, datetime(2026, 10, 18), Decimal("5.00"), TipoTransazione.BONIFICO, "prova", 3, 7
+        )).start()
+        inizio = asyncio.get_running_loop().time()
+        eventi, da_recuperare = await iscrizione.attendi_async(10)
+        bacheca.disiscrivi(iscrizione)
+        return eventi, da_recuperare, asyncio.get_running_loop().time() - inizio
+
+    eventi, da_recuperare, attesa = asyncio.run(ascolta())
+    assert [e["id"] for e in eventi] == [1]
+    assert eventi[0]["uscita"] is False
+    assert not da_recuperare
+    assert attesa < 5
+    assert bacheca.iscritti() == 0
@@ -0,0 +1,126 @@
+#chiavi di idempotenza: il movimento e la sua chiave vanno insieme, una prenotazione abbandonata scade
+from decimal import Decimal
+import pytest
+from sqlalchemy import func, insert, select, update
+
+
+@pytest.fixture
+def conti(engine):
+    import app  # noqa: F401 importare app.py applica le migrazioni (che ricalcolano i saldi): prima dei dati
+    from models import Conto, Utente
+
+    with engine.begin() as conn:
+        conn.execute(insert(Utente.__table__).values(
+            id=1, nome="Nome", cognome="Cognome", codice_fiscale="CF00000000000001", codice_titolare="00000001", pin_hash="x"
+        ))
+        conn.execute(insert(Conto.__table__), [
+            {"id": 1, "iban": "IT" + "1" * 25, "utente_id": 1, "saldo": Decimal("100.00")},
+            {"id": 2, "iban": "IT" + "2" * 25, "utente_id": 1, "saldo": Decimal("0.00")},
+        ])
+    from idempotenza import registro
+    registro._conclusi.clear()
+    return engine
+
+
+@pytest.fixture
+def client(conti):
+    import app as applicazione
+
+    client = applicazione.app.test_client()
+    with client.session_transaction() as sessione:
+        sessione["utente_id"] = 1
+        sessione["conto_selezionato"] = 1
+    return client
+
+
+def _movimenti(engine):
+    from models import Transazione
+
+    with engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(Transazione)).scalar_one()
+
+
+def _paga(client, chiave):
+    return client.post("/effettua_pagamento", data={"importo": "10", "descrizione": "x", "chiave_idempotenza": chiave})
+
+
+def _impronta_pagamento():
+    #la stessa impronta che calcola idempotente per il modulo inviato da _paga
+    from idempotenza import impronta
+
+    return impronta("effettua_pagamento", {}, [("descrizione", "x"), ("importo", "10")], None)
+
+
+def test_movimento_committato_senza_esito_viene_ripreso(conti, client):
+    #la richiesta originale si ferma dopo il commit del movimento e prima di salvare l'esito
+    import coda_movimenti
+    from database import SessionLocal
+    from idempotenza import registro
+    from models import TipoTransazione
+
+    proprietario, _, _ = registro.prenota(1, "k1", _impronta_pagamento())
+    richiesta = coda_movimenti.Richiesta(TipoTransazione.PAGAMENTO, 1, 1, Decimal("10"), "x", None, (1, "k1", proprietario, 10**10))
+    db = SessionLocal.session_factory()
+    try:
+        (_, esito), = coda_movimenti.applica_blocco(db, [richiesta])
+    finally:
+        db.close()
+    assert not isinstance(esito, Exception)
+
+    risposta = _paga(client, "k1")
+    assert risposta.status_code == 302 and risposta.headers["Location"].endswith("/pagina_privata")
+    with client.session_transaction() as sessione:
+        assert sessione["_flashes"][-1] == ("success", "Pagamento effettuato con successo!")
+    ripetuta = _paga(client, "k1")
+    assert ripetuta.headers.get("Idempotent-Replayed") == "true"
+    assert _movimenti(conti) == 1
+
+
+def test_prenotazione_abbandonata_scade_e_il_vecchio_movimento_viene_rifiutato(conti, client):
+    import coda_movimenti
+    from database import SessionLocal
+    from idempotenza import registro
+    from models import ChiaveIdempotenza, TipoTransazione
+
+    abbandonata, _, _ = registro.prenota(1, "k2", _impronta_pagamento())
+    assert _paga(client, "k2").status_code == 302
+    with client.session_transaction() as sessione:
+        assert "in corso" in sessione["_flashes"][-1][1]
+    assert _movimenti(conti) == 0
+
+    #prenotazione scaduta: la chiave torna utilizzabile
+    tabella = ChiaveIdempotenza.__table__
+    with conti.begin() as conn:
+        conn.execute(update(tabella).values(scadenza=0))
+    assert _paga(client, "k2").status_code == 302
+    assert _movimenti(conti) == 1
+
+    #la richiesta che l'aveva prenotata non può più applicare il suo movimento
+    richiesta = coda_movimenti.Richiesta(TipoTransazione.PAGAMENTO, 1, 1, Decimal("10"), "x", None, (1, "k2", abbandonata, 10**10))
+    db = SessionLocal.session_factory()
+    try:
+        (_, esito), = coda_movimenti.applica_blocco(db, [richiesta])
+    finally:
+        db.close()
+    assert isinstance(esito, coda_movimenti.MovimentoRifiutato) and esito.motivo == "chiave"
+    assert _movimenti(conti) == 1
+
+
+@pytest.mark.filterwarnings("ignore:Using `httpx`")
+def test_api_asgi_ripete_l_esito_della_chiave(conti):
+    from starlette.testclient import TestClient
+    import app as applicazione
+    import app_async
+
+    token = applicazione.firma_token_api.dumps({"utente": 1, "conti": [1, 2]})
+    client = TestClient(app_async.app)
+    intestazioni = {"Authorization": f"Bearer {token}", "Idempotency-Key": "k3"}
+    corpo = {"iban_destinatario": "IT" + "2" * 25, "importo": 5}
+
+    prima = client.post("/api/conti/1/bonifico", headers=intestazioni, json=corpo)
+    assert prima.status_code == 200
+    seconda = client.post("/api/conti/1/bonifico", headers=intestazioni, json=corpo)
+    assert seconda.headers.get("Idempotent-Replayed") == "true"
+    assert seconda.json() == prima.json()
+    diversa = client.post("/api/conti/1/bonifico", headers=intestazioni, json={**corpo, "importo": 6})
+    assert diversa.status_code == 422
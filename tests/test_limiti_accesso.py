@@ -0,0 +1,50 @@
+#secchielli dei tentativi sul PIN: contano solo i tentativi falliti e un secchiello vuoto non si svuota riempiendo la tabella
+import os
+import pytest
+from limiti_accesso import SecchielliMemoria, SecchielliSqlite
+
+LIMITE = (5.0, 5.0 / 300) #5 tentativi ogni 5 minuti
+
+
+@pytest.fixture(params=["memoria", "sqlite"])
+def secchielli(request, tmp_path):
+    if request.param == "memoria":
+        return SecchielliMemoria()
+    return SecchielliSqlite(os.path.join(tmp_path, "limiti.db"))
+
+
+def test_i_tentativi_riusciti_non_consumano_gettoni(secchielli):
+    richieste = [("titolare:00000001", LIMITE)]
+    for _ in range(50):
+        assert secchielli.preleva(richieste) == 0
+        secchielli.restituisci(richieste)
+
+
+def test_i_tentativi_falliti_esauriscono_il_secchiello(secchielli):
+    richieste = [("titolare:00000001", LIMITE)]
+    for _ in range(5):
+        assert secchielli.preleva(richieste) == 0
+    assert secchielli.preleva(richieste) > 0
+    #un successo non rende i tentativi già falliti
+    secchielli.restituisci(richieste)
+    assert secchielli.preleva(richieste) == 0
+    assert secchielli.preleva(richieste) > 0
+
+
+def test_le_chiavi_nuove_non_scartano_un_secchiello_vuoto():
+    secchielli = SecchielliMemoria(chiavi_max=10)
+    bersaglio = [("titolare:00000001", LIMITE)]
+    for _ in range(5):
+        secchielli.preleva(bersaglio)
+    for i in range(100):
+        secchielli.preleva([(f"titolare:altro{i}", LIMITE)])
+    assert secchielli.preleva(bersaglio) > 0
+
+
+def test_le_chiavi_piene_vengono_scartate():
+    secchielli = SecchielliMemoria(chiavi_max=10)
+    for i in range(100):
+        chiave = [(f"titolare:{i}", LIMITE)]
+        secchielli.preleva(chiave)
+        secchielli.restituisci(chiave)
+    assert len(secchielli._secchielli) == 10
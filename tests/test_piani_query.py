@@ -0,0 +1,41 @@
+#i piani di esecuzione delle query più frequenti, sulle istruzioni SQLAlchemy che le route eseguono davvero
+import pytest
+from migrazioni import piani_attesi, piano, problemi_piano, verifica_piani
+
+
+@pytest.mark.parametrize("descrizione, istruzione, indici", piani_attesi(), ids=lambda valore: str(valore)[:40])
+def test_query_usano_gli_indici(engine, descrizione, istruzione, indici):
+    from database import Base
+
+    with engine.connect() as conn:
+        righe = piano(conn, istruzione)
+    assert problemi_piano(righe, indici, Base.metadata.tables) == [], righe
+
+
+def test_storico_legge_entrambe_le_direzioni_sugli_indici(engine):
+    from storico import query_pagina_transazioni
+
+    with engine.connect() as conn:
+        dettagli = [dettaglio for _, _, dettaglio in piano(conn, query_pagina_transazioni(1, None, 21))]
+    assert "MERGE (UNION ALL)" in dettagli
+    ricerche = [d for d in dettagli if d.startswith("SEARCH transazioni")]
+    assert len(ricerche) == 2
+    assert any("ix_transazioni_mittente_data" in d for d in ricerche)
+    assert any("ix_transazioni_destinatario_data" in d for d in ricerche)
+
+
+def test_verifica_piani_segnala_un_indice_mancante(engine):
+    from sqlalchemy import text
+
+    assert verifica_piani(engine) == []
+    with engine.begin() as conn:
+        #anche l'indice per id, altrimenti SQLite ripiega su quello per lo storico
+        conn.execute(text("DROP INDEX ix_transazioni_destinatario_data"))
+        conn.execute(text("DROP INDEX ix_transazioni_destinatario_id"))
+    #le istruzioni EXPLAIN restano nella cache di pysqlite e non si accorgono del cambio di schema: connessioni nuove
+    engine.dispose()
+    problemi = verifica_piani(engine)
+    assert any("non usa ix_transazioni_destinatario_data" in p for p in problemi)
+    assert any("scansione completa: SCAN transazioni" in p for p in problemi)
+    assert any("ordinamento non coperto" in p for p in problemi)
+    assert any("non usa ix_transazioni_destinatario_id" in p for p in problemi)
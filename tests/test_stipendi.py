@@ -0,0 +1,80 @@
+#accredito degli stipendi: due esecuzioni dello stesso mese sovrapposte non devono accreditare due volte
+import threading
+import pytest
+from decimal import Decimal
+from sqlalchemy import func, insert, select
+
+
+def _popola(engine, utenti):
+    from models import Conto, Lavoro, TipoTransazione, Transazione, Utente
+
+    with engine.begin() as conn:
+        conn.execute(insert(Lavoro.__table__), [{"id": 1, "nome_lavoro": "Impiegato", "stipendio_mensile": Decimal("1500.00")}])
+        conn.execute(insert(Utente.__table__), [
+            {"id": i, "nome": "Nome", "cognome": "Cognome", "codice_fiscale": f"CF{i:014d}",
+             "codice_titolare": f"{i:08d}", "pin_hash": "x", "lavoro_id": 1}
+            for i in range(1, utenti + 1)
+        ])
+        conn.execute(insert(Conto.__table__), [
+            {"id": i, "iban": f"IT{i:025d}", "utente_id": i, "saldo": Decimal("0.00")} for i in range(1, utenti + 1)
+        ])
+    return Transazione, TipoTransazione, Conto
+
+
+@pytest.mark.parametrize("ripresa", [False, True], ids=["prima_esecuzione", "ripresa"])
+def test_esecuzioni_sovrapposte_accreditano_una_volta(engine, monkeypatch, ripresa):
+    import stipendi
+    from models import EsecuzioneStipendi
+
+    Transazione, TipoTransazione, Conto = _popola(engine, 20)
+    if ripresa:
+        #riga di avanzamento già presente: le due esecuzioni si contendono solo la prenotazione dei blocchi
+        with engine.begin() as conn:
+            conn.execute(insert(EsecuzioneStipendi.__table__).values(mese="2026-10", ultimo_utente_id=0, accrediti=0, completata=False))
+    #entrambe le esecuzioni leggono lo stesso blocco prima che una delle due lo prenoti
+    insieme = threading.Barrier(2, timeout=10)
+    originale = stipendi.prossimo_blocco
+
+    def prossimo_blocco(db, ultimo_utente_id, blocco):
+        righe = originale(db, ultimo_utente_id, blocco)
+        if ultimo_utente_id == 0:
+            insieme.wait()
+        return righe
+
+    monkeypatch.setattr(stipendi, "prossimo_blocco", prossimo_blocco)
+    esiti, errori = [], []
+
+    def esegui():
+        try:
+            esiti.append(stipendi.accredita_stipendi("2026-10", blocco=5))
+        except Exception as e:
+            errori.append(e)
+        finally:
+            stipendi.SessionLocal.remove()
+
+    thread = [threading.Thread(target=esegui) for _ in range(2)]
+    for t in thread:
+        t.start()
+    for t in thread:
+        t.join()
+
+    assert errori == []
+    assert sum(esiti) == 20
+    with engine.connect() as conn:
+        accrediti = conn.execute(
+            select(func.count()).where(Transazione.tipo == TipoTransazione.STIPENDIO)
+        ).scalar_one()
+        saldi = conn.execute(select(Conto.saldo)).scalars().all()
+    assert accrediti == 20
+    assert set(saldi) == {Decimal("1500.00")}
+
+
+def test_mese_completato_non_viene_riaccreditato(engine):
+    import stipendi
+
+    Transazione, _, _ = _popola(engine, 7)
+    assert stipendi.accredita_stipendi("2026-10", blocco=3) == 7
+    assert stipendi.accredita_stipendi("2026-10", blocco=3) == 0
+    stipendi.SessionLocal.remove()
+    with engine.connect() as conn:
+        assert conn.execute(select(func.count()).select_from(Transazione)).scalar_one() == 7
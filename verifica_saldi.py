@@ -0,0 +1,32 @@
+#verifica_saldi.py controlla che il saldo memorizzato di ogni conto coincida con la somma dei suoi movimenti.
+#Con --correggi riallinea i conti incoerenti al valore ricalcolato dallo storico.
+import sys
+from database import SessionLocal, engine, Base
+from models import Conto
+from migrazioni import applica_migrazioni
+
+
+Base.metadata.create_all(bind=engine)
+applica_migrazioni(engine)
+
+db = SessionLocal()
+try:
+    incoerenti = Conto.saldi_incoerenti(db)
+    if not incoerenti:
+        print("✔️ Tutti i saldi sono coerenti con lo storico.")
+    for conto_id, saldo, saldo_registro in incoerenti:
+        print(f"❌ Conto {conto_id}: saldo memorizzato {saldo}, saldo da storico {saldo_registro}")
+
+    if incoerenti and "--correggi" in sys.argv:
+        for conto_id, _, saldo_registro in incoerenti:
+            db.query(Conto).filter_by(id=conto_id).update({Conto.saldo: saldo_registro})
+        db.commit()
+        print(f"✔️ {len(incoerenti)} saldi riallineati.")
+    elif incoerenti:
+        sys.exit(1)
+except Exception as e:
+    db.rollback()
+    print("❌ Errore:", e)
+    sys.exit(1)
+finally:
+    db.close()